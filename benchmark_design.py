@@ -0,0 +1,131 @@
+import argparse
+import configparser
+import statistics
+import time
+from connection import ClusterPool
+from sql_queries import table_columns, dwh_tables_order, dashboard_queries, render
+from table_design import load_layouts, render_create_tables
+
+
+def create_layout_schema(cur, conn, name, layout):
+    """
+    Create a copy of the data warehouse tables with the physical design of a layout
+    in its own schema
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    name -- the layout name, the schema is called bench_<name>
+    layout -- dict mapping a table to its design, as returned by load_layouts
+    """
+
+    schema = f'bench_{name}'
+    print(f'Creating schema {schema}...')
+    cur.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE;')
+    cur.execute(f'CREATE SCHEMA {schema};')
+    cur.execute(render('set_search_path', schema=schema))
+
+    for query in render_create_tables(layout):
+        cur.execute(query)
+
+    for table in dwh_tables_order:
+        # identity columns can't be inserted into, they are generated again
+        columns = ', '.join(name for name, definition in table_columns[table] if 'IDENTITY' not in definition)
+        print(f'Copying {table} table...')
+        cur.execute(f'INSERT INTO {schema}.{table} ({columns}) SELECT {columns} FROM public.{table};')
+
+    conn.commit()
+
+    for table in dwh_tables_order:
+        cur.execute(f'ANALYZE {schema}.{table};')
+    conn.commit()
+
+
+def time_queries(cur, name, runs):
+    """
+    Run every dashboard query against one layout and time it
+
+    Params:
+    cur -- cursor object to database connection
+    name -- the layout name
+    runs -- how many times each query is run, the first run is a warm-up
+
+    Returns
+    timings -- dict mapping every dashboard query to its median time in seconds
+    """
+
+    cur.execute(f'SET search_path TO bench_{name};')
+    # otherwise every run after the first is answered from the result cache
+    cur.execute('SET enable_result_cache_for_session TO off;')
+
+    timings = {}
+    for query_name, query in dashboard_queries.items():
+        durations = []
+        for _ in range(runs + 1):
+            start = time.perf_counter()
+            cur.execute(query)
+            cur.fetchall()
+            durations.append(time.perf_counter() - start)
+
+        timings[query_name] = statistics.median(durations[1:])
+
+    return timings
+
+
+def print_report(results):
+    """
+    Print the median time of every dashboard query for every layout
+
+    Params:
+    results -- dict mapping every layout to its timings, as returned by time_queries
+    """
+
+    layouts = list(results)
+    width = max(len(query_name) for query_name in dashboard_queries)
+
+    print('\n' + 'query'.ljust(width) + ''.join(layout.rjust(12) for layout in layouts))
+    for query_name in dashboard_queries:
+        row = ''.join(f'{results[layout][query_name]:12.3f}' for layout in layouts)
+        print(query_name.ljust(width) + row)
+
+    totals = {layout: sum(results[layout].values()) for layout in layouts}
+    print('total'.ljust(width) + ''.join(f'{totals[layout]:12.3f}' for layout in layouts))
+    print(f'\nFastest layout: {min(totals, key=totals.get)}')
+
+
+if __name__ == "__main__":
+    """
+    Copy the loaded data warehouse into one schema per layout of table_design.cfg
+    and time the dashboard queries against each of them
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the table layouts with the dashboard queries.')
+    parser.add_argument('--layouts', nargs='*', help='layouts to benchmark, all of them by default')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs of every query')
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark schemas')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    layouts = load_layouts(config.get('DESIGN', 'LAYOUTS_FILE'))
+    names = args.layouts or list(layouts)
+
+    pool = ClusterPool(config)
+    conn = pool.getconn()
+    cur = conn.cursor()
+
+    results = {}
+    for name in names:
+        create_layout_schema(cur, conn, name, layouts[name])
+        results[name] = time_queries(cur, name, args.runs)
+
+    print_report(results)
+
+    if not args.keep:
+        for name in names:
+            cur.execute(f'DROP SCHEMA IF EXISTS bench_{name} CASCADE;')
+        conn.commit()
+
+    pool.putconn(conn)
+    pool.closeall()
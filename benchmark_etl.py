@@ -0,0 +1,171 @@
+import argparse
+import configparser
+import json
+import os
+import sys
+import time
+from calendar_dimension import extend_calendar_to_events
+from connection import ClusterPool
+from create_tables import drop_views, drop_tables, create_tables
+from local_postgres import local_data_dirs, translate, prepare_database, load_json_files
+from table_design import load_layouts, render_create_tables
+from sql_queries import insert_steps_order, render_insert_steps, staging_tables_order, staging_tables_names, \
+                        analyze_table, count_rows
+
+
+def timed_load(cur, conn, table, path):
+    """
+    Load the JSON files of a local directory into a staging table, and refresh
+    its statistics so the planner sees the same data the inserts will read
+
+    Returns
+    result -- dict with the seconds, rows and rows per second of the load
+    """
+
+    start = time.perf_counter()
+    rows = load_json_files(cur, conn, table, path)
+    seconds = time.perf_counter() - start
+
+    cur.execute(analyze_table.format(table))
+    conn.commit()
+
+    return {'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds if seconds else 0}
+
+
+def timed_calendar(cur, conn):
+    """
+    Build the time dimension over the days of the staged events, it starts empty
+
+    Returns
+    result -- dict with the seconds, rows and rows per second of the calendar
+    """
+
+    start = time.perf_counter()
+    rows = extend_calendar_to_events(cur, conn)
+    seconds = time.perf_counter() - start
+
+    return {'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds if seconds else 0}
+
+
+def timed_inserts(cur, conn):
+    """
+    Run every insert of the ETL one after the other and time each statement alone,
+    the tables are empty beforehand so their row count is what the insert wrote
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+
+    Returns
+    results -- dict mapping every insert step to its seconds, rows and rows per second
+    """
+
+    results = {}
+    for i, (table, query) in enumerate(zip(insert_steps_order, render_insert_steps(dialect='postgres')), 1):
+        print(f'{i}. Inserting into {table} table...')
+        start = time.perf_counter()
+        cur.execute(query)
+        conn.commit()
+        seconds = time.perf_counter() - start
+
+        cur.execute(count_rows.format(table))
+        rows = cur.fetchone()[0]
+        results[table] = {'seconds': seconds, 'rows': rows, 'rows_per_second': rows / seconds if seconds else 0}
+        print('Done.')
+
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare the throughput of every statement with a previous run
+
+    Params:
+    results -- dict mapping a step to its timing, as returned by timed_inserts
+    baseline -- the same dict from a previous run
+    tolerance -- allowed relative drop of rows per second, e.g. 0.2 for 20%
+
+    Returns
+    regressions -- list of (step, baseline rows/s, rows/s) slower than the tolerance
+    """
+
+    regressions = []
+    for step, result in results.items():
+        before = baseline.get(step, {}).get('rows_per_second')
+        if before and result['rows_per_second'] < before * (1 - tolerance):
+            regressions.append((step, before, result['rows_per_second']))
+
+    return regressions
+
+
+def print_report(results):
+    """
+    Print the seconds, rows and rows per second of every statement
+    """
+
+    print(f"\n{'statement':<16}{'seconds':>10}{'rows':>14}{'rows/s':>14}")
+    for step, result in results.items():
+        print(f"{step:<16}{result['seconds']:>10.2f}{result['rows']:>14}{result['rows_per_second']:>14.0f}")
+
+
+if __name__ == "__main__":
+    """
+    Run the ETL end to end on a local Postgres stand-in with data made by
+    generate_data.py, and time every statement to catch regressions in the SQL
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark the ETL statements on a local Postgres.')
+    parser.add_argument('--data', help='directory written by generate_data.py, [LOCAL] data_dir by default')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed drop of rows per second against the baseline')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    data_dir = args.data or config.get('LOCAL', 'DATA_DIR')
+
+    print('Connecting to the local Postgres database...')
+    pool = ClusterPool(config, 'LOCAL', query_group=None)
+    conn = pool.getconn()
+    cur = conn.cursor()
+    prepare_database(cur, conn)
+
+    print('\nFirst, drop all the views and tables if exists')
+    drop_views(cur, conn)
+    drop_tables(cur, conn)
+    # the physical design is skipped, Postgres has no distribution or sort keys
+    layout = load_layouts(config.get('DESIGN', 'LAYOUTS_FILE'))[config.get('DESIGN', 'LAYOUT')]
+    print('\nThen, create the tables')
+    create_tables(cur, conn, [translate(query) for query in render_create_tables(layout)])
+
+    print('\nLoading the staging tables from local JSON files...')
+    results = {}
+    for table, name in zip(staging_tables_order, staging_tables_names):
+        print(f'Loading {table} table...')
+        results[name] = timed_load(cur, conn, name, os.path.join(data_dir, local_data_dirs[name]))
+        print('Done.')
+
+    print('\nBuilding the calendar of the time dimension...')
+    results['time'] = timed_calendar(cur, conn)
+
+    print('\nInserting into the data warehouse tables...')
+    results.update(timed_inserts(cur, conn))
+    print_report(results)
+
+    pool.putconn(conn)
+    pool.closeall()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for step, before, after in regressions:
+            print(f'Regression in {step}: {before:.0f} -> {after:.0f} rows/s')
+        if regressions:
+            sys.exit(1)
+        print('\nNo regression against the baseline.')
@@ -0,0 +1,128 @@
+import argparse
+import configparser
+from datetime import date, datetime, timezone
+from connection import ClusterPool
+from sql_queries import load_settings, select_calendar_bounds, select_staging_ts_bounds, render_extend_calendar
+
+
+def day_keys(day):
+    """
+    The time_key of the first and the last row of a day
+
+    Params:
+    day -- datetime.date
+
+    Returns
+    first_key -- the time_key of midnight
+    last_key -- the time_key of the last second or minute of the day
+    """
+
+    grain_seconds = load_settings()['calendar_grain_seconds']
+    midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    seconds = int(midnight.timestamp())
+    return seconds // grain_seconds, (seconds + 86400) // grain_seconds - 1
+
+
+def missing_ranges(bounds, first_key, last_key):
+    """
+    The key ranges of the calendar to insert so it covers first_key to last_key,
+    the calendar only grows at its ends so it stays contiguous
+
+    Params:
+    bounds -- (min time_key, max time_key) of the calendar, (None, None) when it is empty
+    first_key -- the first time_key to cover
+    last_key -- the last time_key to cover
+
+    Returns
+    ranges -- list of (first time_key, last time_key) tuples
+    """
+
+    low, high = bounds
+    if low is None:
+        return [(first_key, last_key)]
+
+    ranges = []
+    if first_key < low:
+        ranges.append((first_key, low - 1))
+    if last_key > high:
+        ranges.append((high + 1, last_key))
+
+    return ranges
+
+
+def extend_calendar(cur, conn, first_day, last_day):
+    """
+    Add the days from first_day to last_day the time dimension doesn't hold yet,
+    one bulk insert per missing range
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    first_day -- the first datetime.date to cover
+    last_day -- the last datetime.date to cover
+
+    Returns
+    rows -- number of rows inserted
+    """
+
+    cur.execute(select_calendar_bounds)
+    bounds = cur.fetchone()
+
+    rows = 0
+    for first_key, last_key in missing_ranges(bounds, day_keys(first_day)[0], day_keys(last_day)[1]):
+        print(f'Extending the calendar with {last_key - first_key + 1} rows...')
+        cur.execute(render_extend_calendar(first_key, last_key))
+        rows += cur.rowcount
+    conn.commit()
+
+    return rows
+
+
+def extend_calendar_to_events(cur, conn, query=select_staging_ts_bounds):
+    """
+    Extend the time dimension to the days of the loaded events
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    query -- the query returning the oldest and the newest ts of the events, in milliseconds
+
+    Returns
+    rows -- number of rows inserted
+    """
+
+    cur.execute(query)
+    oldest, newest = cur.fetchone()
+    if oldest is None:
+        print('No events, the calendar is left as is.')
+        return 0
+
+    def day(ts):
+        return datetime.fromtimestamp(ts / 1000, timezone.utc).date()
+
+    return extend_calendar(cur, conn, day(oldest), day(newest))
+
+
+if __name__ == "__main__":
+    """
+    Pre-build the time dimension over a date range, the ETL then only extends it
+    """
+
+    parser = argparse.ArgumentParser(description='Build the calendar of the time dimension over a date range.')
+    parser.add_argument('--start-date', required=True, help='the first day of the calendar (YYYY-MM-DD)')
+    parser.add_argument('--end-date', required=True, help='the last day of the calendar (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    pool = ClusterPool(config)
+    conn = pool.getconn()
+    cur = conn.cursor()
+
+    start_date, end_date = date.fromisoformat(args.start_date), date.fromisoformat(args.end_date)
+    rows = extend_calendar(cur, conn, start_date, end_date)
+    print(f'Done, {rows} rows added at the {config.get("CALENDAR", "GRAIN")} grain.')
+
+    pool.putconn(conn)
+    pool.closeall()
@@ -0,0 +1,221 @@
+import argparse
+import configparser
+import time
+import boto3
+from provisioning import poll, wait_for_cluster, wait_for_status
+
+# node types that support elastic resize, with how far they can grow or shrink at once
+ELASTIC_RESIZE_FACTORS = {'ra3': 4, 'dc2': 2, 'ds2': 2}
+
+
+def describe_cluster(redshift, cluster_identifier):
+    """
+    Retrieves the properties of the cluster
+
+    Params:
+    redshift -- Boto3 client for Redshift
+    cluster_identifier -- the cluster identifier
+
+    Returns
+    cluster -- the cluster properties
+    """
+
+    return redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]
+
+
+def provisioning_timeouts(config):
+    """
+    The (timeout, initial delay, max delay) of the waits, from the PROVISIONING section
+    """
+
+    return (config.getint('PROVISIONING', 'TIMEOUT'),
+            config.getint('PROVISIONING', 'INITIAL_DELAY'),
+            config.getint('PROVISIONING', 'MAX_DELAY'))
+
+
+def redshift_client(config, region='us-west-2'):
+    """
+    Creates a Redshift client with the credentials of dwh.cfg
+    """
+
+    return boto3.client('redshift',
+                        aws_access_key_id=config.get('AWS', 'KEY'),
+                        aws_secret_access_key=config.get('AWS', 'SECRET'),
+                        region_name=region)
+
+
+def use_elastic_resize(node_type, current_nodes, target_nodes):
+    """
+    Whether a resize can be done with elastic resize, which takes minutes, instead
+    of classic resize, which copies all the data to a new cluster
+
+    Params:
+    node_type -- the node type of the cluster, e.g. dc2.large
+    current_nodes -- the current number of nodes
+    target_nodes -- the wanted number of nodes
+
+    Returns
+    boolean -- True for elastic resize, False for classic resize
+    """
+
+    # single-node clusters can only change their cluster type with a classic resize
+    if current_nodes == 1 or target_nodes == 1:
+        return False
+
+    factor = ELASTIC_RESIZE_FACTORS.get(node_type.split('.')[0])
+    return factor is not None and current_nodes / factor <= target_nodes <= current_nodes * factor
+
+
+def resize(redshift, cluster_identifier, target_nodes, timeouts):
+    """
+    Resize the cluster to a number of nodes and wait until it is available again
+
+    Params:
+    redshift -- Boto3 client for Redshift
+    cluster_identifier -- the cluster identifier
+    target_nodes -- the wanted number of nodes
+    timeouts -- (timeout, initial delay, max delay) of the wait
+
+    Returns
+    elapsed -- seconds the resize took, 0 if the cluster already had target_nodes
+    """
+
+    cluster = describe_cluster(redshift, cluster_identifier)
+    current_nodes = cluster['NumberOfNodes']
+    if current_nodes == target_nodes:
+        print(f'The cluster already has {target_nodes} nodes.')
+        return 0
+
+    elastic = use_elastic_resize(cluster['NodeType'], current_nodes, target_nodes)
+    print(f"Resizing the cluster from {current_nodes} to {target_nodes} nodes "
+          f"({'elastic' if elastic else 'classic'} resize)...")
+
+    options = {'ClusterType': 'multi-node' if target_nodes > 1 else 'single-node',
+               'NodeType': cluster['NodeType'],
+               'Classic': not elastic}
+    if target_nodes > 1:
+        options['NumberOfNodes'] = target_nodes
+
+    start = time.monotonic()
+    redshift.resize_cluster(ClusterIdentifier=cluster_identifier, **options)
+
+    # the status stays available for a moment after the call, so wait for the new size too
+    def resized():
+        cluster = describe_cluster(redshift, cluster_identifier)
+        return (cluster['ClusterStatus'].lower() == 'available'
+                and cluster['NumberOfNodes'] == target_nodes
+                and not cluster.get('PendingModifiedValues'))
+
+    poll(resized, f'{cluster_identifier} to have {target_nodes} nodes', *timeouts)
+    elapsed = time.monotonic() - start
+    print(f'Resize done in {elapsed:.0f}s.')
+
+    return elapsed
+
+
+def pause(redshift, cluster_identifier, timeouts):
+    """
+    Pause the cluster, a paused cluster only pays for its storage
+
+    Returns
+    elapsed -- seconds the pause took
+    """
+
+    print('Pausing the cluster...')
+    redshift.pause_cluster(ClusterIdentifier=cluster_identifier)
+    elapsed = wait_for_status(redshift, cluster_identifier, 'paused', *timeouts)
+    print(f'Cluster paused in {elapsed:.0f}s.')
+
+    return elapsed
+
+
+def resume(redshift, cluster_identifier, timeouts):
+    """
+    Resume the cluster if it is paused
+
+    Returns
+    elapsed -- seconds the resume took, 0 if the cluster wasn't paused
+    """
+
+    if describe_cluster(redshift, cluster_identifier)['ClusterStatus'].lower() != 'paused':
+        return 0
+
+    print('Resuming the cluster...')
+    redshift.resume_cluster(ClusterIdentifier=cluster_identifier)
+    elapsed = wait_for_cluster(redshift, 'cluster_available', cluster_identifier, *timeouts)
+    print(f'Cluster resumed in {elapsed:.0f}s.')
+
+    return elapsed
+
+
+def scale_up(redshift, config):
+    """
+    Get the cluster ready for the load: resume it and grow it to the load size
+
+    Params:
+    redshift -- Boto3 client for Redshift
+    config -- the parsed dwh.cfg
+
+    Returns
+    timings -- dict mapping every transition to the seconds it took
+    """
+
+    cluster_identifier = config.get('DWH', 'DWH_CLUSTER_IDENTIFIER')
+    timeouts = provisioning_timeouts(config)
+
+    timings = {'resume': resume(redshift, cluster_identifier, timeouts)}
+    timings['resize'] = resize(redshift, cluster_identifier, config.getint('CAPACITY', 'LOAD_NODES'), timeouts)
+
+    return timings
+
+
+def scale_down(redshift, config):
+    """
+    Shrink the cluster back to its idle size once the load is done, and pause it
+    if configured to
+
+    Params:
+    redshift -- Boto3 client for Redshift
+    config -- the parsed dwh.cfg
+
+    Returns
+    timings -- dict mapping every transition to the seconds it took
+    """
+
+    cluster_identifier = config.get('DWH', 'DWH_CLUSTER_IDENTIFIER')
+    timeouts = provisioning_timeouts(config)
+
+    timings = {'resize': resize(redshift, cluster_identifier, config.getint('CAPACITY', 'IDLE_NODES'), timeouts)}
+    if config.getboolean('CAPACITY', 'PAUSE_AFTER_LOAD'):
+        timings['pause'] = pause(redshift, cluster_identifier, timeouts)
+
+    return timings
+
+
+if __name__ == '__main__':
+    """
+    Resize, pause or resume the cluster around the ETL load window
+    """
+
+    parser = argparse.ArgumentParser(description='Manage the capacity of the Redshift cluster.')
+    parser.add_argument('action', choices=['up', 'down', 'pause', 'resume'],
+                        help='up before the load, down after it, or pause/resume on demand')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    redshift = redshift_client(config)
+    cluster_identifier = config.get('DWH', 'DWH_CLUSTER_IDENTIFIER')
+
+    if args.action == 'up':
+        timings = scale_up(redshift, config)
+    elif args.action == 'down':
+        timings = scale_down(redshift, config)
+    elif args.action == 'pause':
+        timings = {'pause': pause(redshift, cluster_identifier, provisioning_timeouts(config))}
+    else:
+        timings = {'resume': resume(redshift, cluster_identifier, provisioning_timeouts(config))}
+
+    for transition, seconds in timings.items():
+        print(f'{transition}: {seconds:.0f}s')
@@ -0,0 +1,108 @@
+import time
+from datetime import datetime, timezone
+from sql_queries import select_unfinished_run, select_done_steps, delete_checkpoint, insert_checkpoint, count_rows
+
+# the last step of every run, a run without it is resumed by the next one
+RUN_STEP = 'run'
+
+
+def start_run(cur, new_run=False):
+    """
+    Resume the last run if it didn't finish, otherwise start a new one
+
+    Params:
+    cur -- cursor object to database connection
+    new_run -- start a new run even if the last one didn't finish
+
+    Returns
+    run_id -- the id of the run
+    done -- set of the (step, partition) tuples the run already finished
+    """
+
+    cur.execute(select_unfinished_run)
+    row = cur.fetchone()
+
+    if row is None or new_run:
+        run_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+        print(f'Starting run {run_id}.\n')
+        return run_id, set()
+
+    run_id = row[0]
+    cur.execute(select_done_steps, (run_id,))
+    done = set(cur.fetchall())
+    print(f'Resuming run {run_id}, {len(done)} steps already done.\n')
+
+    return run_id, done
+
+
+def record_step(cur, conn, run_id, step, partition, status, table=None, seconds=None):
+    """
+    Record the status and wall time of a step, the row count of its table is kept once it is done
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    run_id -- the id of the run
+    step -- the step name
+    partition -- the partition the step worked on, '' for the whole data
+    status -- running, done or failed
+    table -- the table the step loads, its rows are counted when the step is done
+    seconds -- the wall time of the step, None while it is running
+    """
+
+    # a failed statement leaves the transaction aborted
+    conn.rollback()
+
+    row_count = None
+    if table and status == 'done':
+        cur.execute(count_rows.format(table))
+        row_count = cur.fetchone()[0]
+
+    cur.execute(delete_checkpoint, (run_id, step, partition))
+    cur.execute(insert_checkpoint, (run_id, step, partition, status, row_count, seconds))
+    conn.commit()
+
+
+def run_step(cur, conn, run_id, done, step, partition, table, action):
+    """
+    Run a step unless the run already finished it, and record its status
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    run_id -- the id of the run
+    done -- set of the (step, partition) tuples the run already finished
+    step -- the step name
+    partition -- the partition the step works on, '' for the whole data
+    table -- the table the step loads
+    action -- callable doing the work of the step
+    """
+
+    if (step, partition) in done:
+        print(f"Skipping {step}{' ' + partition if partition else ''}, already done in this run.")
+        return
+
+    record_step(cur, conn, run_id, step, partition, 'running')
+    start = time.perf_counter()
+    try:
+        action()
+    except Exception:
+        record_step(cur, conn, run_id, step, partition, 'failed', seconds=time.perf_counter() - start)
+        raise
+
+    record_step(cur, conn, run_id, step, partition, 'done', table, time.perf_counter() - start)
+    done.add((step, partition))
+
+
+def finish_run(cur, conn, run_id):
+    """
+    Mark the run as finished so the next one starts from scratch
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    run_id -- the id of the run
+    """
+
+    record_step(cur, conn, run_id, RUN_STEP, '', 'done')
+    print(f'Run {run_id} finished.\n')
@@ -0,0 +1,179 @@
+import configparser
+import math
+from sql_queries import table_columns, staging_tables_names, dwh_tables_order
+
+# AZ64 only supports these types, FLOAT columns fall back to the suggested encoding
+AZ64_TYPES = ('SMALLINT', 'INTEGER', 'BIGINT', 'DECIMAL', 'NUMERIC', 'DATE', 'TIMESTAMP')
+TEXT_TYPES = ('CHAR', 'VARCHAR')
+
+# the largest VARCHAR length Redshift accepts
+MAX_VARCHAR = 65535
+
+
+def column_type(definition):
+    """
+    The base type of a column definition, e.g. 'VARCHAR' for 'VARCHAR NOT NULL'
+    """
+
+    return definition.split()[0].split('(')[0].upper()
+
+
+def analyze_compression(cur, table):
+    """
+    Ask Redshift for the encoding that compresses every column of a table the most
+
+    Params:
+    cur -- cursor object to database connection
+    table -- the table to analyze
+
+    Returns
+    suggestions -- dict mapping every column to its suggested encoding
+    """
+
+    cur.execute(f'ANALYZE COMPRESSION {table};')
+    return {column.lower(): encoding.lower() for _, column, encoding, *_ in cur.fetchall()}
+
+
+def text_profile(cur, table):
+    """
+    Measure the longest value and the number of distinct values of every text
+    column of a table in a single scan
+
+    Params:
+    cur -- cursor object to database connection
+    table -- the table to profile
+
+    Returns
+    profile -- dict mapping every text column to a (max bytes, distinct values) tuple
+    """
+
+    columns = [name for name, definition in table_columns[table] if column_type(definition) in TEXT_TYPES]
+    if not columns:
+        return {}
+
+    aggregates = ', '.join(f'MAX(OCTET_LENGTH({name})), COUNT(DISTINCT {name})' for name in columns)
+    cur.execute(f'SELECT {aggregates} FROM {table};')
+    row = cur.fetchone()
+
+    return {name.lower(): (row[2 * i], row[2 * i + 1]) for i, name in enumerate(columns)}
+
+
+def choose_encodings(table, suggestions, profile, design, bytedict_limit):
+    """
+    Pick the encoding of every column of a table
+
+    The leading sort key column is left RAW so range restricted scans stay cheap,
+    numbers and timestamps get AZ64, text with few distinct values gets BYTEDICT
+    and the rest takes the encoding suggested by ANALYZE COMPRESSION, or ZSTD.
+
+    Params:
+    table -- the table name
+    suggestions -- the encodings suggested by analyze_compression
+    profile -- the text profile of the table, as returned by text_profile
+    design -- the physical design of the table
+    bytedict_limit -- the most distinct values a BYTEDICT column may have
+
+    Returns
+    encode -- dict mapping every column to its encoding
+    """
+
+    sortkey = [column.lower() for column in design.get('sortkey', [])]
+
+    encode = {}
+    for name, definition in table_columns[table]:
+        key = name.lower()
+        base_type = column_type(definition)
+
+        if sortkey and key == sortkey[0]:
+            encode[name] = 'raw'
+        elif base_type in AZ64_TYPES:
+            encode[name] = 'az64'
+        elif key in profile and profile[key][1] is not None and profile[key][1] <= bytedict_limit:
+            encode[name] = 'bytedict'
+        elif suggestions.get(key, 'raw') not in ('raw', 'az64'):
+            encode[name] = suggestions[key]
+        else:
+            encode[name] = 'zstd'
+
+    return encode
+
+
+def choose_widths(table, profile, headroom):
+    """
+    Size every VARCHAR column of a table after its longest observed value
+
+    Params:
+    table -- the table name
+    profile -- the text profile of the table, as returned by text_profile
+    headroom -- factor applied to the longest observed value
+
+    Returns
+    widths -- dict mapping every VARCHAR column to its length, rounded up to a multiple of 8
+    """
+
+    widths = {}
+    for name, definition in table_columns[table]:
+        longest = profile.get(name.lower(), (None, None))[0]
+        if column_type(definition) == 'VARCHAR' and longest:
+            widths[name] = min(MAX_VARCHAR, 8 * math.ceil(longest * headroom / 8))
+
+    return widths
+
+
+def derive_column_design(conn, layout, bytedict_limit, headroom):
+    """
+    Derive the encodings of all the tables and the VARCHAR widths of the data
+    warehouse tables from the loaded data. The staging tables keep their wide
+    columns so a longer value in a later COPY doesn't fail the load.
+
+    Params:
+    conn -- connection object to database
+    layout -- dict mapping a table to its design, as returned by load_layouts
+    bytedict_limit -- the most distinct values a BYTEDICT column may have
+    headroom -- factor applied to the longest observed value
+
+    Returns
+    column_design -- dict mapping every table to its encode and widths dicts
+    """
+
+    # ANALYZE COMPRESSION can't run inside a transaction block
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    column_design = {}
+    try:
+        for i, table in enumerate(staging_tables_names + dwh_tables_order, 1):
+            print(f'{i}. Analyzing compression of {table} table...')
+            suggestions = analyze_compression(cur, table)
+            profile = text_profile(cur, table)
+
+            column_design[table] = {
+                'encode': choose_encodings(table, suggestions, profile, layout.get(table, {}), bytedict_limit),
+                'widths': choose_widths(table, profile, headroom) if table in dwh_tables_order else {},
+            }
+            print('Done.')
+    finally:
+        conn.autocommit = False
+
+    return column_design
+
+
+def write_column_design(path, column_design):
+    """
+    Write the derived column design, create_tables.py uses it on the next rebuild
+
+    Params:
+    path -- path of the column design config file
+    column_design -- dict mapping every table to its encode and widths dicts
+    """
+
+    config = configparser.ConfigParser()
+    for table, design in column_design.items():
+        config[table] = {'encode': ', '.join(f'{name}:{encoding}' for name, encoding in design['encode'].items())}
+        if design['widths']:
+            config[table]['widths'] = ', '.join(f'{name}:{width}' for name, width in design['widths'].items())
+
+    with open(path, 'w') as configfile:
+        config.write(configfile)
+
+    print(f'Column design written to {path}, it is used the next time the tables are created.')
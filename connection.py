@@ -0,0 +1,206 @@
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from instrumentation import ETL_QUERY_GROUP, set_session_query_group
+
+# errors worth retrying, e.g. a dropped connection or a cluster that is restarting
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def connection_params(config, section='CLUSTER'):
+    """
+    Build the psycopg2 connection parameters from dwh.cfg
+
+    Params:
+    config -- the parsed dwh.cfg
+    section -- the section holding the database address, LOCAL for the local stand-in
+
+    Returns
+    params -- dict of keyword arguments for psycopg2.connect
+    """
+
+    cluster = config[section]
+    connection = config['CONNECTION']
+
+    return {
+        'host': cluster.get('HOST'),
+        'dbname': cluster.get('DB_NAME'),
+        'user': cluster.get('DB_USER'),
+        'password': cluster.get('DB_PASSWORD'),
+        'port': cluster.getint('DB_PORT'),
+        'connect_timeout': connection.getint('CONNECT_TIMEOUT'),
+        # detect dead connections during long COPY and INSERT statements
+        'keepalives': 1,
+        'keepalives_idle': connection.getint('KEEPALIVES_IDLE'),
+        'keepalives_interval': connection.getint('KEEPALIVES_INTERVAL'),
+        'keepalives_count': connection.getint('KEEPALIVES_COUNT'),
+    }
+
+
+def retry(func, attempts, backoff):
+    """
+    Call func, retrying with an exponential backoff when it fails with a transient error
+
+    Params:
+    func -- callable without arguments
+    attempts -- how many times func is called at most
+    backoff -- seconds to wait before the first retry, doubled after every retry
+
+    Returns
+    result -- what func returns
+    """
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except TRANSIENT_ERRORS as e:
+            if attempt == attempts:
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            print(f'Transient error: {e}'.strip() + f' Retrying in {delay:.0f}s...')
+            time.sleep(delay)
+
+
+class ClusterPool:
+    """
+    A bounded, thread-safe pool of connections to the Redshift cluster.
+
+    getconn blocks while all the connections are in use, every connection gets
+    the configured statement timeout and query group when it is opened.
+    """
+
+    def __init__(self, config, section='CLUSTER', query_group=ETL_QUERY_GROUP):
+        """
+        Open the pool with the CLUSTER (or section) and CONNECTION sections of dwh.cfg
+
+        Params:
+        config -- the parsed dwh.cfg
+        section -- the section holding the database address
+        query_group -- the query group of every connection, routing it to a WLM queue,
+                       None for a database without query groups (the local Postgres)
+        """
+
+        self.query_group = query_group
+
+        settings = config['CONNECTION']
+        max_connections = settings.getint('MAX_CONNECTIONS')
+        # psycopg2 closes the connections returned above min_connections, keeping them all
+        # open lets the sessions be reused instead of reconnecting for every query
+        min_connections = settings.getint('MIN_CONNECTIONS', fallback=max_connections)
+
+        self.statement_timeout = settings.getint('STATEMENT_TIMEOUT_MS')
+        self.attempts = settings.getint('RETRIES')
+        self.backoff = settings.getfloat('RETRY_BACKOFF')
+
+        params = connection_params(config, section)
+        self._pool = retry(lambda: ThreadedConnectionPool(min_connections, max_connections, **params),
+                           self.attempts, self.backoff)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        # the prepared connections themselves, not their ids: the id of a closed
+        # connection can be given to a new one
+        self._prepared = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def _prepare(self, conn):
+        """
+        Set up the session of a connection the first time it is handed out
+        """
+
+        with self._lock:
+            if conn in self._prepared:
+                return
+            self._prepared.add(conn)
+
+        cur = conn.cursor()
+        cur.execute('SET statement_timeout TO %s;', (self.statement_timeout,))
+        if self.query_group:
+            set_session_query_group(cur, conn, self.query_group)
+        conn.commit()
+
+    def getconn(self):
+        """
+        Borrow a connection, waiting for one to be returned if they are all in use
+
+        Returns
+        conn -- connection object to database
+        """
+
+        self._slots.acquire()
+        try:
+            conn = retry(self._pool.getconn, self.attempts, self.backoff)
+            self._prepare(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+        return conn
+
+    def putconn(self, conn):
+        """
+        Give a connection back to the pool, a broken connection is closed
+
+        Params:
+        conn -- connection object to database
+        """
+
+        broken = bool(conn.closed)
+        if not broken:
+            conn.autocommit = False
+        self._pool.putconn(conn, close=broken)
+        self._slots.release()
+
+    def closeall(self):
+        """
+        Close all the connections of the pool
+        """
+
+        self._pool.closeall()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block
+        """
+
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Yield a cursor whose statements are committed together when the with block
+        ends, or rolled back if it raises
+        """
+
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            except Exception:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+
+    def run(self, func):
+        """
+        Run func(cur) in a unit of work, the whole unit is retried on a transient error
+
+        Params:
+        func -- callable taking a cursor
+
+        Returns
+        result -- what func returns
+        """
+
+        def attempt():
+            with self.unit_of_work() as cur:
+                return func(cur)
+
+        return retry(attempt, self.attempts, self.backoff)
@@ -1,8 +1,10 @@
 import boto3
 import json
-import time
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+from provisioning import wait_for_cluster, prepare_security_group, find_subnet_group, wlm_configuration, \
+                         prepare_parameter_group
 
 
 # AWS config parameters
@@ -21,6 +23,17 @@ DWH_PORT = None
 
 DWH_IAM_ROLE_NAME = None
 
+DWH_VPC_ID = None
+DWH_CLUSTER_SUBNET_GROUP = None
+
+PROVISIONING_TIMEOUT = None
+PROVISIONING_INITIAL_DELAY = None
+PROVISIONING_MAX_DELAY = None
+
+WLM_PARAMETER_GROUP = None
+WLM_QUEUES = None
+WLM_MAX_SCALING_CLUSTERS = None
+
 
 def config_parser():
     """
@@ -30,6 +43,9 @@ def config_parser():
     global KEY, SECRET, DWH_CLUSTER_TYPE, DWH_NUM_NODES
     global DWH_NODE_TYPE, DWH_CLUSTER_IDENTIFIER, DWH_DB
     global DWH_DB_USER, DWH_DB_PASSWORD, DWH_PORT, DWH_IAM_ROLE_NAME
+    global DWH_VPC_ID, DWH_CLUSTER_SUBNET_GROUP
+    global PROVISIONING_TIMEOUT, PROVISIONING_INITIAL_DELAY, PROVISIONING_MAX_DELAY
+    global WLM_PARAMETER_GROUP, WLM_QUEUES, WLM_MAX_SCALING_CLUSTERS
 
     print("Parsing the configuration file...\n")
 
@@ -42,6 +58,7 @@ def config_parser():
 
         DWH_CLUSTER_TYPE = config.get("DWH", "DWH_CLUSTER_TYPE")
         DWH_NODE_TYPE = config.get("DWH", "DWH_NODE_TYPE")
+        DWH_NUM_NODES = config.getint("DWH", "DWH_NUM_NODES")
 
         DWH_IAM_ROLE_NAME = config.get("DWH", "DWH_IAM_ROLE_NAME")
         DWH_CLUSTER_IDENTIFIER = config.get("DWH", "DWH_CLUSTER_IDENTIFIER")
@@ -51,6 +68,17 @@ def config_parser():
         DWH_DB_PASSWORD = config.get("CLUSTER", "DB_PASSWORD")
         DWH_PORT = config.get("CLUSTER", "DB_PORT")
 
+        DWH_VPC_ID = config.get("DWH", "DWH_VPC_ID")
+        DWH_CLUSTER_SUBNET_GROUP = config.get("DWH", "DWH_CLUSTER_SUBNET_GROUP")
+
+        PROVISIONING_TIMEOUT = config.getint("PROVISIONING", "TIMEOUT")
+        PROVISIONING_INITIAL_DELAY = config.getint("PROVISIONING", "INITIAL_DELAY")
+        PROVISIONING_MAX_DELAY = config.getint("PROVISIONING", "MAX_DELAY")
+
+        WLM_PARAMETER_GROUP = config.get("WLM", "PARAMETER_GROUP")
+        WLM_QUEUES = wlm_configuration(config["WLM"])
+        WLM_MAX_SCALING_CLUSTERS = config.getint("WLM", "MAX_CONCURRENCY_SCALING_CLUSTERS")
+
 def aws_client(service, region):
     """
     Creates an AWS client (specified by the argument) in region (specified by argument)
@@ -71,25 +99,6 @@ def aws_client(service, region):
     return client
 
 
-def aws_resource(service, region):
-    """
-    Creates an AWS resource (specified by the argument) in region (specified by argument)
-    
-    Params:
-    service -- The resource to be created
-    param region -- The region where resource has to be created
-    
-    Returns
-    resource -- The resource for AWS service
-    """
-
-    resource = boto3.resource(service,
-                              region_name=region,
-                              aws_access_key_id=KEY,
-                              aws_secret_access_key=SECRET)
-
-    return resource
-
 # create an IAM Role that makes Redshift able to access S3 bucket (ReadOnly)
 
 def create_iam_role(iam):
@@ -130,18 +139,32 @@ def create_iam_role(iam):
     return roleArn
 
 # create redshift cluster 
-def create_redshift_cluster(redshift, roleArn):
+def create_redshift_cluster(redshift, roleArn, securityGroupIds=None, subnetGroup=None, parameterGroup=None):
     """
     Initiate the AWS Redshift cluster creation process
     
     Params:
     redshift -- Boto3 client for the Redshift
     roleArn -- The ARN string for IAM role
+    securityGroupIds -- The VPC security groups of the cluster, the default one if None
+    subnetGroup -- The cluster subnet group, the default one if None
+    parameterGroup -- The cluster parameter group holding the WLM queues, the default one if None
     
     Returns 
     boolean -- True if the cluster was created successfully, False otherwise.
     """
 
+    options = {}
+    # NumberOfNodes is only accepted for multi-node clusters
+    if DWH_CLUSTER_TYPE == 'multi-node':
+        options['NumberOfNodes'] = DWH_NUM_NODES
+    if securityGroupIds:
+        options['VpcSecurityGroupIds'] = securityGroupIds
+    if subnetGroup:
+        options['ClusterSubnetGroupName'] = subnetGroup
+    if parameterGroup:
+        options['ClusterParameterGroupName'] = parameterGroup
+
     print('2. Creating Redshift cluster...')
     try:
         response = redshift.create_cluster(
@@ -155,7 +178,10 @@ def create_redshift_cluster(redshift, roleArn):
             MasterUserPassword=DWH_DB_PASSWORD,
             
             #Roles (for s3 access)
-            IamRoles=[roleArn]  
+            IamRoles=[roleArn],
+
+            #Size and network
+            **options
         )
         
         cluster_status = response['ResponseMetadata']['HTTPStatusCode']
@@ -207,69 +233,33 @@ def redshift_cluster_status(redshift):
     return cluster_status
     
     
-# open an incoming TCP port to access the cluster ednpoint
-def aws_open_redshift_port(ec2, redshift):
-    """
-    Opens an incoming TCP port to access Redshift cluster endpoint on VPC security group
-    
-    Params:
-    ec2 -- Boto3 client for EC2 instance
-    Redshift -- Boto3 client for Redshift
-    """
-    print('3. Openning an incoming TCP port to access the cluster ednpoint...')
-    clusterProps = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-    
-    vpc = ec2.Vpc(id=clusterProps['VpcId'])
-    defaultSg = list(vpc.security_groups.all())[0]
-
-
-    try:
-        vpc = ec2.Vpc(id=clusterProps['VpcId'])
-        defaultSg = list(vpc.security_groups.all())[0]
-        
-        defaultSg.authorize_ingress(
-            GroupName= defaultSg.group_name,
-            CidrIp='0.0.0.0/0',
-            IpProtocol='TCP',
-            FromPort=int(DWH_PORT),
-            ToPort=int(DWH_PORT)
-        )
-    except Exception as e:
-        print(e)
-        
-        
 if __name__ == '__main__':
     
     config_parser()
     
     region = 'us-west-2'
 
-    ec2 = aws_resource('ec2', region)
-    s3 = aws_resource('s3', region)
+    ec2 = aws_client('ec2', region)
     iam = aws_client('iam', region)
     redshift = aws_client('redshift', region)
 
-    roleArn = create_iam_role(iam)
-
-    clusterCreationStarted = create_redshift_cluster(redshift, roleArn)
+    # the IAM role, the security group, the subnet group and the parameter group don't depend on each other
+    print('1. Preparing the IAM role, security group, subnet group and parameter group...')
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        roleArn = executor.submit(create_iam_role, iam)
+        securityGroupId = executor.submit(prepare_security_group, ec2, int(DWH_PORT), DWH_VPC_ID)
+        subnetGroup = executor.submit(find_subnet_group, redshift, DWH_CLUSTER_SUBNET_GROUP)
+        parameterGroup = executor.submit(prepare_parameter_group, redshift, WLM_PARAMETER_GROUP, WLM_QUEUES,
+                                         WLM_MAX_SCALING_CLUSTERS)
+
+    clusterCreationStarted = create_redshift_cluster(redshift, roleArn.result(),
+                                                     [securityGroupId.result()], subnetGroup.result(),
+                                                     parameterGroup.result())
     
     if clusterCreationStarted:
-        print('The cluster is being created...')
-        print('Checking if the cluster is created')
-        time.sleep(5)
-        cluster_status = redshift_cluster_status(redshift)
-        print(f'Cluster status: {cluster_status}')
-        print('Cluster is still being created. Please wait this process may take a few minutes.')
-
-        
-        while True:
-            cluster_status = redshift_cluster_status(redshift)
-            if cluster_status == 'available':
-                print(f'Cluster status: {cluster_status}')
-                time.sleep(2)
-                config_update_cluster(redshift)
-                aws_open_redshift_port(ec2, redshift)
-                break
-          
-            time.sleep(10)
-        print('Cluster was created successfully.\n')
\ No newline at end of file
+        print('The cluster is being created. Please wait this process may take a few minutes.')
+        elapsed = wait_for_cluster(redshift, 'cluster_available', DWH_CLUSTER_IDENTIFIER,
+                                   PROVISIONING_TIMEOUT, PROVISIONING_INITIAL_DELAY, PROVISIONING_MAX_DELAY)
+        print(f'Cluster status: {redshift_cluster_status(redshift)} after {elapsed:.0f}s')
+        config_update_cluster(redshift)
+        print('Cluster was created successfully.\n')
@@ -1,7 +1,11 @@
 import sys
 import configparser
 import psycopg2
-from sql_queries import create_table_queries, create_tables_order, drop_table_queries, drop_tables_order
+from sql_queries import create_tables_order, drop_table_queries, drop_tables_order, \
+                        create_view_queries, drop_view_queries, views_order
+from connection import ClusterPool
+from table_design import load_layouts, load_column_design, apply_column_design, render_create_tables, \
+                         default_create_table_queries
 
 def drop_tables(cur, conn):
     """
@@ -24,16 +28,60 @@ def drop_tables(cur, conn):
             conn.close()
 
 
-def create_tables(cur, conn):
+def drop_views(cur, conn):
     """
-    Create all the tables in the Redshift cluster
+    Drop the materialized views, they depend on the tables
     
     Params:
     cur -- cursor object to database connection
     conn -- connection object to database
     """
+
+    for i, (view, query) in enumerate(zip(views_order, drop_view_queries), 1):
+        try:
+            print(f'{i}. Deleting {view} view...')
+            cur.execute(query)
+            conn.commit()
+            print('Done.')
+        except psycopg2.Error as e:
+            print(e)
+            conn.close()
+
+
+def create_views(cur, conn):
+    """
+    Create the materialized views the dashboard reads its aggregates from
     
-    for i, (table, query) in enumerate(zip(create_tables_order, create_table_queries), 1):
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    """
+
+    for i, (view, query) in enumerate(zip(views_order, create_view_queries), 1):
+        try:
+            print(f'{i}. Creating {view} view...')
+            cur.execute(query)
+            conn.commit()
+            print('Done.')
+        except psycopg2.Error as e:
+            print(e)
+            conn.close()
+
+
+def create_tables(cur, conn, queries=None):
+    """
+    Create all the tables in the Redshift cluster
+    
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    queries -- CREATE TABLE statements in create_tables_order, defaults to the default layout
+    """
+
+    if queries is None:
+        queries = default_create_table_queries()
+
+    for i, (table, query) in enumerate(zip(create_tables_order, queries), 1):
         try:
             print(f'{i}. Creating {table} table...')
             cur.execute(query)
@@ -52,17 +100,27 @@ if __name__ == "__main__":
     # connect to the Redshift cluster
     try:
         print('Connecting to the Redshift cluster...')
-        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        pool = ClusterPool(config)
+        conn = pool.getconn()
         cur = conn.cursor()
     except Exception as e:
         print(e)
 
     # reset the tables
-    print('\nFirst, drop all the tables if exists')
+    print('\nFirst, drop all the views and tables if exists')
+    drop_views(cur, conn)
     drop_tables(cur, conn)
-    print('\nThen, create the tables')
-    create_tables(cur, conn)
+    # render the DDL with the physical design of the configured layout
+    layout = config.get('DESIGN', 'LAYOUT')
+    layouts = load_layouts(config.get('DESIGN', 'LAYOUTS_FILE'))
+    # encodings and VARCHAR widths derived from a previous load, if any
+    column_design = load_column_design(config.get('DESIGN', 'COLUMN_DESIGN_FILE'))
+    print(f'\nThen, create the tables with the {layout} layout')
+    create_tables(cur, conn, render_create_tables(apply_column_design(layouts[layout], column_design)))
+    print('\nFinally, create the materialized views of the dashboard')
+    create_views(cur, conn)
 
     print('\nAll tables were created successfully.\n\nClosing the connection...')
     # close the connection
-    conn.close()
\ No newline at end of file
+    pool.putconn(conn)
+    pool.closeall()
@@ -1,6 +1,7 @@
 import boto3
 import configparser
-import time
+from botocore.exceptions import ClientError
+from provisioning import wait_for_cluster
 
 # AWS config parameters
 KEY = None
@@ -8,6 +9,10 @@ SECRET = None
 
 DWH_CLUSTER_IDENTIFIER = None
 
+PROVISIONING_TIMEOUT = None
+PROVISIONING_INITIAL_DELAY = None
+PROVISIONING_MAX_DELAY = None
+
 
 def config_parser():
     """
@@ -15,6 +20,7 @@ def config_parser():
     """
 
     global KEY, SECRET, DWH_CLUSTER_IDENTIFIER
+    global PROVISIONING_TIMEOUT, PROVISIONING_INITIAL_DELAY, PROVISIONING_MAX_DELAY
 
     print("Parsing the configuration file...\n")
 
@@ -27,6 +33,10 @@ def config_parser():
 
         DWH_CLUSTER_IDENTIFIER = config.get("DWH", "DWH_CLUSTER_IDENTIFIER")
 
+        PROVISIONING_TIMEOUT = config.getint("PROVISIONING", "TIMEOUT")
+        PROVISIONING_INITIAL_DELAY = config.getint("PROVISIONING", "INITIAL_DELAY")
+        PROVISIONING_MAX_DELAY = config.getint("PROVISIONING", "MAX_DELAY")
+
 
 def aws_client(service, region):
     """
@@ -83,28 +93,19 @@ if __name__ == '__main__':
     region = 'us-west-2'
     redshift = aws_client('redshift', region)
     
-    cluster_status = redshift_cluster_status(redshift)
-
-    if cluster_status == 'available':
-        print(f'Cluster status: {cluster_status}')
+    try:
+        cluster_status = redshift_cluster_status(redshift)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ClusterNotFound':
+            raise
+        print('The cluster does not exist.')
+        raise SystemExit(0)
+
+    print(f'Cluster status: {cluster_status}')
+    if cluster_status != 'deleting':
         destroy_redshift_cluster(redshift)
-        
-        while cluster_status == 'available':
-            cluster_status = redshift_cluster_status(redshift)
-        
-        print('The cluster is being deleted...')
-        time.sleep(5)
-        print('Cluster status: ', cluster_status)
-        time.sleep(2)
-        print("Cluster is still being deleted. Please wait until that's done.")
-        
-    while True:
-        try:
-            cluster_status = redshift_cluster_status(redshift)
-            time.sleep(10)
-        except Exception:
-            print("The cluster is not available now.")
-            break
-        
-    
-  
\ No newline at end of file
+
+    print("The cluster is being deleted. Please wait until that's done.")
+    elapsed = wait_for_cluster(redshift, 'cluster_deleted', DWH_CLUSTER_IDENTIFIER,
+                               PROVISIONING_TIMEOUT, PROVISIONING_INITIAL_DELAY, PROVISIONING_MAX_DELAY)
+    print(f'The cluster was deleted after {elapsed:.0f}s.')
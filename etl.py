@@ -1,53 +1,343 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, staging_tables_order, insert_table_queries, dwh_tables_order
+import os
+import boto3
+from calendar_dimension import extend_calendar_to_events
+from capacity import redshift_client, scale_up, scale_down
+from checkpoint import start_run, record_step, run_step, finish_run
+from connection import ClusterPool
+from fanout import load_staging_table_fanout
+from compression import derive_column_design, write_column_design
+from instrumentation import query_group, query_group_label, collect_metrics
+from incremental import get_watermark, reset_watermark, update_watermark, new_log_partitions, \
+                        load_staging_events_incremental, log_month_partitions
+from maintenance import run_maintenance
+from quality import load_checks, run_checks
+from manifest import load_staging_tables_manifest
+from scheduler import run_dag
+from spectrum import prepare_external_tables, external_sources
+from table_design import load_layouts
+from views import refresh_views
+from sql_queries import copy_table_queries, staging_tables_order, insert_steps_queries, insert_steps_order, \
+                        dwh_tables_order, insert_table_dependencies, truncate_staging_queries, \
+                        render_insert_steps, select_max_ts, select_ts_bounds, staging_tables_names
 
 
-def load_staging_tables(cur, conn):
+def truncate_staging_tables(cur, conn, tables=staging_tables_order):
+    """
+    Empty the staging tables so they only hold the data of this run.
+    """
+
+    for table, query in zip(staging_tables_order, truncate_staging_queries):
+        if table in tables:
+            cur.execute(query)
+    conn.commit()
+
+
+def load_staging_tables(cur, conn, tables=staging_tables_order):
     """
     Load data from files stored in S3 to the staging tables.
     """
-    
+
     print("Loading data from JSON files stored in S3 buckets into staging tables...")
-    
+
     for i, (table, query) in enumerate(zip(staging_tables_order, copy_table_queries), 1):
+        if table not in tables:
+            continue
         print(f'{i}. Loading data into {table} table...')
         cur.execute(query)
         conn.commit()
         print('Done.')
-    
+
     print("\nAll loaded into staging tables successfully.\n")
 
 
-def insert_tables(cur, conn):
+def insert_tables(pool, max_concurrency, skip=(), on_status=None, query_groups=None, queries=insert_steps_queries):
     """
     Insert data from staging tables into the tables.
+
+    The independent inserts run at the same time on a pool of connections,
+    songplays waits for the dimension tables it references and the song lookup.
+
+    Params:
+    pool -- connection.ClusterPool the inserts borrow their connections from
+    max_concurrency -- maximum number of inserts running at the same time
+    skip -- tables that are not inserted into, e.g. already done in this run
+    on_status -- optional callable(table, status, seconds), see scheduler.run_dag
+    query_groups -- optional callable(table) returning the query group of its insert
+    queries -- the insert queries in insert_steps_order, e.g. reading from external tables
+
+    Returns
+    timings -- dict mapping every inserted table to its insert wall time in seconds
     """
-    
+
     print("Inserting data from staging tables into our data warehouse...")
-    
-    for i, (table, query) in enumerate(zip(dwh_tables_order, insert_table_queries), 1):
-        print(f'{i}. Inserting data into {table} table...')
-        cur.execute(query)
-        conn.commit()
-        print('Done.')
+
+    timings = run_dag(insert_steps_order, queries, insert_table_dependencies, pool, max_concurrency,
+                      skip, on_status, query_groups)
+
+    for table, seconds in timings.items():
+        print(f'{table}: {seconds:.2f}s')
 
     print("\nAll data inserted into data warehouse successfully.\n")
-    
+
+    return timings
+
+
+def instrumented_step(cur, conn, run_id, done, step, partition, table, action, metrics_log):
+    """
+    Run a checkpointed step under its query group, then collect the metrics of
+    its queries unless metrics_log is None.
+    """
+
+    skipped = (step, partition) in done
+
+    def tagged():
+        with query_group(cur, conn, query_group_label(run_id, step, partition)):
+            action()
+
+    run_step(cur, conn, run_id, done, step, partition, table, tagged)
+    if metrics_log is not None and not skipped:
+        collect_metrics(cur, conn, run_id, step, partition, metrics_log)
+
+
+def checkpointed_inserts(cur, conn, run_id, done, partition, pool, max_concurrency, tables, metrics_log=None,
+                         queries=insert_steps_queries):
+    """
+    Insert into the given tables, skipping the ones this run already finished
+    for the partition and recording the status, wall time and query metrics of every insert.
+    """
+
+    skip = [table for table in insert_steps_order if table not in tables or (table, partition) in done]
+
+    def on_status(table, status, seconds):
+        record_step(cur, conn, run_id, table, partition, status, table, seconds)
+        if status == 'done':
+            done.add((table, partition))
+            if metrics_log is not None:
+                collect_metrics(cur, conn, run_id, table, partition, metrics_log)
+
+    insert_tables(pool, max_concurrency, skip, on_status,
+                  lambda table: query_group_label(run_id, table, partition), queries)
+
+
+def check_step(cur, conn, run_id, checks, tables, partition=''):
+    """
+    Run the data quality checks of the tables under their own query group, a failed
+    check raises quality.DataQualityError and stops the run. None turns them off.
+    """
+
+    if checks is None:
+        return
+
+    with query_group(cur, conn, query_group_label(run_id, 'quality', partition)):
+        run_checks(cur, run_id, checks, tables)
+
+
+def refresh_step(cur, conn, run_id, done, config, metrics_log=None):
+    """
+    Refresh the materialized views of the dashboard once the inserts are done.
+    """
+
+    if config.getboolean('VIEWS', 'ENABLED'):
+        instrumented_step(cur, conn, run_id, done, 'refresh views', '', None, lambda: refresh_views(conn),
+                          metrics_log)
+
+
+def run_full(cur, conn, s3, config, run_id, done, watermark, pool, max_concurrency, metrics_log=None,
+             checks=None):
+    """
+    Load the staging tables with everything new since the watermark, then
+    insert into all the tables.
+    """
+
+    fanout = config['FANOUT'] if config.getboolean('FANOUT', 'ENABLED') else None
+
+    def load_events():
+        truncate_staging_tables(cur, conn, ['staging events'])
+        if fanout is not None:
+            load_staging_table_fanout(pool, s3, 'staging_events', config.get('S3', 'LOG_DATA'), fanout,
+                                      start_date=watermark[1] if watermark else None,
+                                      query_group=query_group_label(run_id, 'staging events'))
+        elif config.getboolean('MANIFEST', 'ENABLED'):
+            load_staging_tables_manifest(cur, conn, s3, config['MANIFEST'],
+                                         config.get('S3', 'LOG_DATA'), config.get('S3', 'SONG_DATA'),
+                                         start_date=watermark[1] if watermark else None,
+                                         tables=['staging events'])
+        elif watermark is None:
+            load_staging_tables(cur, conn, ['staging events'])
+        else:
+            load_staging_events_incremental(cur, conn, new_log_partitions(s3, watermark[1]))
+
+    def load_songs():
+        truncate_staging_tables(cur, conn, ['staging songs'])
+        if fanout is not None:
+            load_staging_table_fanout(pool, s3, 'staging_songs', config.get('S3', 'SONG_DATA'), fanout,
+                                      query_group=query_group_label(run_id, 'staging songs'))
+        elif config.getboolean('MANIFEST', 'ENABLED'):
+            load_staging_tables_manifest(cur, conn, s3, config['MANIFEST'],
+                                         config.get('S3', 'LOG_DATA'), config.get('S3', 'SONG_DATA'),
+                                         tables=['staging songs'])
+        else:
+            load_staging_tables(cur, conn, ['staging songs'])
+
+    instrumented_step(cur, conn, run_id, done, 'staging events', '', 'staging_events', load_events, metrics_log)
+    instrumented_step(cur, conn, run_id, done, 'staging songs', '', 'staging_songs', load_songs, metrics_log)
+    check_step(cur, conn, run_id, checks, staging_tables_names)
+    instrumented_step(cur, conn, run_id, done, 'time', '', 'time', lambda: extend_calendar_to_events(cur, conn),
+                      metrics_log)
+
+    checkpointed_inserts(cur, conn, run_id, done, '', pool, max_concurrency, insert_steps_order, metrics_log)
+    update_watermark(cur, conn)
+    check_step(cur, conn, run_id, checks, dwh_tables_order)
+
+
+def run_spectrum(cur, conn, s3, config, run_id, done, watermark, pool, max_concurrency, metrics_log=None,
+                 checks=None):
+    """
+    Read the new months of events and the songs in place through Spectrum
+    external tables instead of copying them into the staging tables, then
+    insert into all the tables.
+    """
+
+    write_parquet = config.getboolean('SPECTRUM', 'WRITE_PARQUET')
+    months = log_month_partitions(s3, watermark[1] if watermark else None)
+
+    instrumented_step(cur, conn, run_id, done, 'external tables', '', None,
+                      lambda: prepare_external_tables(conn, months, write_parquet), metrics_log)
+
+    events_source, songs_source = external_sources(months[0][0] if months else None, write_parquet)
+    instrumented_step(cur, conn, run_id, done, 'time', '', 'time',
+                      lambda: extend_calendar_to_events(cur, conn, select_ts_bounds.format(events_source + ' e')),
+                      metrics_log)
+    checkpointed_inserts(cur, conn, run_id, done, '', pool, max_concurrency, insert_steps_order, metrics_log,
+                         render_insert_steps(events_source, songs_source))
+    update_watermark(cur, conn, select_max_ts.format(events_source + ' e'))
+    check_step(cur, conn, run_id, checks, dwh_tables_order)
+
+
+def run_by_partition(cur, conn, s3, run_id, done, watermark, pool, max_concurrency, metrics_log=None,
+                     checks=None):
+    """
+    Load the song metadata and its dimensions once, then the event logs one month
+    at a time, so a failure only costs the partition it happened in.
+    """
+
+    def load_songs():
+        truncate_staging_tables(cur, conn, ['staging songs'])
+        load_staging_tables(cur, conn, ['staging songs'])
+
+    instrumented_step(cur, conn, run_id, done, 'staging songs', '', 'staging_songs', load_songs, metrics_log)
+    check_step(cur, conn, run_id, checks, ['staging_songs'])
+    checkpointed_inserts(cur, conn, run_id, done, '', pool, max_concurrency, ['song_lookup', 'artists', 'songs'],
+                         metrics_log)
+
+    for month, path in log_month_partitions(s3, watermark[1] if watermark else None):
+        print(f'Processing partition {month}...\n')
+
+        def load_events():
+            truncate_staging_tables(cur, conn, ['staging events'])
+            load_staging_events_incremental(cur, conn, [(month, path)])
+
+        instrumented_step(cur, conn, run_id, done, 'staging events', month, 'staging_events', load_events,
+                          metrics_log)
+        check_step(cur, conn, run_id, checks, ['staging_events'], month)
+        instrumented_step(cur, conn, run_id, done, 'time', month, 'time', lambda: extend_calendar_to_events(cur, conn),
+                          metrics_log)
+        checkpointed_inserts(cur, conn, run_id, done, month, pool, max_concurrency,
+                             ['staging_next_songs', 'users', 'songplays', 'parked_plays'], metrics_log)
+        # the watermark keeps the next partition from inserting these events again. It is a
+        # step of the month too: on resume staging_events may already hold the next month
+        instrumented_step(cur, conn, run_id, done, 'watermark', month, None, lambda: update_watermark(cur, conn),
+                          metrics_log)
+
+    check_step(cur, conn, run_id, checks, dwh_tables_order)
+
 
 if __name__ == "__main__":
     """
-    Extract song metadata and user activity data from S3, transform it using a staging table, 
+    Extract song metadata and user activity data from S3, transform it using a staging table,
     and load it into fact and dimensional tables for analysis
     """
-    
+
+    parser = argparse.ArgumentParser(description='Load the data warehouse from S3.')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='ignore the watermark and reload the full history from S3')
+    parser.add_argument('--analyze-compression', action='store_true',
+                        help='derive the column encodings and widths again after the load')
+    parser.add_argument('--by-partition', action='store_true',
+                        help='load the event logs one monthly partition at a time')
+    parser.add_argument('--new-run', action='store_true',
+                        help='start a new run instead of resuming the last unfinished one')
+    parser.add_argument('--from-spectrum', action='store_true',
+                        help='read the events and songs through Spectrum external tables instead of staging')
+    parser.add_argument('--manage-capacity', action='store_true',
+                        help='grow the cluster before the load, shrink and pause it after')
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    max_concurrency = config.getint('ETL', 'MAX_CONCURRENCY')
+
+    if args.manage_capacity:
+        scale_up(redshift_client(config), config)
+
+    # one connection for the control steps, the others for the concurrent inserts. Every
+    # connection of the pool runs in the ETL queue of WLM, the maintenance and the analysis too
+    pool = ClusterPool(config)
+    conn = pool.getconn()
     cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
 
-    conn.close()
\ No newline at end of file
+    run_id, done = start_run(cur, args.new_run)
+
+    # a resumed run keeps the watermark it started with
+    if args.full_refresh and not done:
+        print('Full refresh requested, resetting the watermark and the plays.\n')
+        reset_watermark(cur, conn)
+
+    watermark = get_watermark(cur)
+
+    s3 = boto3.client('s3',
+                      aws_access_key_id=config.get('AWS', 'KEY'),
+                      aws_secret_access_key=config.get('AWS', 'SECRET'),
+                      region_name='us-west-2')
+
+    # the queries of every step are read back from the system tables, None turns it off
+    metrics_log = config.get('METRICS', 'LOG_FILE') if config.getboolean('METRICS', 'ENABLED') else None
+    # the checks run after the loads and the inserts, a failed one stops the run before the views
+    checks = load_checks(config.get('QUALITY', 'CHECKS_FILE')) if config.getboolean('QUALITY', 'ENABLED') else None
+
+    if args.from_spectrum or config.getboolean('SPECTRUM', 'ENABLED'):
+        run_spectrum(cur, conn, s3, config, run_id, done, watermark, pool, max_concurrency, metrics_log, checks)
+    elif args.by_partition:
+        run_by_partition(cur, conn, s3, run_id, done, watermark, pool, max_concurrency, metrics_log, checks)
+    else:
+        run_full(cur, conn, s3, config, run_id, done, watermark, pool, max_concurrency, metrics_log, checks)
+
+    refresh_step(cur, conn, run_id, done, config, metrics_log)
+
+    if config.getboolean('MAINTENANCE', 'ENABLED'):
+        run_maintenance(conn, dwh_tables_order, {
+            'unsorted': config.getfloat('MAINTENANCE', 'UNSORTED_THRESHOLD'),
+            'stats_off': config.getfloat('MAINTENANCE', 'STATS_OFF_THRESHOLD'),
+            'deleted': config.getfloat('MAINTENANCE', 'DELETED_THRESHOLD'),
+        })
+
+    # derive the column design once, after the first load, for the next rebuild
+    column_design_file = config.get('DESIGN', 'COLUMN_DESIGN_FILE')
+    if args.analyze_compression or not os.path.exists(column_design_file):
+        layout = load_layouts(config.get('DESIGN', 'LAYOUTS_FILE'))[config.get('DESIGN', 'LAYOUT')]
+        column_design = derive_column_design(conn, layout,
+                                             config.getint('DESIGN', 'BYTEDICT_LIMIT'),
+                                             config.getfloat('DESIGN', 'VARCHAR_HEADROOM'))
+        write_column_design(column_design_file, column_design)
+
+    finish_run(cur, conn, run_id)
+
+    pool.putconn(conn)
+    pool.closeall()
+
+    # only after a successful run, a failed one is resumed on the large cluster
+    if args.manage_capacity:
+        scale_down(redshift_client(config), config)
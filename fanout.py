@@ -0,0 +1,181 @@
+from manifest import split_s3_path, list_objects, filter_objects, balance_objects, build_manifest, write_manifest
+from scheduler import run_dag
+from sql_queries import render, set_query_group, select_slice_count, create_partition_table, \
+                        append_partition_table, drop_partition_table
+
+# the COPY option of the compressed inputs, by key suffix
+COMPRESSIONS = {'.gz': 'GZIP', '.zst': 'ZSTD'}
+
+
+def compression_of(key):
+    """
+    The COPY compression option of an object, from its key suffix
+
+    Params:
+    key -- the object key
+
+    Returns
+    compression -- GZIP, ZSTD or '' for an uncompressed object
+    """
+
+    for suffix, compression in COMPRESSIONS.items():
+        if key.endswith(suffix):
+            return compression
+    return ''
+
+
+def slice_count(cur):
+    """
+    The number of slices of the cluster, read from STV_SLICES
+
+    Params:
+    cur -- cursor object to database connection
+
+    Returns
+    slices -- the number of slices
+    """
+
+    cur.execute(select_slice_count)
+    return cur.fetchone()[0]
+
+
+def partition_objects(objects, num_slices, max_partitions):
+    """
+    Split the objects in key order, so a partition covers consecutive dates, into
+    at most max_partitions partitions of about the same size. The cuts fall on
+    multiples of num_slices files, so each COPY gives every slice the same number
+    of files, only the last partition takes the remainder
+
+    Params:
+    objects -- list of (key, size, last_modified) tuples
+    num_slices -- number of slices of the cluster
+    max_partitions -- the most partitions to make
+
+    Returns
+    partitions -- list of lists of objects
+    """
+
+    objects = sorted(objects)
+    chunks = [objects[i:i + num_slices] for i in range(0, len(objects), num_slices)]
+    if not chunks:
+        return []
+
+    num_partitions = min(max_partitions, len(chunks))
+    target = sum(obj[1] for obj in objects) / num_partitions
+
+    partitions = [[]]
+    loaded = 0
+    for chunk in chunks:
+        # a partition is closed once the partitions so far hold their share of the bytes
+        if partitions[-1] and loaded >= target * len(partitions) and len(partitions) < num_partitions:
+            partitions.append([])
+        partitions[-1].extend(chunk)
+        loaded += sum(obj[1] for obj in chunk)
+
+    return partitions
+
+
+def plan_partitions(objects, num_slices, max_partitions):
+    """
+    Group the objects by compression, a COPY takes one compression option, then
+    partition every group
+
+    Params:
+    objects -- list of (key, size, last_modified) tuples
+    num_slices -- number of slices of the cluster
+    max_partitions -- the most partitions to make per compression
+
+    Returns
+    plan -- list of (compression, objects) tuples, one per partition
+    """
+
+    groups = {}
+    for obj in objects:
+        groups.setdefault(compression_of(obj[0]), []).append(obj)
+
+    return [(compression, partition)
+            for compression, group in sorted(groups.items())
+            for partition in partition_objects(group, num_slices, max_partitions)]
+
+
+def load_staging_table_fanout(pool, s3, table, source_path, fanout_config, start_date=None, query_group=None):
+    """
+    Load a staging table with one COPY per partition of its input, the COPYs run
+    concurrently. In append mode every partition is loaded into its own table and
+    appended to the staging table with ALTER TABLE APPEND, in direct mode all the
+    COPYs load the staging table itself
+
+    Params:
+    pool -- connection.ClusterPool the COPYs borrow their connections from
+    s3 -- Boto3 client for S3
+    table -- staging_events or staging_songs
+    source_path -- S3 path of the input files
+    fanout_config -- the FANOUT section of dwh.cfg
+    start_date -- first date of the input to load (YYYY-MM-DD), None for all
+    query_group -- optional query group the statements run under
+
+    Returns
+    stats -- dict with the number of slices, partitions, objects and bytes
+    """
+
+    path = fanout_config.get('PATH').rstrip('/')
+    append = fanout_config.get('MODE') == 'append'
+
+    num_slices = pool.run(slice_count)
+    objects = filter_objects(list_objects(s3, source_path, fanout_config.getint('LISTING_WORKERS')),
+                             fanout_config.get('KEY_PATTERN'), start_date)
+    plan = plan_partitions(objects, num_slices, fanout_config.getint('MAX_PARTITIONS'))
+    stats = {'slices': num_slices, 'partitions': len(plan), 'objects': len(objects),
+             'bytes': sum(obj[1] for obj in objects)}
+
+    print(f"{table}: {stats['objects']} objects, {stats['bytes']} bytes in {stats['partitions']} partitions "
+          f"for {num_slices} slices.")
+    if not plan:
+        print('Nothing new to load.')
+        return stats
+
+    bucket, _ = split_s3_path(source_path)
+    nodes, queries = [], []
+    for i, (compression, partition) in enumerate(plan):
+        node = f'{table}_part_{i}'
+        manifest_path = f'{path}/{table}/{node}.manifest'
+        write_manifest(s3, manifest_path, build_manifest(bucket, balance_objects(partition, num_slices)))
+        nodes.append(node)
+        queries.append(render(f'copy_{table}_fanout', table=node if append else table, manifest=manifest_path,
+                              compression=compression))
+
+    def drop_partitions(cur):
+        for node in nodes:
+            cur.execute(drop_partition_table.format(node))
+
+    if append:
+        # the tables of a failed load are dropped first, their rows were never appended
+        def create_partitions(cur):
+            drop_partitions(cur)
+            for node in nodes:
+                cur.execute(create_partition_table.format(node, table))
+        pool.run(create_partitions)
+
+    run_dag(nodes, queries, {}, pool, fanout_config.getint('MAX_CONCURRENCY'),
+            query_groups=(lambda node: query_group) if query_group else None)
+
+    if append:
+        # ALTER TABLE APPEND can't run inside a transaction block
+        with pool.connection() as conn:
+            conn.autocommit = True
+            cur = conn.cursor()
+            try:
+                if query_group:
+                    cur.execute(set_query_group, (query_group,))
+                for node in nodes:
+                    print(f'Appending {node} to {table}...')
+                    cur.execute(append_partition_table.format(table, node))
+                drop_partitions(cur)
+                if query_group:
+                    cur.execute(set_query_group, (pool.query_group,))
+            finally:
+                conn.autocommit = False
+
+    print('Done.')
+
+    return stats
@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import random
+import string
+from datetime import datetime, timedelta, timezone
+
+FIRST_NAMES = ['Kaylee', 'Lily', 'Jacob', 'Layla', 'Tegan', 'Chloe', 'Aleena', 'Jayden', 'Mohammad', 'Ava']
+LAST_NAMES = ['Summers', 'Koch', 'Klein', 'Griffin', 'Levine', 'Cuevas', 'Kirby', 'Bell', 'Rodriguez', 'Lee']
+LOCATIONS = ['Phoenix-Mesa-Scottsdale, AZ', 'Chicago-Naperville-Elgin, IL-IN-WI', 'San Jose-Sunnyvale-Santa Clara, CA',
+             'Portland-South Portland, ME', 'Lansing-East Lansing, MI', 'Atlanta-Sandy Springs-Roswell, GA']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko)"',
+               'Mozilla/5.0 (X11; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0']
+WORDS = ['love', 'night', 'fire', 'heart', 'dream', 'blue', 'rain', 'road', 'home', 'light', 'dance', 'gold']
+
+
+def random_id(rng, prefix):
+    """
+    An id shaped like the ones of the million song dataset, e.g. SOUPIRU12A6D4FA1E1
+    """
+
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+
+
+def random_title(rng, words):
+    """
+    A title of a few capitalized words
+    """
+
+    return ' '.join(rng.choice(WORDS).capitalize() for _ in range(words))
+
+
+def generate_songs(num_songs, out_dir, rng):
+    """
+    Write one JSON file per song, shaped like song_data/A/B/C/TRABC....json
+
+    Params:
+    num_songs -- number of songs to generate
+    out_dir -- the directory the song_data folder is written to
+    rng -- random.Random instance
+
+    Returns
+    songs -- list of (title, artist name, duration) tuples the events can play
+    """
+
+    artists = [(random_id(rng, 'AR'), f'{random_title(rng, 2)} {i}', rng.choice(LOCATIONS),
+                rng.uniform(-90, 90), rng.uniform(-180, 180)) for i in range(max(1, num_songs // 3))]
+
+    songs = []
+    for i in range(num_songs):
+        artist_id, artist_name, location, latitude, longitude = rng.choice(artists)
+        track_id = random_id(rng, 'TR')
+        song = {
+            'num_songs': 1,
+            'artist_id': artist_id,
+            'artist_latitude': round(latitude, 5) if rng.random() < 0.5 else None,
+            'artist_longitude': round(longitude, 5) if rng.random() < 0.5 else None,
+            'artist_location': location,
+            'artist_name': artist_name,
+            'song_id': random_id(rng, 'SO'),
+            'title': f'{random_title(rng, rng.randint(1, 4))} {i}',
+            'duration': round(rng.uniform(90, 420), 5),
+            'year': rng.choice([0, rng.randint(1960, 2018)]),
+        }
+
+        path = os.path.join(out_dir, 'song_data', *track_id[2:5], f'{track_id}.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as song_file:
+            json.dump(song, song_file)
+
+        songs.append((song['title'], song['artist_name'], song['duration']))
+
+    return songs
+
+
+def generate_users(num_users, rng):
+    """
+    The listeners, every one with a fixed profile and a free or paid level
+    """
+
+    return [{'userId': user_id,
+             'firstName': rng.choice(FIRST_NAMES),
+             'lastName': rng.choice(LAST_NAMES),
+             'gender': rng.choice('MF'),
+             'level': rng.choice(['free', 'paid']),
+             'location': rng.choice(LOCATIONS),
+             'userAgent': rng.choice(USER_AGENTS),
+             'registration': float(rng.randint(1_530_000_000_000, 1_541_000_000_000))}
+            for user_id in range(1, num_users + 1)]
+
+
+def generate_events(num_events, songs, num_users, days, start_date, match_rate, out_dir, rng):
+    """
+    Write the user activity logs, one newline delimited JSON file per day shaped
+    like log_data/YYYY/MM/YYYY-MM-DD-events.json. The files are written one day
+    at a time so memory stays flat at any scale
+
+    Params:
+    num_events -- total number of events
+    songs -- list of (title, artist name, duration) tuples, as returned by generate_songs
+    num_users -- number of listeners
+    days -- number of daily files the events are spread over
+    start_date -- the date of the first file
+    match_rate -- share of the played songs that exist in song_data
+    out_dir -- the directory the log_data folder is written to
+    rng -- random.Random instance
+    """
+
+    users = generate_users(num_users, rng)
+    sessions = {}
+    per_day = num_events // days
+
+    for day in range(days):
+        date = start_date + timedelta(days=day)
+        path = os.path.join(out_dir, 'log_data', f'{date:%Y}', f'{date:%m}', f'{date:%Y-%m-%d}-events.json')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        day_start = int(date.timestamp() * 1000)
+        count = per_day + (num_events % days if day == days - 1 else 0)
+        timestamps = sorted(rng.randrange(day_start, day_start + 86_400_000) for _ in range(count))
+
+        with open(path, 'w') as log_file:
+            for ts in timestamps:
+                user = rng.choice(users)
+                # some free users upgrade along the way
+                if user['level'] == 'free' and rng.random() < 0.001:
+                    user['level'] = 'paid'
+
+                session = sessions.setdefault(user['userId'], [rng.randint(1, 10_000_000), 0])
+                if rng.random() < 0.05:
+                    session[:] = [rng.randint(1, 10_000_000), 0]
+                session[1] += 1
+
+                event = {**user, 'auth': 'Logged In', 'itemInSession': session[1], 'method': 'PUT',
+                         'sessionId': session[0], 'status': 200, 'ts': ts,
+                         'page': 'NextSong' if rng.random() < 0.8 else rng.choice(['Home', 'Logout', 'Settings'])}
+
+                if event['page'] == 'NextSong':
+                    if rng.random() < match_rate:
+                        title, artist, duration = rng.choice(songs)
+                    else:
+                        title, artist, duration = random_title(rng, 3), random_title(rng, 2), rng.uniform(90, 420)
+                    event.update({'song': title, 'artist': artist, 'length': round(duration, 5)})
+                else:
+                    event.update({'song': None, 'artist': None, 'length': None, 'method': 'GET'})
+
+                log_file.write(json.dumps(event) + '\n')
+
+
+if __name__ == '__main__':
+    """
+    Generate synthetic song metadata and user activity logs with the same JSON
+    shape as the song_data and log_data S3 prefixes
+    """
+
+    parser = argparse.ArgumentParser(description='Generate synthetic song_data and log_data files.')
+    parser.add_argument('--events', type=int, default=10_000, help='number of events, e.g. 10000 to 100000000')
+    parser.add_argument('--songs', type=int, help='number of songs, events / 20 up to 100000 by default')
+    parser.add_argument('--users', type=int, help='number of users, events / 1000 (at least 10) by default')
+    parser.add_argument('--days', type=int, default=30, help='number of daily log files')
+    parser.add_argument('--start-date', default='2018-11-01', help='date of the first log file')
+    parser.add_argument('--match-rate', type=float, default=0.9, help='share of played songs found in song_data')
+    parser.add_argument('--seed', type=int, default=42, help='random seed, the same seed gives the same data')
+    parser.add_argument('--out', default='data', help='output directory')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    num_songs = args.songs or max(1, min(args.events // 20, 100_000))
+    num_users = args.users or max(10, args.events // 1000)
+    start_date = datetime.strptime(args.start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+    print(f'Generating {num_songs} songs...')
+    songs = generate_songs(num_songs, args.out, rng)
+    print(f'Generating {args.events} events for {num_users} users over {args.days} days...')
+    generate_events(args.events, songs, num_users, args.days, start_date, args.match_rate, args.out, rng)
+    print(f'Done, the data is in {args.out}/.')
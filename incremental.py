@@ -0,0 +1,142 @@
+import re
+from datetime import datetime, timezone
+from manifest import expand_prefixes
+from sql_queries import load_settings, render, select_watermark, delete_watermark, insert_watermark, \
+                        select_max_staging_ts, full_refresh_queries
+
+WATERMARK_SOURCE = 'log_data'
+
+# log_data keys look like log_data/2018/11/2018-11-01-events.json
+PARTITION_PATTERN = re.compile(r'(\d{4})/(\d{2})/(\d{4}-\d{2}-\d{2})')
+
+
+def get_watermark(cur):
+    """
+    Read the high-water mark of the event logs from the control table
+
+    Params:
+    cur -- cursor object to database connection
+
+    Returns
+    watermark -- (last_ts, last_partition) tuple, or None if nothing was loaded yet
+    """
+
+    cur.execute(select_watermark, (WATERMARK_SOURCE,))
+    return cur.fetchone()
+
+
+def reset_watermark(cur, conn):
+    """
+    Forget the high-water mark so the next load processes the full history. The
+    songplays inserts only de-duplicate within a load, so the plays of the previous
+    loads are truncated too
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    """
+
+    cur.execute(delete_watermark, (WATERMARK_SOURCE,))
+    for query in full_refresh_queries:
+        cur.execute(query)
+    conn.commit()
+
+
+def update_watermark(cur, conn, query=select_max_staging_ts):
+    """
+    Move the high-water mark to the newest event in the staging table, the date
+    partition is the day of that event. The mark is kept as it is when no new
+    events were loaded
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    query -- the query returning the newest event ts, e.g. over an external table
+    """
+
+    cur.execute(query)
+    last_ts = cur.fetchone()[0]
+    if last_ts is None:
+        print('No new events, the watermark is unchanged.')
+        return
+
+    last_partition = datetime.fromtimestamp(last_ts / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
+    cur.execute(delete_watermark, (WATERMARK_SOURCE,))
+    cur.execute(insert_watermark, (WATERMARK_SOURCE, last_ts, last_partition))
+    conn.commit()
+    print(f'Watermark moved to ts {last_ts}, partition {last_partition}.')
+
+
+def new_log_partitions(s3, last_partition):
+    """
+    List the date partitions of the event logs from last_partition onwards,
+    last_partition itself is listed again as it may have been loaded partially
+
+    Params:
+    s3 -- Boto3 client for S3
+    last_partition -- the newest date partition already loaded (YYYY-MM-DD)
+
+    Returns
+    partitions -- sorted list of (date, S3 path prefix) tuples
+    """
+
+    bucket, prefix = load_settings()['log_bucket'], load_settings()['log_prefix']
+    year, month = last_partition[:4], last_partition[5:7]
+    start_after = f'{prefix}/{year}/{month}/{last_partition}'
+
+    partitions = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, StartAfter=start_after):
+        for obj in page.get('Contents', []):
+            match = PARTITION_PATTERN.search(obj['Key'])
+            if match:
+                year, month, day = match.groups()
+                partitions[day] = f's3://{bucket}/{prefix}/{year}/{month}/{day}'
+
+    return sorted(partitions.items())
+
+
+def load_staging_events_incremental(cur, conn, partitions):
+    """
+    Load only the new date partitions of the event logs into the staging events table
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    partitions -- list of (date, S3 path prefix) tuples to load
+    """
+
+    print("Loading new event logs stored in S3 buckets into the staging events table...")
+
+    for i, (day, path) in enumerate(partitions, 1):
+        print(f'{i}. Loading partition {day} into staging events table...')
+        cur.execute(render('copy_staging_events_partition', path=path))
+        conn.commit()
+        print('Done.')
+
+    print("\nAll new partitions loaded successfully.\n")
+
+
+def log_month_partitions(s3, watermark=None):
+    """
+    List the monthly partitions of the event logs, e.g. log_data/2018/11/
+
+    Params:
+    s3 -- Boto3 client for S3
+    watermark -- the newest date partition already loaded (YYYY-MM-DD), the months
+                 before it are left out
+
+    Returns
+    partitions -- sorted list of (month, S3 path prefix) tuples, month as YYYY/MM
+    """
+
+    bucket, log_prefix = load_settings()['log_bucket'], load_settings()['log_prefix']
+
+    partitions = []
+    for prefix in expand_prefixes(s3, bucket, log_prefix, 2):
+        month = prefix[len(log_prefix):].strip('/')
+        if watermark and month < watermark[:7].replace('-', '/'):
+            continue
+        partitions.append((month, f's3://{bucket}/{prefix}'))
+
+    return sorted(partitions)
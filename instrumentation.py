@@ -0,0 +1,119 @@
+import json
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+from sql_queries import set_query_group, reset_query_group, select_query_metrics, insert_query_metric
+
+# the query group of everything the ETL runs, the WLM etl queue matches it with etl*
+ETL_QUERY_GROUP = 'etl'
+
+# the query group every session runs under between the steps, by connection
+session_query_groups = weakref.WeakKeyDictionary()
+
+# the columns of select_query_metrics, in order
+METRIC_COLUMNS = ['query', 'query_group', 'elapsed_ms', 'queue_ms', 'rows_scanned', 'bytes_scanned',
+                  'rows_inserted', 'broadcast_steps', 'redistribute_steps', 'diskbased_steps', 'files_loaded',
+                  'lines_loaded', 'load_errors', 'aborted', 'query_text']
+
+
+def query_group_label(run_id, step, partition=''):
+    """
+    The query group of a step, e.g. etl/20240101T020000/staging_events/2018/11
+
+    Params:
+    run_id -- the id of the run
+    step -- the step name
+    partition -- the partition the step works on, '' for the whole data
+
+    Returns
+    label -- the query group, unique to the step of the run
+    """
+
+    label = f'{ETL_QUERY_GROUP}/{run_id}/{step}' + (f'/{partition}' if partition else '')
+    return label.replace(' ', '_')
+
+
+def set_session_query_group(cur, conn, label):
+    """
+    Set the query group a session runs under between the steps, e.g. the one
+    of its pool, the query_group blocks go back to it
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    label -- the query group
+    """
+
+    cur.execute(set_query_group, (label,))
+    session_query_groups[conn] = label
+
+
+@contextmanager
+def query_group(cur, conn, label):
+    """
+    Run the statements of a with block under a query group, the session goes
+    back to its own query group when the block ends even if it raises
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    label -- the query group
+    """
+
+    previous = session_query_groups.get(conn)
+    cur.execute(set_query_group, (label,))
+    try:
+        yield
+    finally:
+        # a failed statement leaves the transaction aborted
+        if conn.info.transaction_status == TRANSACTION_STATUS_INERROR:
+            conn.rollback()
+        if previous:
+            cur.execute(set_query_group, (previous,))
+        else:
+            cur.execute(reset_query_group)
+        conn.commit()
+
+
+def collect_metrics(cur, conn, run_id, step, partition, log_path=None):
+    """
+    Read back the metrics of the queries a step ran from STL_QUERY, STL_WLM_QUERY,
+    SVL_QUERY_SUMMARY, STL_LOAD_COMMITS and STL_LOAD_ERRORS, store them in the
+    etl_query_metrics table and append them to a JSON lines log
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    run_id -- the id of the run
+    step -- the step name
+    partition -- the partition the step worked on, '' for the whole data
+    log_path -- the JSON lines file the metrics are appended to, None to skip it
+
+    Returns
+    metrics -- list of dicts, one per query, keyed by METRIC_COLUMNS
+    """
+
+    cur.execute(select_query_metrics, {'query_group': query_group_label(run_id, step, partition)})
+    metrics = [dict(zip(METRIC_COLUMNS, row)) for row in cur.fetchall()]
+
+    for metric in metrics:
+        cur.execute(insert_query_metric, [run_id, step, partition] + [metric[column] for column in METRIC_COLUMNS])
+    conn.commit()
+
+    recorded_at = datetime.now(timezone.utc).isoformat()
+    if log_path:
+        with open(log_path, 'a') as log_file:
+            for metric in metrics:
+                record = {'recorded_at': recorded_at, 'run_id': run_id, 'step': step, 'partition': partition}
+                log_file.write(json.dumps({**record, **metric}, default=str) + '\n')
+
+    for metric in metrics:
+        print(f"   query {metric['query']}: {metric['elapsed_ms'] / 1000:.2f}s "
+              f"(queued {metric['queue_ms'] / 1000:.2f}s), {metric['rows_scanned']} rows scanned, "
+              f"{metric['rows_inserted'] or metric['lines_loaded']} rows written, "
+              f"{metric['broadcast_steps']} broadcasts, {metric['redistribute_steps']} redistributions, "
+              f"{metric['diskbased_steps']} steps spilled to disk"
+              + (f", {metric['load_errors']} load errors" if metric['load_errors'] else ''))
+
+    return metrics
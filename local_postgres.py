@@ -0,0 +1,122 @@
+import io
+import json
+import os
+import re
+from sql_queries import table_columns, to_dialect
+
+# the folder of the generated data every staging table is loaded from, like the S3 prefixes
+local_data_dirs = {'staging_events': 'log_data', 'staging_songs': 'song_data'}
+
+# the Redshift functions the queries use, emulated in Postgres. FNV_HASH only needs
+# to be deterministic here, the song lookup is rebuilt from scratch on every run
+postgres_functions = (
+    """
+    CREATE OR REPLACE FUNCTION fnv_hash(value anyelement, seed bigint DEFAULT 0) RETURNS bigint AS $$
+        SELECT ('x' || substr(md5(seed::text || ':' || value::text), 1, 16))::bit(64)::bigint
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION getdate() RETURNS timestamp AS $$
+        SELECT now()::timestamp
+    $$ LANGUAGE sql STABLE;
+    """
+)
+
+
+def translate(query):
+    """
+    Translate a Redshift statement of sql_queries.py to the Postgres dialect
+
+    Params:
+    query -- the Redshift statement
+
+    Returns
+    query -- the Postgres statement
+    """
+
+    if re.match(r'\s*(COPY|VACUUM|UNLOAD)\b', query, re.IGNORECASE):
+        raise ValueError(f'No Postgres equivalent, use the local loader instead: {query.split()[0]}')
+
+    return to_dialect(query, 'postgres')
+
+
+def prepare_database(cur, conn):
+    """
+    Create the functions the Redshift queries rely on
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    """
+
+    cur.execute(postgres_functions)
+    conn.commit()
+
+
+def json_files(path):
+    """
+    All the JSON files under a local directory, in key order like an S3 listing
+    """
+
+    files = []
+    for root, _, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names if name.endswith('.json'))
+
+    return sorted(files)
+
+
+def copy_value(value):
+    """
+    Format a value for the text format of COPY FROM STDIN
+    """
+
+    if value is None:
+        return '\\N'
+
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def load_json_files(cur, conn, table, path, chunk_rows=100000):
+    """
+    Stand-in for COPY ... FORMAT AS JSON: stream the newline delimited JSON files
+    under a local directory into a table with COPY FROM STDIN, one chunk of rows
+    at a time. The JSON keys are matched to the columns by name like JSON 'auto'
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    table -- the staging table, a key of table_columns
+    path -- local directory holding the JSON files, e.g. data/log_data
+    chunk_rows -- number of rows sent per COPY
+
+    Returns
+    rows -- number of rows loaded
+    """
+
+    columns = [name for name, _ in table_columns[table]]
+    query = 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns))
+
+    rows = 0
+    buffer = io.StringIO()
+
+    def flush():
+        buffer.seek(0)
+        cur.copy_expert(query, buffer)
+        buffer.seek(0)
+        buffer.truncate()
+
+    for file_path in json_files(path):
+        with open(file_path) as json_file:
+            for line in json_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                buffer.write('\t'.join(copy_value(record.get(column)) for column in columns) + '\n')
+                rows += 1
+                if rows % chunk_rows == 0:
+                    flush()
+
+    if buffer.tell():
+        flush()
+    conn.commit()
+
+    return rows
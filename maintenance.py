@@ -0,0 +1,89 @@
+import time
+from sql_queries import select_table_health, vacuum_sort_only, vacuum_delete_only, analyze_table
+
+
+def table_health(cur, tables):
+    """
+    Read the unsorted, stale statistics and deleted rows percentages of the tables
+
+    Params:
+    cur -- cursor object to database connection
+    tables -- list of table names
+
+    Returns
+    health -- dict mapping every table to a dict with unsorted, stats_off and deleted
+    """
+
+    cur.execute(select_table_health, (tuple(tables),))
+    return {table.strip(): {'unsorted': float(unsorted), 'stats_off': float(stats_off), 'deleted': float(deleted)}
+            for table, unsorted, stats_off, deleted in cur.fetchall()}
+
+
+def plan_maintenance(health, thresholds):
+    """
+    Pick the maintenance steps of every table that crosses a threshold
+
+    Params:
+    health -- dict as returned by table_health
+    thresholds -- dict with the unsorted, stats_off and deleted thresholds in percent
+
+    Returns
+    steps -- list of (table, step name, query) tuples, the vacuums come before the
+             ANALYZE of the same table since they change its statistics
+    """
+
+    steps = []
+    for table, metrics in health.items():
+        vacuumed = False
+        if metrics['deleted'] > thresholds['deleted']:
+            steps.append((table, 'vacuum delete only', vacuum_delete_only.format(table)))
+            vacuumed = True
+        if metrics['unsorted'] > thresholds['unsorted']:
+            steps.append((table, 'vacuum sort only', vacuum_sort_only.format(table)))
+            vacuumed = True
+        if vacuumed or metrics['stats_off'] > thresholds['stats_off']:
+            steps.append((table, 'analyze', analyze_table.format(table)))
+
+    return steps
+
+
+def run_maintenance(conn, tables, thresholds):
+    """
+    VACUUM and ANALYZE only the tables that need it and log the time of each step
+
+    Params:
+    conn -- connection object to database
+    tables -- list of table names
+    thresholds -- dict with the unsorted, stats_off and deleted thresholds in percent
+
+    Returns
+    timings -- list of (table, step name, seconds) tuples
+    """
+
+    print("Checking which tables need maintenance...")
+
+    # VACUUM can't run inside a transaction block
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    timings = []
+    try:
+        health = table_health(cur, tables)
+        steps = plan_maintenance(health, thresholds)
+        if not steps:
+            print('All tables are within the thresholds, nothing to do.')
+
+        for i, (table, step, query) in enumerate(steps, 1):
+            metrics = health[table]
+            print(f"{i}. Running {step} on {table} table (unsorted {metrics['unsorted']:.1f}%, "
+                  f"stats off {metrics['stats_off']:.1f}%, deleted {metrics['deleted']:.1f}%)...")
+            start = time.perf_counter()
+            cur.execute(query)
+            timings.append((table, step, time.perf_counter() - start))
+            print(f'Done in {timings[-1][2]:.2f}s.')
+    finally:
+        conn.autocommit = False
+
+    print("\nMaintenance finished.\n")
+
+    return timings
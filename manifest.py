@@ -0,0 +1,290 @@
+import fnmatch
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from sql_queries import render, staging_tables_order
+
+# log_data keys carry their date, e.g. log_data/2018/11/2018-11-01-events.json
+KEY_DATE_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+
+def split_s3_path(path):
+    """
+    Split an S3 path into its bucket and key prefix
+
+    Params:
+    path -- S3 path, e.g. 's3://udacity-dend/log_data', quotes are ignored
+
+    Returns
+    bucket, prefix -- the bucket name and the key prefix
+    """
+
+    bucket, _, prefix = path.strip("'").replace('s3://', '', 1).partition('/')
+    return bucket, prefix
+
+
+def expand_prefixes(s3, bucket, prefix, depth):
+    """
+    Walk the "directories" under prefix so they can be listed at the same time
+
+    Params:
+    s3 -- Boto3 client for S3
+    bucket -- the bucket name
+    prefix -- the key prefix to expand
+    depth -- how many levels of "/" to walk down
+
+    Returns
+    prefixes -- list of key prefixes covering every object under prefix
+    """
+
+    prefix = prefix.rstrip('/') + '/'
+    prefixes = [prefix]
+    paginator = s3.get_paginator('list_objects_v2')
+
+    for _ in range(depth):
+        children = []
+        for parent in prefixes:
+            found = []
+            for page in paginator.paginate(Bucket=bucket, Prefix=parent, Delimiter='/'):
+                found.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+                # objects sitting directly under parent are only covered by parent itself
+                if page.get('Contents'):
+                    found = None
+                    break
+            children.extend(found if found else [parent])
+        prefixes = children
+
+    return prefixes
+
+
+def list_prefix(s3, bucket, prefix):
+    """
+    List every object under one key prefix, page by page
+
+    Params:
+    s3 -- Boto3 client for S3
+    bucket -- the bucket name
+    prefix -- the key prefix to list
+
+    Returns
+    objects -- list of (key, size, last_modified) tuples
+    """
+
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects.append((obj['Key'], obj['Size'], obj['LastModified']))
+
+    return objects
+
+
+def list_objects(s3, path, max_workers, depth=2):
+    """
+    List every object under an S3 path, the sub-prefixes are listed concurrently
+
+    Params:
+    s3 -- Boto3 client for S3
+    path -- S3 path to list
+    max_workers -- number of listing threads
+    depth -- how many levels of sub-prefixes to list in parallel
+
+    Returns
+    objects -- list of (key, size, last_modified) tuples sorted by key
+    """
+
+    bucket, prefix = split_s3_path(path)
+    prefixes = expand_prefixes(s3, bucket, prefix, depth)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings = executor.map(lambda p: list_prefix(s3, bucket, p), prefixes)
+        objects = [obj for listing in listings for obj in listing]
+
+    return sorted(set(objects))
+
+
+def object_date(key, last_modified):
+    """
+    The date of an object, taken from its key when it has one, otherwise from
+    its last modified time
+
+    Returns
+    date -- date string formatted as YYYY-MM-DD
+    """
+
+    match = KEY_DATE_PATTERN.search(key)
+    return match.group(1) if match else last_modified.strftime('%Y-%m-%d')
+
+
+def filter_objects(objects, pattern='*', start_date=None, end_date=None):
+    """
+    Keep only the objects matching a key pattern and a date range
+
+    Params:
+    objects -- list of (key, size, last_modified) tuples
+    pattern -- shell-style pattern the key must match, e.g. '*.json'
+    start_date -- first date to keep (YYYY-MM-DD), None for no lower bound
+    end_date -- last date to keep (YYYY-MM-DD), None for no upper bound
+
+    Returns
+    objects -- the matching objects
+    """
+
+    matching = []
+    for key, size, last_modified in objects:
+        if not fnmatch.fnmatch(key, pattern):
+            continue
+        date = object_date(key, last_modified)
+        if start_date and date < start_date:
+            continue
+        if end_date and date > end_date:
+            continue
+        matching.append((key, size, last_modified))
+
+    return matching
+
+
+def balance_objects(objects, num_groups):
+    """
+    Split the objects into groups of about the same total size, largest first
+    into the lightest group, so no slice is left with all the big files
+
+    Params:
+    objects -- list of (key, size, last_modified) tuples
+    num_groups -- number of groups, the number of slices in the cluster
+
+    Returns
+    groups -- list of num_groups lists of objects
+    """
+
+    groups = [[] for _ in range(num_groups)]
+    sizes = [0] * num_groups
+
+    for obj in sorted(objects, key=lambda obj: obj[1], reverse=True):
+        lightest = sizes.index(min(sizes))
+        groups[lightest].append(obj)
+        sizes[lightest] += obj[1]
+
+    return groups
+
+
+def build_manifest(bucket, groups):
+    """
+    Build a COPY manifest, the groups are interleaved so consecutive entries
+    come from different groups
+
+    Params:
+    bucket -- the bucket holding the objects
+    groups -- list of lists of objects, as returned by balance_objects
+
+    Returns
+    manifest -- the manifest as a dict
+    """
+
+    entries = []
+    for i in range(max((len(group) for group in groups), default=0)):
+        for group in groups:
+            if i < len(group):
+                key, size, _ = group[i]
+                entries.append({'url': f's3://{bucket}/{key}',
+                                'mandatory': True,
+                                'meta': {'content_length': size}})
+
+    return {'entries': entries}
+
+
+def write_manifest(s3, manifest_path, manifest):
+    """
+    Upload a manifest to S3
+
+    Params:
+    s3 -- Boto3 client for S3
+    manifest_path -- S3 path of the manifest file
+    manifest -- the manifest as a dict
+    """
+
+    bucket, key = split_s3_path(manifest_path)
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+
+
+def manifest_stats(groups):
+    """
+    Object count and byte totals of a manifest
+
+    Returns
+    stats -- dict with the number of objects, total bytes and the bytes of the
+             heaviest and lightest groups
+    """
+
+    group_bytes = [sum(obj[1] for obj in group) for group in groups] or [0]
+    return {'objects': sum(len(group) for group in groups),
+            'bytes': sum(group_bytes),
+            'max_group_bytes': max(group_bytes),
+            'min_group_bytes': min(group_bytes)}
+
+
+def prepare_manifest(s3, source_path, manifest_path, num_slices, max_workers,
+                     pattern='*', start_date=None, end_date=None):
+    """
+    List, filter and balance the objects under source_path and write their manifest
+
+    Returns
+    stats -- the manifest stats, see manifest_stats
+    """
+
+    bucket, _ = split_s3_path(source_path)
+    objects = filter_objects(list_objects(s3, source_path, max_workers), pattern, start_date, end_date)
+    groups = balance_objects(objects, num_slices)
+    write_manifest(s3, manifest_path, build_manifest(bucket, groups))
+
+    return manifest_stats(groups)
+
+
+def load_staging_tables_manifest(cur, conn, s3, manifest_config, log_data, song_data, start_date=None,
+                                 tables=staging_tables_order):
+    """
+    Load the staging tables with COPY ... MANIFEST, only the event logs dated
+    from start_date onwards are loaded
+
+    Params:
+    cur -- cursor object to database connection
+    conn -- connection object to database
+    s3 -- Boto3 client for S3
+    manifest_config -- the MANIFEST section of dwh.cfg
+    log_data -- S3 path of the event logs
+    song_data -- S3 path of the song metadata
+    start_date -- first date of event logs to load (YYYY-MM-DD), None for all
+    tables -- the staging tables to load, all of them by default
+
+    Returns
+    stats -- dict mapping every loaded staging table to its manifest stats
+    """
+
+    print("Loading data from JSON files stored in S3 buckets into staging tables using manifests...")
+
+    path = manifest_config.get('PATH').rstrip('/')
+    num_slices = manifest_config.getint('SLICES')
+    max_workers = manifest_config.getint('LISTING_WORKERS')
+    pattern = manifest_config.get('KEY_PATTERN')
+
+    loads = [('staging events', log_data, f'{path}/staging_events.manifest', 'copy_staging_events_manifest', start_date),
+             ('staging songs', song_data, f'{path}/staging_songs.manifest', 'copy_staging_songs_manifest', None)]
+    loads = [load for load in loads if load[0] in tables]
+
+    stats = {}
+    for i, (table, source_path, manifest_path, template, start) in enumerate(loads, 1):
+        print(f'{i}. Listing objects for {table} table...')
+        stats[table] = prepare_manifest(s3, source_path, manifest_path, num_slices, max_workers, pattern, start)
+        print(f"{stats[table]['objects']} objects, {stats[table]['bytes']} bytes.")
+        if not stats[table]['objects']:
+            print('Nothing new to load.')
+            continue
+
+        print(f'Loading data into {table} table...')
+        cur.execute(render(template, manifest=manifest_path))
+        conn.commit()
+        print('Done.')
+
+    print("\nAll loaded into staging tables successfully.\n")
+
+    return stats
@@ -0,0 +1,235 @@
+import json
+import time
+from botocore.exceptions import ClientError, WaiterError
+
+
+def poll(check, description, timeout, initial_delay=5, max_delay=60):
+    """
+    Call check until it returns True, with an exponential backoff between calls,
+    until the total timeout
+
+    Params:
+    check -- callable without arguments returning True once done
+    description -- what is being waited for, used in the log
+    timeout -- maximum number of seconds to wait
+    initial_delay -- seconds between the first two checks
+    max_delay -- the delay between checks never grows above this
+
+    Returns
+    elapsed -- number of seconds waited
+    """
+
+    delay = initial_delay
+    start = time.monotonic()
+
+    while not check():
+        elapsed = time.monotonic() - start
+        if elapsed + delay > timeout:
+            raise TimeoutError(f'{description} not reached after {elapsed:.0f}s')
+
+        print(f'Waiting for {description}, checking again in {delay:.0f}s...')
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+    return time.monotonic() - start
+
+
+def wait_for_cluster(redshift, waiter_name, cluster_identifier, timeout, initial_delay=5, max_delay=60):
+    """
+    Wait for a Redshift cluster waiter (e.g. cluster_available, cluster_deleted) to
+    succeed, polling with an exponential backoff until the total timeout
+
+    Params:
+    redshift -- Boto3 client for Redshift
+    waiter_name -- name of the Redshift waiter
+    cluster_identifier -- the cluster to wait for
+    timeout -- maximum number of seconds to wait
+    initial_delay -- seconds between the first two checks
+    max_delay -- the delay between checks never grows above this
+
+    Returns
+    elapsed -- number of seconds waited
+    """
+
+    waiter = redshift.get_waiter(waiter_name)
+
+    def check():
+        try:
+            # a single check, the backoff between checks is ours
+            waiter.wait(ClusterIdentifier=cluster_identifier, WaiterConfig={'Delay': 1, 'MaxAttempts': 1})
+            return True
+        except WaiterError as e:
+            # any other reason means the cluster reached a failure state
+            if 'Max attempts exceeded' not in str(e):
+                raise
+            return False
+
+    return poll(check, f'{waiter_name} of {cluster_identifier}', timeout, initial_delay, max_delay)
+
+
+def wait_for_status(redshift, cluster_identifier, status, timeout, initial_delay=5, max_delay=60):
+    """
+    Wait for a cluster to reach a status there is no boto3 waiter for, e.g. paused
+
+    Params:
+    redshift -- Boto3 client for Redshift
+    cluster_identifier -- the cluster to wait for
+    status -- the cluster status to wait for
+    timeout -- maximum number of seconds to wait
+    initial_delay -- seconds between the first two checks
+    max_delay -- the delay between checks never grows above this
+
+    Returns
+    elapsed -- number of seconds waited
+    """
+
+    def check():
+        cluster = redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]
+        return cluster['ClusterStatus'].lower() == status
+
+    return poll(check, f'{cluster_identifier} to be {status}', timeout, initial_delay, max_delay)
+
+
+def prepare_security_group(ec2, port, vpc_id=None):
+    """
+    Open the cluster port on the default security group of a VPC, the cluster is
+    then created in that security group
+
+    Params:
+    ec2 -- Boto3 client for EC2
+    port -- the TCP port of the cluster
+    vpc_id -- the VPC of the cluster, the default VPC if None
+
+    Returns
+    group_id -- the id of the security group
+    """
+
+    print('Opening an incoming TCP port on the default security group...')
+    if not vpc_id:
+        vpc_id = ec2.describe_vpcs(Filters=[{'Name': 'isDefault', 'Values': ['true']}])['Vpcs'][0]['VpcId']
+
+    group = ec2.describe_security_groups(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]},
+                                                  {'Name': 'group-name', 'Values': ['default']}])['SecurityGroups'][0]
+
+    try:
+        ec2.authorize_security_group_ingress(
+            GroupId=group['GroupId'],
+            IpPermissions=[{'IpProtocol': 'tcp',
+                            'FromPort': port,
+                            'ToPort': port,
+                            'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}]
+        )
+    except ClientError as e:
+        # the port is already open
+        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+            raise
+
+    return group['GroupId']
+
+
+def find_subnet_group(redshift, name):
+    """
+    Make sure the configured cluster subnet group exists
+
+    Params:
+    redshift -- Boto3 client for Redshift
+    name -- the cluster subnet group name, empty for the default one
+
+    Returns
+    name -- the subnet group name, or None to use the default subnet group
+    """
+
+    if not name:
+        return None
+
+    print(f'Looking up the {name} cluster subnet group...')
+    try:
+        redshift.describe_cluster_subnet_groups(ClusterSubnetGroupName=name)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ClusterSubnetGroupNotFoundFault':
+            raise
+        print(f'Cluster subnet group {name} not found, using the default one.')
+        return None
+
+    return name
+
+
+def wlm_configuration(wlm):
+    """
+    Build the manual WLM queues: an ETL queue for the COPY and INSERT statements
+    routed by query group, a BI queue for the dashboard routed by user or query
+    group, short query acceleration and the default queue for everything else
+
+    Params:
+    wlm -- the WLM section of dwh.cfg
+
+    Returns
+    queues -- the wlm_json_configuration parameter value, as a list of dicts
+    """
+
+    queues = [
+        {'name': 'etl',
+         'query_group': [f"{wlm.get('ETL_QUERY_GROUP')}*"],
+         'query_group_wild_card': 1,
+         'memory_percent_to_use': wlm.getint('ETL_MEMORY_PERCENT'),
+         'query_concurrency': wlm.getint('ETL_CONCURRENCY'),
+         'concurrency_scaling': wlm.get('ETL_CONCURRENCY_SCALING')},
+        {'name': 'bi',
+         'query_group': [f"{wlm.get('BI_QUERY_GROUP')}*"],
+         'query_group_wild_card': 1,
+         'user_group': [group.strip() for group in wlm.get('BI_USER_GROUP').split(',') if group.strip()],
+         'memory_percent_to_use': wlm.getint('BI_MEMORY_PERCENT'),
+         'query_concurrency': wlm.getint('BI_CONCURRENCY'),
+         'concurrency_scaling': wlm.get('BI_CONCURRENCY_SCALING')},
+        # the default queue has to be the last one
+        {'name': 'default',
+         'memory_percent_to_use': wlm.getint('DEFAULT_MEMORY_PERCENT'),
+         'query_concurrency': wlm.getint('DEFAULT_CONCURRENCY')},
+    ]
+
+    memory = sum(queue['memory_percent_to_use'] for queue in queues)
+    if memory > 100:
+        raise ValueError(f'The WLM queues use {memory}% of the memory, at most 100% is available')
+
+    if wlm.getboolean('SHORT_QUERY_ACCELERATION'):
+        # 0 lets Redshift pick the maximum runtime of a short query
+        sqa = {'short_query_queue': True}
+        if wlm.getint('SHORT_QUERY_MAX_RUNTIME'):
+            sqa['max_execution_time'] = wlm.getint('SHORT_QUERY_MAX_RUNTIME') * 1000
+        queues.append(sqa)
+
+    return queues
+
+
+def prepare_parameter_group(redshift, name, queues, max_scaling_clusters):
+    """
+    Create the cluster parameter group if needed and set its WLM queues and
+    concurrency scaling limit, the cluster is then created with it
+
+    Params:
+    redshift -- Boto3 client for Redshift
+    name -- the cluster parameter group name
+    queues -- the WLM queues, as returned by wlm_configuration
+    max_scaling_clusters -- how many concurrency scaling clusters can run at once
+
+    Returns
+    name -- the parameter group name
+    """
+
+    print(f'Preparing the {name} parameter group with {len(queues)} WLM queues...')
+    try:
+        redshift.create_cluster_parameter_group(ParameterGroupName=name,
+                                                ParameterGroupFamily='redshift-1.0',
+                                                Description='WLM queues for the ETL and the dashboard')
+    except ClientError as e:
+        # the parameter group is kept between clusters
+        if e.response['Error']['Code'] != 'ClusterParameterGroupAlreadyExists':
+            raise
+
+    redshift.modify_cluster_parameter_group(
+        ParameterGroupName=name,
+        Parameters=[{'ParameterName': 'wlm_json_configuration', 'ParameterValue': json.dumps(queues)},
+                    {'ParameterName': 'max_concurrency_scaling_clusters', 'ParameterValue': str(max_scaling_clusters)}]
+    )
+
+    return name
@@ -0,0 +1,130 @@
+import configparser
+from incremental import WATERMARK_SOURCE
+from sql_queries import render_quality_check
+
+
+class DataQualityError(Exception):
+    """
+    Raised when a data quality check fails, it stops the run before the views are refreshed
+    """
+
+
+def load_checks(path='quality.cfg'):
+    """
+    Read the data quality checks from the quality config file
+
+    Params:
+    path -- path of the quality config file
+
+    Returns
+    checks -- dict mapping every table to a dict of its checks
+    """
+
+    config = configparser.ConfigParser()
+    with open(path) as configfile:
+        config.read_file(configfile)
+
+    def pairs(value):
+        return [pair.strip().split(':', 1) for pair in value.split(',') if pair.strip()]
+
+    checks = {}
+    for table in config.sections():
+        options = config[table]
+
+        table_checks = {}
+        if 'min_rows' in options:
+            table_checks['min_rows'] = options.getint('min_rows')
+        if 'max_row_drop' in options:
+            table_checks['max_row_drop'] = options.getfloat('max_row_drop')
+        # a NOT NULL column is a column with a NULL rate of 0
+        null_rates = {column.strip(): 0.0 for column in options.get('not_null', '').split(',') if column.strip()}
+        null_rates.update({column: float(rate) for column, rate in pairs(options.get('max_null_rate', ''))})
+        if null_rates:
+            table_checks['null_rates'] = null_rates
+        if 'unique' in options:
+            table_checks['unique'] = [column.strip() for column in options['unique'].split(',')]
+        if 'references' in options:
+            table_checks['references'] = {column: tuple(parent.split('.', 1))
+                                          for column, parent in pairs(options['references'])}
+        if 'freshness' in options:
+            table_checks['freshness'] = {column: int(hours) for column, hours in pairs(options['freshness'])}
+
+        checks[table] = table_checks
+
+    return checks
+
+
+def evaluate_checks(checks, result):
+    """
+    Compare the measures of a table with the thresholds of its checks
+
+    Params:
+    checks -- dict of the checks of the table, as returned by load_checks
+    result -- dict mapping the columns of the render_quality_check query to their value
+
+    Returns
+    outcomes -- list of (check, measure, passed) tuples
+    """
+
+    row_count = result['row_count']
+    outcomes = []
+
+    if 'min_rows' in checks:
+        outcomes.append((f"min_rows >= {checks['min_rows']}", f'{row_count} rows',
+                         row_count >= checks['min_rows']))
+    if 'max_row_drop' in checks:
+        previous = result['previous_rows']
+        # the first run has nothing to compare with
+        passed = previous is None or row_count >= previous * (1 - checks['max_row_drop'])
+        outcomes.append((f"max_row_drop <= {checks['max_row_drop']:.0%}",
+                         f'{row_count} rows, {previous} before', passed))
+    for column, rate in checks.get('null_rates', {}).items():
+        nulls = result[f'nulls_{column}'] or 0
+        outcomes.append((f'null_rate({column}) <= {rate:.0%}', f'{nulls} NULL',
+                         nulls <= rate * row_count))
+    for column in checks.get('unique', []):
+        duplicates = result[f'duplicates_{column}']
+        outcomes.append((f'unique({column})', f'{duplicates} duplicates', duplicates == 0))
+    for column, (parent, key) in checks.get('references', {}).items():
+        orphans = result[f'orphans_{column}'] or 0
+        outcomes.append((f'references({column} -> {parent}.{key})', f'{orphans} orphans', orphans == 0))
+    for column, hours in checks.get('freshness', {}).items():
+        outcomes.append((f'freshness({column}) <= {hours}h', f"newest {result[f'newest_{column}']}",
+                         result[f'stale_{column}'] == 0))
+
+    return outcomes
+
+
+def run_checks(cur, run_id, checks, tables):
+    """
+    Run the checks of the given tables, one query per table computed in the cluster,
+    and fail on the first table with a failed check
+
+    Params:
+    cur -- cursor object to database connection
+    run_id -- the id of the run, the row counts are compared with the previous runs
+    checks -- dict mapping a table to its checks, as returned by load_checks
+    tables -- the tables to check, the ones without checks are skipped
+
+    Returns
+    outcomes -- dict mapping every checked table to its list of (check, measure, passed) tuples
+    """
+
+    outcomes = {}
+    for table in tables:
+        if not checks.get(table):
+            continue
+
+        print(f'Checking {table}...')
+        cur.execute(render_quality_check(table, checks[table]), {'run_id': run_id, 'source': WATERMARK_SOURCE})
+        result = dict(zip([column[0] for column in cur.description], cur.fetchone()))
+        outcomes[table] = evaluate_checks(checks[table], result)
+
+        for check, measure, passed in outcomes[table]:
+            print(f"   {check}: {measure}, {'ok' if passed else 'FAILED'}")
+
+        failed = [check for check, _, passed in outcomes[table] if not passed]
+        if failed:
+            raise DataQualityError(f"{table} failed {len(failed)} checks: {', '.join(failed)}")
+
+    return outcomes
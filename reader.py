@@ -0,0 +1,142 @@
+import argparse
+import configparser
+import csv
+import uuid
+from connection import ClusterPool
+from sql_queries import dwh_tables_order, render_unload_select
+
+
+def stream_batches(pool, query, params=None, itersize=10000):
+    """
+    Run a query on a named (server-side) cursor and yield its rows in batches,
+    so only one batch is held in memory at a time. The connection is borrowed
+    until the generator is exhausted or closed
+
+    Params:
+    pool -- connection.ClusterPool the connection is borrowed from
+    query -- the SELECT statement
+    params -- optional query parameters
+    itersize -- number of rows fetched from the server per round trip and per batch
+
+    Returns
+    batches -- generator of (column names, list of row tuples) tuples
+    """
+
+    with pool.connection() as conn:
+        # a named cursor only lives inside a transaction
+        cur = conn.cursor(name=f'reader_{uuid.uuid4().hex}')
+        cur.itersize = itersize
+        try:
+            cur.execute(query, params)
+            columns = None
+            while True:
+                rows = cur.fetchmany(itersize)
+                if columns is None:
+                    columns = [column[0] for column in cur.description]
+                if not rows:
+                    break
+                yield columns, rows
+        finally:
+            cur.close()
+            conn.rollback()
+
+
+def write_csv(batches, path):
+    """
+    Write the batches to a CSV file with a header line
+
+    Params:
+    batches -- generator of (column names, rows) tuples, as returned by stream_batches
+    path -- the CSV file
+
+    Returns
+    rows -- number of rows written
+    """
+
+    rows = 0
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        for columns, batch in batches:
+            if rows == 0:
+                writer.writerow(columns)
+            writer.writerows(batch)
+            rows += len(batch)
+
+    return rows
+
+
+def record_batches(batches):
+    """
+    Convert the batches to Arrow record batches, one per fetched batch
+
+    Params:
+    batches -- generator of (column names, rows) tuples, as returned by stream_batches
+
+    Returns
+    record_batches -- generator of pyarrow.RecordBatch
+    """
+
+    # only needed for the Arrow and Parquet outputs
+    import pyarrow as pa
+
+    for columns, batch in batches:
+        yield pa.RecordBatch.from_arrays([pa.array(values) for values in zip(*batch)], names=columns)
+
+
+def write_parquet(batches, path):
+    """
+    Write the batches to a Parquet file, one row group per fetched batch
+
+    Params:
+    batches -- generator of (column names, rows) tuples, as returned by stream_batches
+    path -- the Parquet file
+
+    Returns
+    rows -- number of rows written
+    """
+
+    import pyarrow.parquet as pq
+
+    rows = 0
+    writer = None
+    try:
+        for record_batch in record_batches(batches):
+            if writer is None:
+                writer = pq.ParquetWriter(path, record_batch.schema)
+            writer.write_batch(record_batch)
+            rows += record_batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rows
+
+
+if __name__ == "__main__":
+    """
+    Extract a table or a query result to a local CSV or Parquet file with bounded memory
+    """
+
+    parser = argparse.ArgumentParser(description='Stream a query result from the cluster to a local file.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--table', choices=dwh_tables_order, help='the table to extract')
+    source.add_argument('--query', help='the SELECT statement to extract')
+    parser.add_argument('--start-date', help='only extract the rows of --table from this date on (YYYY-MM-DD)')
+    parser.add_argument('--end-date', help='only extract the rows of --table before this date (YYYY-MM-DD)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='the output file format')
+    parser.add_argument('--itersize', type=int, help='rows per batch, [READER] itersize by default')
+    parser.add_argument('output', help='the output file')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    query = args.query or render_unload_select(args.table, args.start_date, args.end_date)
+    itersize = args.itersize or config.getint('READER', 'ITERSIZE')
+
+    pool = ClusterPool(config)
+    batches = stream_batches(pool, query, itersize=itersize)
+    print(f'Extracting to {args.output}...')
+    rows = write_csv(batches, args.output) if args.format == 'csv' else write_parquet(batches, args.output)
+    print(f'Done, {rows} rows written.')
+    pool.closeall()
@@ -0,0 +1,104 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from sql_queries import set_query_group, reset_query_group
+
+
+def validate_dag(nodes, dependencies):
+    """
+    Make sure every dependency refers to a known node and that there are no cycles
+
+    Params:
+    nodes -- list of node names
+    dependencies -- dict mapping a node to the list of nodes it depends on
+    """
+
+    for node, parents in dependencies.items():
+        for parent in [node] + list(parents):
+            if parent not in nodes:
+                raise ValueError(f'Unknown node in dependencies: {parent}')
+
+    # Kahn's algorithm, if some nodes are never released there is a cycle
+    remaining = {node: set(dependencies.get(node, [])) for node in nodes}
+    while remaining:
+        ready = [node for node, parents in remaining.items() if not parents]
+        if not ready:
+            raise ValueError(f'Cycle detected between: {", ".join(remaining)}')
+        for node in ready:
+            del remaining[node]
+        for parents in remaining.values():
+            parents.difference_update(ready)
+
+
+def run_dag(nodes, queries, dependencies, pool, max_workers, skip=(), on_status=None, query_groups=None):
+    """
+    Execute the queries concurrently on a pool of connections, each query starts
+    as soon as all the queries it depends on are committed. Every query runs in
+    its own unit of work and is retried on transient errors
+
+    Params:
+    nodes -- list of node (table) names
+    queries -- list of queries, in the same order as nodes
+    dependencies -- dict mapping a node to the list of nodes it depends on
+    pool -- connection.ClusterPool the queries borrow their connections from
+    max_workers -- maximum number of queries running at the same time
+    skip -- nodes that are not run and count as already done
+    on_status -- optional callable(node, status, seconds) called from the calling
+                 thread when a node is 'running', 'done' or 'failed'
+    query_groups -- optional callable(node) returning the query group the query of
+                    the node runs under, e.g. to route it to a WLM queue
+
+    Returns
+    timings -- dict mapping every node that ran to its wall time in seconds
+    """
+
+    validate_dag(nodes, dependencies)
+
+    node_queries = dict(zip(nodes, queries))
+    pending = {node: set(dependencies.get(node, [])) - set(skip) for node in nodes if node not in skip}
+    timings = {}
+    on_status = on_status or (lambda node, status, seconds: None)
+
+    def execute(node):
+        def timed(cur):
+            start = time.perf_counter()
+            if query_groups:
+                cur.execute(set_query_group, (query_groups(node),))
+            cur.execute(node_queries[node])
+            if query_groups:
+                # back to the query group of the pool, the connection keeps its WLM queue
+                if pool.query_group:
+                    cur.execute(set_query_group, (pool.query_group,))
+                else:
+                    cur.execute(reset_query_group)
+            return time.perf_counter() - start
+
+        return pool.run(timed)
+
+    def submit_ready(executor, running):
+        for node in [node for node, parents in pending.items() if not parents]:
+            del pending[node]
+            print(f'Starting {node}...')
+            on_status(node, 'running', None)
+            running[executor.submit(execute, node)] = node
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        submit_ready(executor, running)
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                if future.exception() is not None:
+                    on_status(node, 'failed', None)
+                    # re-raise the failure, the nodes that depend on it never start
+                    raise future.exception()
+                timings[node] = future.result()
+                print(f'Done {node} in {timings[node]:.2f}s.')
+                on_status(node, 'done', timings[node])
+                for parents in pending.values():
+                    parents.discard(node)
+
+            submit_ready(executor, running)
+
+    return timings
@@ -0,0 +1,91 @@
+from sql_queries import load_settings, render, select_external_tables
+
+# the external tables and the template of the statement creating each of them
+EXTERNAL_TABLES = {'events_json': 'create_external_events_json',
+                   'songs_json': 'create_external_songs_json',
+                   'events_parquet': 'create_external_events_parquet'}
+
+
+def create_external_tables(cur):
+    """
+    Create the external schema and the external tables that don't exist yet,
+    the existing ones keep their registered partitions
+
+    Params:
+    cur -- cursor object to database connection, in autocommit mode
+    """
+
+    schema = load_settings()['spectrum_schema']
+    cur.execute(render('create_external_schema'))
+    cur.execute(select_external_tables, (schema,))
+    existing = {row[0] for row in cur.fetchall()}
+
+    for table, template in EXTERNAL_TABLES.items():
+        if table not in existing:
+            print(f'Creating external table {schema}.{table}...')
+            cur.execute(render(template))
+
+
+def prepare_external_tables(conn, months, write_parquet):
+    """
+    Register the monthly partitions of the event logs on the external tables and,
+    when write_parquet is set, write a Parquet copy of every month with UNLOAD
+
+    Params:
+    conn -- connection object to database
+    months -- list of (YYYY/MM, S3 path prefix) tuples, as returned by incremental.log_month_partitions
+    write_parquet -- write and register the Parquet copy of the months
+    """
+
+    print("Registering the event logs in the Spectrum external tables...")
+
+    # external DDL and UNLOAD can't run inside a transaction block, the one the caller
+    # left open (e.g. the SET query_group of the step) is committed first
+    conn.commit()
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    try:
+        create_external_tables(cur)
+
+        for i, (month, path) in enumerate(months, 1):
+            year, month_number = (int(part) for part in month.split('/'))
+            print(f'{i}. Registering partition {month}...')
+            cur.execute(render('add_external_partition', table='events_json', year=year, month=month_number,
+                               location=path.rstrip('/') + '/'))
+
+            if write_parquet:
+                print(f'   Writing the Parquet copy of {month}...')
+                cur.execute(render('unload_events_parquet', year=year, month=month_number))
+                cur.execute(render('add_external_partition', table='events_parquet', year=year, month=month_number,
+                                   location=render('external_parquet_partition', year=year, month=month_number)))
+            print('Done.')
+    finally:
+        conn.autocommit = False
+
+    print("\nAll partitions registered successfully.\n")
+
+
+def external_sources(first_month=None, parquet=True):
+    """
+    The relations the insert steps read the events and the songs from, the
+    events are restricted to the months from first_month on so Spectrum only
+    scans those partitions
+
+    Params:
+    first_month -- the oldest month to read (YYYY/MM), None reads them all
+    parquet -- read the events from the Parquet copy instead of the raw JSON
+
+    Returns
+    events_source -- parenthesized subquery over the external events table
+    songs_source -- the external songs table
+    """
+
+    schema = load_settings()['spectrum_schema']
+    events_table = f"{schema}.{'events_parquet' if parquet else 'events_json'}"
+    where = ''
+    if first_month:
+        year, month = (int(part) for part in first_month.split('/'))
+        where = f' WHERE year > {year} OR (year = {year} AND month >= {month})'
+
+    return f'(SELECT * FROM {events_table}{where})', f'{schema}.songs_json'
@@ -1,14 +1,133 @@
 import configparser
+import re
+from functools import lru_cache
 
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
 
-S3_LOG_DATA = config.get('S3', 'LOG_DATA')
-S3_LOG_JSONPATH = config.get('S3', 'LOG_JSONPATH')
-S3_SONG_DATA = config.get('S3', 'SONG_DATA')
-DWH_IAM_ROLE_ARN = config.get("IAM_ROLE", "ARN")
+# the seconds every row of the time dimension covers
+calendar_grains = {'second': 1, 'minute': 60}
+
+
+@lru_cache(maxsize=None)
+def load_settings(path='dwh.cfg'):
+    """
+    Read the settings the query templates are rendered with, once per config file.
+    Importing this module doesn't read dwh.cfg, the first rendered template does
+
+    Params:
+    path -- path of the config file
+
+    Returns
+    settings -- dict of the default named parameters of the templates
+    """
+
+    config = configparser.ConfigParser()
+    config.read(path)
+
+    log_data = config.get('S3', 'LOG_DATA')
+    # bucket and key prefix of the event logs, used to list the new date partitions
+    log_bucket, log_prefix = log_data.strip("'").replace('s3://', '').split('/', 1)
+
+    return {
+        'log_data': log_data,
+        'log_jsonpath': config.get('S3', 'LOG_JSONPATH'),
+        'song_data': config.get('S3', 'SONG_DATA'),
+        # the same paths without their quotes, for the external table locations
+        'log_data_location': log_data.strip("'"),
+        'song_data_location': config.get('S3', 'SONG_DATA').strip("'"),
+        'log_bucket': log_bucket,
+        'log_prefix': log_prefix,
+        'iam_role_arn': config.get('IAM_ROLE', 'ARN'),
+        'mv_auto_refresh': config.getboolean('VIEWS', 'AUTO_REFRESH'),
+        'spectrum_schema': config.get('SPECTRUM', 'SCHEMA'),
+        'spectrum_database': config.get('SPECTRUM', 'GLUE_DATABASE'),
+        'spectrum_parquet_path': config.get('SPECTRUM', 'PARQUET_PATH').rstrip('/'),
+        'calendar_grain_seconds': calendar_grains[config.get('CALENDAR', 'GRAIN')],
+    }
+
+
+# TEMPLATES
+
+# the statements depending on the settings or on a partition, rendered on demand with
+# str.format named parameters. Every section below adds its own
+query_templates = {}
+
+# Redshift-only syntax and what it becomes in the other dialects, an empty replacement skips it
+dialect_rules = {
+    'redshift': [],
+    'postgres': [
+        (re.compile(r'\s*\bDISTSTYLE\s+\w+', re.IGNORECASE), ''),
+        (re.compile(r'\s*\bDISTKEY\s*\([^)]*\)', re.IGNORECASE), ''),
+        (re.compile(r'\s*\b(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', re.IGNORECASE), ''),
+        (re.compile(r'\s+ENCODE\s+\w+', re.IGNORECASE), ''),
+        # the foreign keys are informational in Redshift, Postgres would enforce them
+        (re.compile(r'\s+REFERENCES\s+\w+\s*\([^)]*\)', re.IGNORECASE), ''),
+        (re.compile(r'\bIDENTITY\s*\(\s*0\s*,\s*1\s*\)', re.IGNORECASE),
+         'GENERATED BY DEFAULT AS IDENTITY (MINVALUE 0 START 0)'),
+        (re.compile(r'\bEXTRACT\s*\(\s*dayofweek\b', re.IGNORECASE), 'EXTRACT(dow'),
+    ],
+}
+
+
+def to_dialect(query, dialect='redshift'):
+    """
+    Rewrite a Redshift statement in another SQL dialect
+
+    Params:
+    query -- the Redshift statement
+    dialect -- a key of dialect_rules
+
+    Returns
+    query -- the statement in the dialect
+    """
+
+    for pattern, replacement in dialect_rules[dialect]:
+        query = pattern.sub(replacement, query)
+
+    return query
+
+
+@lru_cache(maxsize=None)
+def _render_template(name, dialect, params):
+    return to_dialect(query_templates[name].format(**dict(params)), dialect)
+
+
+def render(name, dialect='redshift', settings=None, **params):
+    """
+    Render a query template, e.g. render('copy_staging_events_partition', path=path).
+    The settings fill the parameters that aren't passed, and every rendering is cached
+
+    Params:
+    name -- the template name, a key of query_templates
+    dialect -- the SQL dialect, a key of dialect_rules
+    settings -- dict of default parameters, the ones of dwh.cfg when None
+    params -- named parameters, they win over the settings
+
+    Returns
+    query -- the statement
+    """
+
+    merged = {**(load_settings() if settings is None else settings), **params}
+    return _render_template(name, dialect, tuple(sorted(merged.items())))
+
+
+# the statement lists holding rendered templates, rendered on access too
+lazy_query_lists = {}
+
+
+def __getattr__(name):
+    """
+    The templates and the lists holding them are rendered with the settings of
+    dwh.cfg when they are first imported, e.g. from sql_queries import copy_staging_events
+    """
+
+    if name in query_templates:
+        return render(name)
+    if name in lazy_query_lists:
+        return lazy_query_lists[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 # DROP TABLES
 drop_staging_events_table = "DROP TABLE IF EXISTS staging_events;"
@@ -18,233 +137,1136 @@ drop_users_table = "DROP TABLE IF EXISTS users;"
 drop_songs_table = "DROP TABLE IF EXISTS songs;"
 drop_artists_table = "DROP TABLE IF EXISTS artists;"
 drop_time_table = "DROP TABLE IF EXISTS time;"
+drop_watermarks_table = "DROP TABLE IF EXISTS etl_watermarks;"
+drop_song_lookup_table = "DROP TABLE IF EXISTS song_lookup;"
+drop_staging_next_songs_table = "DROP TABLE IF EXISTS staging_next_songs;"
+drop_parked_plays_table = "DROP TABLE IF EXISTS parked_plays;"
+drop_checkpoints_table = "DROP TABLE IF EXISTS etl_checkpoints;"
+drop_query_metrics_table = "DROP TABLE IF EXISTS etl_query_metrics;"
+drop_view = "DROP MATERIALIZED VIEW IF EXISTS {};"
 
 # CREATE TABLES
 
-create_staging_events_table= (
+# column definitions of every table, the physical design (distribution, sort keys
+# and encodings) is kept apart so create_tables.py can render it from table_design.cfg
+table_columns = {
+    'staging_events': [
+        ('artist', 'VARCHAR'),
+        ('auth', 'VARCHAR'),
+        ('firstName', 'VARCHAR'),
+        ('gender', 'CHAR(1)'),
+        ('itemInSession', 'INTEGER'),
+        ('lastName', 'VARCHAR'),
+        ('length', 'DECIMAL'),
+        ('level', 'VARCHAR'),
+        ('location', 'VARCHAR'),
+        ('method', 'VARCHAR'),
+        ('page', 'VARCHAR'),
+        ('registration', 'FLOAT'),
+        ('sessionId', 'INTEGER'),
+        ('song', 'VARCHAR'),
+        ('status', 'INTEGER'),
+        ('ts', 'BIGINT'),
+        ('userAgent', 'VARCHAR'),
+        ('userId', 'INTEGER'),
+    ],
+    # the NextSong events of staging_events, typed once for all the inserts
+    'staging_next_songs': [
+        ('ts', 'BIGINT NOT NULL'),
+        ('start_time', 'TIMESTAMP NOT NULL'),
+        ('user_id', 'INTEGER'),
+        ('first_name', 'VARCHAR'),
+        ('last_name', 'VARCHAR'),
+        ('gender', 'CHAR(1)'),
+        ('level', 'VARCHAR'),
+        ('song_key', 'BIGINT'),
+        ('session_id', 'INTEGER'),
+        ('location', 'VARCHAR'),
+        ('user_agent', 'VARCHAR'),
+    ],
+    # the NextSong events whose song wasn't loaded yet, kept until a later run loads it
+    'parked_plays': [
+        ('ts', 'BIGINT NOT NULL'),
+        ('start_time', 'TIMESTAMP NOT NULL'),
+        ('user_id', 'INTEGER'),
+        ('level', 'VARCHAR'),
+        ('song_key', 'BIGINT'),
+        ('session_id', 'INTEGER'),
+        ('location', 'VARCHAR'),
+        ('user_agent', 'VARCHAR'),
+        ('parked_at', 'TIMESTAMP NOT NULL'),
+    ],
+    'staging_songs': [
+        ('num_songs', 'INTEGER'),
+        ('artist_id', 'VARCHAR'),
+        ('artist_latitude', 'DECIMAL'),
+        ('artist_longitude', 'DECIMAL'),
+        ('artist_location', 'VARCHAR'),
+        ('artist_name', 'VARCHAR'),
+        ('song_id', 'VARCHAR'),
+        ('title', 'VARCHAR'),
+        ('duration', 'DECIMAL'),
+        ('year', 'INTEGER'),
+    ],
+    'songplays': [
+        ('songplay_id', 'INTEGER IDENTITY(0,1) PRIMARY KEY'),
+        ('start_time', 'TIMESTAMP NOT NULL'),
+        ('time_key', 'BIGINT NOT NULL REFERENCES time(time_key)'),
+        ('user_id', 'INTEGER NOT NULL REFERENCES users(user_id)'),
+        ('level', 'VARCHAR'),
+        ('song_id', 'VARCHAR NOT NULL REFERENCES songs(song_id)'),
+        ('artist_id', 'VARCHAR NOT NULL REFERENCES artists(artist_id)'),
+        ('session_id', 'INTEGER NOT NULL'),
+        ('location', 'VARCHAR'),
+        ('user_agent', 'VARCHAR'),
+    ],
+    'artists': [
+        ('artist_id', 'VARCHAR PRIMARY KEY'),
+        ('name', 'VARCHAR NOT NULL'),
+        ('location', 'VARCHAR'),
+        ('latitude', 'DECIMAL'),
+        ('longitude', 'DECIMAL'),
+    ],
+    'users': [
+        ('user_id', 'INTEGER PRIMARY KEY'),
+        ('first_name', 'VARCHAR NOT NULL'),
+        ('last_name', 'VARCHAR NOT NULL'),
+        ('gender', 'CHAR(1)'),
+        ('level', 'VARCHAR NOT NULL'),
+    ],
+    'songs': [
+        ('song_id', 'VARCHAR PRIMARY KEY'),
+        ('title', 'VARCHAR NOT NULL'),
+        ('artist_id', 'VARCHAR NOT NULL REFERENCES artists(artist_id)'),
+        ('year', 'INTEGER NOT NULL'),
+        ('duration', 'INTEGER NOT NULL'),
+    ],
+    # a calendar: one row per second or minute, time_key numbers them from the epoch
+    'time': [
+        ('time_key', 'BIGINT PRIMARY KEY'),
+        ('start_time', 'TIMESTAMP NOT NULL'),
+        ('hour', 'NUMERIC NOT NULL'),
+        ('day', 'NUMERIC NOT NULL'),
+        ('week', 'NUMERIC NOT NULL'),
+        ('month', 'NUMERIC NOT NULL'),
+        ('year', 'NUMERIC NOT NULL'),
+        ('weekday', 'NUMERIC NOT NULL'),
+    ],
+    'song_lookup': [
+        ('song_key', 'BIGINT NOT NULL'),
+        ('song_id', 'VARCHAR NOT NULL'),
+        ('artist_id', 'VARCHAR NOT NULL'),
+    ],
+    'etl_watermarks': [
+        ('source', 'VARCHAR PRIMARY KEY'),
+        ('last_ts', 'BIGINT NOT NULL'),
+        ('last_partition', 'VARCHAR NOT NULL'),
+        ('updated_at', 'TIMESTAMP NOT NULL'),
+    ],
+    'etl_checkpoints': [
+        ('run_id', 'VARCHAR NOT NULL'),
+        ('step', 'VARCHAR NOT NULL'),
+        ('partition_key', 'VARCHAR NOT NULL'),
+        ('status', 'VARCHAR NOT NULL'),
+        ('row_count', 'BIGINT'),
+        ('seconds', 'DOUBLE PRECISION'),
+        ('updated_at', 'TIMESTAMP NOT NULL'),
+    ],
+    'etl_query_metrics': [
+        ('run_id', 'VARCHAR NOT NULL'),
+        ('step', 'VARCHAR NOT NULL'),
+        ('partition_key', 'VARCHAR NOT NULL'),
+        ('query', 'BIGINT NOT NULL'),
+        ('query_group', 'VARCHAR'),
+        ('elapsed_ms', 'BIGINT'),
+        ('queue_ms', 'BIGINT'),
+        ('rows_scanned', 'BIGINT'),
+        ('bytes_scanned', 'BIGINT'),
+        ('rows_inserted', 'BIGINT'),
+        ('broadcast_steps', 'INTEGER'),
+        ('redistribute_steps', 'INTEGER'),
+        ('diskbased_steps', 'INTEGER'),
+        ('files_loaded', 'INTEGER'),
+        ('lines_loaded', 'BIGINT'),
+        ('load_errors', 'INTEGER'),
+        ('aborted', 'INTEGER'),
+        ('query_text', 'VARCHAR(256)'),
+        ('recorded_at', 'TIMESTAMP NOT NULL'),
+    ],
+}
+
+def render_create_table(table, design=None):
+    """
+    Render the CREATE TABLE statement of a table with its physical design
+
+    Params:
+    table -- the table name, a key of table_columns
+    design -- dict with the optional keys diststyle (all, key, even or auto), distkey,
+              sortkey (list of columns), sortstyle (compound or interleaved),
+              encode (dict mapping a column to its encoding) and widths (dict
+              mapping a VARCHAR column to its length)
+
+    Returns
+    query -- the CREATE TABLE statement
+    """
+
+    design = design or {}
+    encode = design.get('encode', {})
+    widths = design.get('widths', {})
+
+    columns = []
+    for name, definition in table_columns[table]:
+        if name in widths and definition.startswith('VARCHAR'):
+            definition = f'VARCHAR({widths[name]})' + definition[len('VARCHAR'):]
+        column = f'{name} {definition}'
+        if name in encode:
+            column += f' ENCODE {encode[name]}'
+        columns.append(column)
+
+    attributes = []
+    diststyle = design.get('diststyle')
+    if diststyle:
+        attributes.append(f'DISTSTYLE {diststyle.upper()}')
+    if design.get('distkey'):
+        attributes.append(f"DISTKEY ({design['distkey']})")
+    if design.get('sortkey'):
+        sortstyle = design.get('sortstyle', 'compound').upper()
+        attributes.append(f"{sortstyle} SORTKEY ({', '.join(design['sortkey'])})")
+
+    query = 'CREATE TABLE IF NOT EXISTS {}\n(\n    {}\n)'.format(table, ',\n    '.join(columns))
+    if attributes:
+        query += '\n' + '\n'.join(attributes)
+
+    return query + ';'
+
+
+# the CREATE TABLE statements are rendered by table_design.py, with a layout of table_design.cfg
+
+
+# STAGING TABLES
+
+query_templates.update({
+    'copy_staging_events': (
+        """
+    COPY staging_events 
+    FROM {log_data}
+    iam_role '{iam_role_arn}'
+    FORMAT AS json {log_jsonpath}
+    """),
+    'copy_staging_songs': (
+        """
+    COPY staging_songs 
+    FROM {song_data}
+    iam_role '{iam_role_arn}'
+    FORMAT AS json 'auto'
+    """),
+    # one date partition, its S3 path is the path parameter
+    'copy_staging_events_partition': (
+        """
+    COPY staging_events 
+    FROM '{path}'
+    iam_role '{iam_role_arn}'
+    FORMAT AS json {log_jsonpath}
+    """),
+    # the S3 path of the manifest written by manifest.py is the manifest parameter
+    'copy_staging_events_manifest': (
+        """
+    COPY staging_events 
+    FROM '{manifest}'
+    iam_role '{iam_role_arn}'
+    FORMAT AS json {log_jsonpath}
+    MANIFEST
+    """),
+    'copy_staging_songs_manifest': (
+        """
+    COPY staging_songs 
+    FROM '{manifest}'
+    iam_role '{iam_role_arn}'
+    FORMAT AS json 'auto'
+    MANIFEST
+    """),
+})
+
+# one partition of a fan-out load: the target table, the manifest and the
+# compression option (GZIP, ZSTD or nothing) are parameters
+query_templates.update({
+    'copy_staging_events_fanout': (
+        """
+    COPY {table}
+    FROM '{manifest}'
+    iam_role '{iam_role_arn}'
+    FORMAT AS json {log_jsonpath}
+    {compression}
+    MANIFEST
+    """),
+    'copy_staging_songs_fanout': (
+        """
+    COPY {table}
+    FROM '{manifest}'
+    iam_role '{iam_role_arn}'
+    FORMAT AS json 'auto'
+    {compression}
+    MANIFEST
+    """),
+})
+
+# every slice of the cluster loads one file of a COPY at a time
+select_slice_count = "SELECT COUNT(*) FROM stv_slices;"
+
+# a partition table has the columns, distribution and sort key of its staging table,
+# ALTER TABLE APPEND then moves its blocks without copying them
+create_partition_table = "CREATE TABLE {} (LIKE {});"
+append_partition_table = "ALTER TABLE {} APPEND FROM {};"
+drop_partition_table = "DROP TABLE IF EXISTS {};"
+
+truncate_staging_events = "TRUNCATE staging_events;"
+truncate_staging_songs = "TRUNCATE staging_songs;"
+
+# a full refresh reloads the whole history, the plays of the previous loads are emptied first
+full_refresh_queries = ["TRUNCATE songplays;", "TRUNCATE parked_plays;"]
+
+# SPECTRUM
+
+# the raw JSON and its Parquet copies can be read in place through external tables
+# instead of being copied into the staging tables
+
+
+def render_external_columns(table):
+    """
+    The columns of an external table over the raw JSON of a staging table,
+    external VARCHAR columns need a length
+
+    Params:
+    table -- the staging table, a key of table_columns
+
+    Returns
+    columns -- the column definitions, one per line
     """
-    CREATE TABLE staging_events 
+
+    columns = []
+    for name, definition in table_columns[table]:
+        if definition == 'VARCHAR':
+            definition = 'VARCHAR(1024)'
+        columns.append(f'{name} {definition}')
+
+    return ',\n    '.join(columns)
+
+
+select_external_tables = "SELECT tablename FROM svv_external_tables WHERE schemaname = %s;"
+
+query_templates.update({
+    'create_external_schema': (
+        """
+    CREATE EXTERNAL SCHEMA IF NOT EXISTS {spectrum_schema}
+    FROM DATA CATALOG DATABASE '{spectrum_database}'
+    IAM_ROLE '{iam_role_arn}'
+    CREATE EXTERNAL DATABASE IF NOT EXISTS;
+    """),
+    # the event logs, partitioned by the year and month of their log_data/YYYY/MM/ prefix
+    'create_external_events_json': (
+        """
+    CREATE EXTERNAL TABLE {{spectrum_schema}}.events_json
     (
-        artist VARCHAR,
-        auth VARCHAR,
-        firstName VARCHAR,
-        gender CHAR(1),
-        itemInSession INTEGER,
-        lastName VARCHAR,
-        length DECIMAL,
-        level VARCHAR,
-        location VARCHAR,
-        method VARCHAR,
-        page VARCHAR,
-        registration FLOAT,
-        sessionId INTEGER,
-        song VARCHAR,
-        status INTEGER,
-        ts VARCHAR,
-        userAgent VARCHAR,
-        userId INTEGER
-    );
-    """
-)
-
-create_staging_songs_table= (
-    """
-    CREATE TABLE staging_songs 
+    {}
+    )
+    PARTITIONED BY (year INTEGER, month INTEGER)
+    ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+    LOCATION '{{log_data_location}}/'
+    TABLE PROPERTIES ('data_cleansing_enabled'='true');
+    """).format(render_external_columns('staging_events')),
+    'create_external_songs_json': (
+        """
+    CREATE EXTERNAL TABLE {{spectrum_schema}}.songs_json
     (
-        num_songs INTEGER,
-        artist_id VARCHAR,
-        artist_latitude DECIMAL,
-        artist_longitude DECIMAL,
-        artist_location VARCHAR,
-        artist_name VARCHAR,
-        song_id VARCHAR,
-        title VARCHAR,
-        duration DECIMAL,
-        year INTEGER
-    );
+    {}
+    )
+    ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+    LOCATION '{{song_data_location}}/'
+    TABLE PROPERTIES ('data_cleansing_enabled'='true');
+    """).format(render_external_columns('staging_songs')),
+    # the compact Parquet copy of the event logs written by unload_events_parquet
+    'create_external_events_parquet': (
+        """
+    CREATE EXTERNAL TABLE {{spectrum_schema}}.events_parquet
+    (
+    {}
+    )
+    PARTITIONED BY (year INTEGER, month INTEGER)
+    STORED AS PARQUET
+    LOCATION '{{spectrum_parquet_path}}/events/';
+    """).format(render_external_columns('staging_events')),
+    # the external table, year, month and S3 location of a partition are parameters
+    'add_external_partition': (
+        """
+    ALTER TABLE {spectrum_schema}.{table}
+    ADD IF NOT EXISTS PARTITION (year={year}, month={month})
+    LOCATION '{location}';
+    """),
+    # one month of events, UNLOAD writes it under events/year=YYYY/month=M/
+    'unload_events_parquet': (
+        """
+    UNLOAD ('SELECT {}, year, month FROM {{spectrum_schema}}.events_json WHERE year = {{year}} AND month = {{month}}')
+    TO '{{spectrum_parquet_path}}/events/'
+    IAM_ROLE '{{iam_role_arn}}'
+    FORMAT AS PARQUET
+    PARTITION BY (year, month)
+    ALLOWOVERWRITE;
+    """).format(', '.join(name for name, _ in table_columns['staging_events'])),
+    'external_parquet_partition': '{spectrum_parquet_path}/events/year={year}/month={month}/',
+})
+
+
+# WATERMARKS
+
+select_watermark = "SELECT last_ts, last_partition FROM etl_watermarks WHERE source = %s;"
+delete_watermark = "DELETE FROM etl_watermarks WHERE source = %s;"
+insert_watermark = (
+    """
+    INSERT INTO etl_watermarks (source, last_ts, last_partition, updated_at)
+    VALUES (%s, %s, %s, GETDATE());
     """
 )
+select_max_ts = "SELECT MAX(ts) FROM {};"
+select_max_staging_ts = select_max_ts.format('staging_events')
+
 
-create_playsong_table=(
+# CHECKPOINTS
+
+# the newest run that didn't reach its final step is resumed
+select_unfinished_run = (
     """
-    CREATE TABLE IF NOT EXISTS songplays 
-    (
-        songplay_id INTEGER 	IDENTITY(0,1) 	PRIMARY KEY,
-		start_time	TIMESTAMP 	NOT NULL 		SORTKEY,
-		user_id		INTEGER		NOT NULL 		REFERENCES users(user_id),
-		LEVEL		VARCHAR,
-		song_id		VARCHAR		NOT NULL 		REFERENCES	songs(song_id),
-		artist_id	VARCHAR		NOT NULL 		REFERENCES	artists(artist_id),
-		session_id	INTEGER		NOT NULL,
-		location	VARCHAR, 
-		user_agent	VARCHAR
-    );
+    SELECT run_id
+    FROM etl_checkpoints
+    WHERE run_id = (SELECT MAX(run_id) FROM etl_checkpoints)
+    AND run_id NOT IN (SELECT run_id FROM etl_checkpoints WHERE step = 'run' AND status = 'done')
+    LIMIT 1;
     """
 )
-
-create_artists_table=(
+select_done_steps = "SELECT step, partition_key FROM etl_checkpoints WHERE run_id = %s AND status = 'done';"
+delete_checkpoint = "DELETE FROM etl_checkpoints WHERE run_id = %s AND step = %s AND partition_key = %s;"
+insert_checkpoint = (
     """
-    CREATE TABLE IF NOT EXISTS artists 
-    (
-        artist_id	VARCHAR		DISTKEY 	PRIMARY KEY,
-		name		VARCHAR 	NOT NULL,
-		location	VARCHAR,
-		latitude	DECIMAL,
-		longitude	DECIMAL
-    );
+    INSERT INTO etl_checkpoints (run_id, step, partition_key, status, row_count, seconds, updated_at)
+    VALUES (%s, %s, %s, %s, %s, %s, GETDATE());
     """
 )
+count_rows = "SELECT COUNT(*) FROM {};"
+
+# QUERY METRICS
+
+# every statement of a step runs under a query group, so its queries can be found
+# in the system tables afterwards
+set_query_group = "SET query_group TO %s;"
+reset_query_group = "RESET query_group;"
 
-create_users_table=(
+# one row per query of a query group: the elapsed and queue times, what the query
+# scanned and wrote, the broadcast, redistribution and disk-based steps of its
+# plan and, for a COPY, the files and lines it loaded and its load errors
+select_query_metrics = (
     """
-    CREATE TABLE IF NOT EXISTS users 
-    (
-        user_id		INTEGER		SORTKEY 	PRIMARY KEY,
-		first_name	VARCHAR 	NOT NULL,
-		last_name	VARCHAR 	NOT NULL,
-		gender		CHAR(1),
-        level 		VARCHAR NOT NULL
-    );
+    WITH tagged AS (
+        SELECT query, TRIM(label) AS query_group, starttime, endtime, aborted,
+            SUBSTRING(TRIM(querytxt), 1, 256) AS query_text
+        FROM stl_query
+        WHERE TRIM(label) = %(query_group)s
+    )
+    SELECT q.query,
+        q.query_group,
+        DATEDIFF(ms, q.starttime, q.endtime) AS elapsed_ms,
+        COALESCE(w.total_queue_time, 0) / 1000 AS queue_ms,
+        COALESCE(s.rows_scanned, 0) AS rows_scanned,
+        COALESCE(s.bytes_scanned, 0) AS bytes_scanned,
+        COALESCE(s.rows_inserted, 0) AS rows_inserted,
+        COALESCE(s.broadcast_steps, 0) AS broadcast_steps,
+        COALESCE(s.redistribute_steps, 0) AS redistribute_steps,
+        COALESCE(s.diskbased_steps, 0) AS diskbased_steps,
+        COALESCE(l.files_loaded, 0) AS files_loaded,
+        COALESCE(l.lines_loaded, 0) AS lines_loaded,
+        COALESCE(e.load_errors, 0) AS load_errors,
+        q.aborted,
+        q.query_text
+    FROM tagged q
+    LEFT JOIN stl_wlm_query w ON w.query = q.query
+    LEFT JOIN (
+        SELECT query,
+            SUM(CASE WHEN label LIKE 'scan%%' THEN rows ELSE 0 END) AS rows_scanned,
+            SUM(CASE WHEN label LIKE 'scan%%' THEN bytes ELSE 0 END) AS bytes_scanned,
+            SUM(CASE WHEN label LIKE 'insert%%' THEN rows ELSE 0 END) AS rows_inserted,
+            SUM(CASE WHEN label LIKE 'bcast%%' THEN 1 ELSE 0 END) AS broadcast_steps,
+            SUM(CASE WHEN label LIKE 'dist%%' THEN 1 ELSE 0 END) AS redistribute_steps,
+            SUM(CASE WHEN is_diskbased = 't' THEN 1 ELSE 0 END) AS diskbased_steps
+        FROM svl_query_summary
+        WHERE query IN (SELECT query FROM tagged)
+        GROUP BY query
+    ) s ON s.query = q.query
+    LEFT JOIN (
+        SELECT query, COUNT(DISTINCT filename) AS files_loaded, SUM(lines_scanned) AS lines_loaded
+        FROM stl_load_commits
+        WHERE query IN (SELECT query FROM tagged)
+        GROUP BY query
+    ) l ON l.query = q.query
+    LEFT JOIN (
+        SELECT query, COUNT(*) AS load_errors
+        FROM stl_load_errors
+        WHERE query IN (SELECT query FROM tagged)
+        GROUP BY query
+    ) e ON e.query = q.query
+    ORDER BY q.starttime;
     """
 )
 
-create_songs_table=(
+insert_query_metric = (
     """
-    CREATE TABLE IF NOT EXISTS songs 
-    (
-        song_id		VARCHAR		SORTKEY 	PRIMARY KEY,
-		title		VARCHAR 	NOT NULL,
-		artist_id	VARCHAR		NOT NULL 	REFERENCES	artists(artist_id),
-		year		INTEGER		NOT NULL,
-		duration	INTEGER		NOT NULL
-    );
+    INSERT INTO etl_query_metrics (run_id, step, partition_key, query, query_group, elapsed_ms, queue_ms,
+        rows_scanned, bytes_scanned, rows_inserted, broadcast_steps, redistribute_steps, diskbased_steps,
+        files_loaded, lines_loaded, load_errors, aborted, query_text, recorded_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, GETDATE());
     """
 )
 
-create_time_table=(
+# only the staging events newer than the last loaded ts, no watermark means a full load
+staging_events_above_watermark = (
+    "e.ts > (SELECT COALESCE(MAX(last_ts), 0) FROM etl_watermarks WHERE source = 'log_data')"
+)
+
+
+
+# FINAL TABLES
+
+# songs are matched on a hash of their normalized title, artist and duration, so the
+# fact insert joins on one BIGINT instead of two wide VARCHAR columns
+song_key = "FNV_HASH(LOWER(TRIM({title})), FNV_HASH(LOWER(TRIM({artist})), FNV_HASH({duration})))"
+
+build_song_lookup = (
     """
-    CREATE TABLE IF NOT EXISTS time 
-    (
-        start_time	TIMESTAMP	SORTKEY 	PRIMARY KEY,
-		hour		NUMERIC 	NOT NULL,
-		day			NUMERIC		NOT NULL,
-		week 		NUMERIC		NOT NULL,
-		month		NUMERIC		NOT NULL,
-		year		NUMERIC		NOT NULL,
-		weekday		NUMERIC		NOT NULL
-    );
+    DELETE FROM song_lookup;
+
+    INSERT INTO song_lookup (song_key, song_id, artist_id)
+    SELECT song_key, song_id, artist_id
+    FROM (
+        SELECT {key} AS song_key,
+            s.song_id AS song_id,
+            s.artist_id AS artist_id,
+            ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY s.song_id) AS version
+        FROM staging_songs s
+        WHERE s.song_id IS NOT NULL AND s.artist_id IS NOT NULL
+    ) songs
+    WHERE version = 1;
+    """
+).format(key=song_key.format(title='s.title', artist='s.artist_name', duration='s.duration'))
+
+# the NextSong events above the watermark, the only events the inserts read. Their
+# timestamp and song key are computed once here instead of in every insert
+build_staging_next_songs = (
+    """
+    DELETE FROM staging_next_songs;
+
+    INSERT INTO staging_next_songs (ts, start_time, user_id, first_name, last_name, gender, level, song_key,
+                                    session_id, location, user_agent)
+    SELECT e.ts,
+        TIMESTAMP 'epoch' + e.ts / 1000 * INTERVAL '1 second',
+        e.userId,
+        e.firstName,
+        e.lastName,
+        e.gender,
+        e.level,
+        {key},
+        e.sessionId,
+        e.location,
+        e.userAgent
+    FROM staging_events e
+    WHERE e.page = 'NextSong'
+    AND e.ts IS NOT NULL
+    AND {watermark};
+    """
+).format(key=song_key.format(title='e.song', artist='e.artist', duration='e.length'),
+         watermark=staging_events_above_watermark)
+
+# a play is identified by its session, timestamp and user, its time_key depends on the
+# grain of the calendar
+query_templates['insert_into_songplay_table'] = (
+    """
+    INSERT INTO songplays (start_time, time_key, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT start_time, time_key, user_id, level, song_id, artist_id, session_id, location, user_agent
+    FROM (
+        SELECT e.start_time AS start_time,
+            e.ts / ({calendar_grain_seconds} * 1000) AS time_key,
+            e.user_id AS user_id,
+            e.level AS level,
+            l.song_id AS song_id,
+            l.artist_id AS artist_id,
+            e.session_id AS session_id,
+            e.location AS location,
+            e.user_agent AS user_agent,
+            ROW_NUMBER() OVER (PARTITION BY e.session_id, e.ts, e.user_id ORDER BY l.song_id) AS occurrence
+        FROM staging_next_songs e
+        JOIN song_lookup l ON l.song_key = e.song_key
+    ) plays
+    WHERE occurrence = 1
     """
 )
 
+# the plays of the songs that weren't loaded yet are parked instead of dropped by the join.
+# Every run first forgets the parked plays it reprocesses (a replayed partition matches or
+# parks them again), promotes the parked plays whose song it loaded into songplays, then parks
+# its own unmatched plays. Only the parked rows are matched again, not the event history
+query_templates['park_unmatched_plays'] = (
+    """
+    DELETE FROM parked_plays
+    USING staging_next_songs e
+    WHERE parked_plays.session_id = e.session_id
+    AND parked_plays.ts = e.ts
+    AND parked_plays.user_id = e.user_id;
 
-# STAGING TABLES
+    INSERT INTO songplays (start_time, time_key, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT start_time, time_key, user_id, level, song_id, artist_id, session_id, location, user_agent
+    FROM (
+        SELECT p.start_time AS start_time,
+            p.ts / ({calendar_grain_seconds} * 1000) AS time_key,
+            p.user_id AS user_id,
+            p.level AS level,
+            l.song_id AS song_id,
+            l.artist_id AS artist_id,
+            p.session_id AS session_id,
+            p.location AS location,
+            p.user_agent AS user_agent,
+            ROW_NUMBER() OVER (PARTITION BY p.session_id, p.ts, p.user_id ORDER BY l.song_id) AS occurrence
+        FROM parked_plays p
+        JOIN song_lookup l ON l.song_key = p.song_key
+    ) plays
+    WHERE occurrence = 1;
+
+    DELETE FROM parked_plays
+    USING song_lookup l
+    WHERE parked_plays.song_key = l.song_key;
 
-copy_staging_events = (
+    INSERT INTO parked_plays (ts, start_time, user_id, level, song_key, session_id, location, user_agent, parked_at)
+    SELECT e.ts, e.start_time, e.user_id, e.level, e.song_key, e.session_id, e.location, e.user_agent, GETDATE()
+    FROM staging_next_songs e
+    LEFT JOIN song_lookup l ON l.song_key = e.song_key
+    WHERE l.song_key IS NULL;
     """
-    COPY staging_events 
-    FROM {}
-    iam_role '{}'
-    FORMAT AS json {}
-    """).format(S3_LOG_DATA, DWH_IAM_ROLE_ARN, S3_LOG_JSONPATH)
+)
 
-copy_staging_songs = (
+# the dimensions are upserted: the newest version of every key in the batch is staged
+# in a temp table, then the old rows are deleted and the staged rows inserted
+# in the same transaction, so the cost follows the batch size not the table size
+upsert_template = (
     """
-    COPY staging_songs 
-    FROM {}
-    iam_role '{}'
-    FORMAT AS json 'auto'
-    """).format(S3_SONG_DATA, DWH_IAM_ROLE_ARN)
+    CREATE TEMP TABLE {table}_upsert (LIKE {table});
 
+    INSERT INTO {table}_upsert ({columns})
+    SELECT {columns}
+    FROM (
+        SELECT {select},
+            ROW_NUMBER() OVER (PARTITION BY {partition_by} ORDER BY {order_by}) AS version
+        FROM {source}
+        WHERE {where}
+    ) batch
+    WHERE version = 1;
 
+    DELETE FROM {table} USING {table}_upsert WHERE {table}.{key} = {table}_upsert.{key};
 
-# FINAL TABLES
+    INSERT INTO {table} ({columns})
+    SELECT {columns} FROM {table}_upsert;
 
-insert_into_songplay_table = (
-    """
-    INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-    SELECT DISTINCT timestamp 'epoch' + cast(ts as bigint)/1000 * interval '1 second' AS start_time,
-        e.userId AS user_id,
-        e.level AS level,
-        s.song_id AS song_id,
-        s.artist_id AS artist_id,
-        e.sessionId AS session_id,
-        e.location AS location,
-        e.userAgent AS user_agent
-    FROM staging_events e
-    JOIN staging_songs s ON (e.song = s.title AND e.artist = s.artist_name)
-    AND e.page  =  'NextSong'
+    DROP TABLE {table}_upsert;
     """
 )
 
-insert_into_users_table = (
+insert_into_users_table = upsert_template.format(
+    table='users',
+    key='user_id',
+    partition_by='e.user_id',
+    columns='user_id, first_name, last_name, gender, level',
+    select="""e.user_id AS user_id,
+            e.first_name AS first_name,
+            e.last_name AS last_name,
+            e.gender AS gender,
+            e.level AS level""",
+    source='staging_next_songs e',
+    where='e.user_id IS NOT NULL',
+    # the latest event carries the current level of the user
+    order_by='e.ts DESC'
+)
+
+# staging_songs has no ts, the newest release year wins
+insert_into_songs_table = upsert_template.format(
+    table='songs',
+    key='song_id',
+    partition_by='s.song_id',
+    columns='song_id, title, artist_id, year, duration',
+    select="""s.song_id AS song_id,
+            s.title AS title,
+            s.artist_id AS artist_id,
+            s.year AS year,
+            s.duration AS duration""",
+    source='staging_songs s',
+    where='s.song_id IS NOT NULL',
+    order_by='s.year DESC'
+)
+
+insert_into_artists_table = upsert_template.format(
+    table='artists',
+    key='artist_id',
+    partition_by='s.artist_id',
+    columns='artist_id, name, location, latitude, longitude',
+    select="""s.artist_id AS artist_id,
+            s.artist_name AS name,
+            s.artist_location AS location,
+            s.artist_latitude AS latitude,
+            s.artist_longitude AS longitude""",
+    source='staging_songs s',
+    where='s.artist_id IS NOT NULL',
+    order_by='s.year DESC'
+)
+
+
+# TIME DIMENSION
+
+# the time dimension is a calendar built ahead of the plays instead of an insert of every
+# load, calendar_dimension.py adds the days the new events fall on
+select_calendar_bounds = "SELECT MIN(time_key), MAX(time_key) FROM time;"
+select_ts_bounds = "SELECT MIN(ts), MAX(ts) FROM {};"
+select_staging_ts_bounds = select_ts_bounds.format('staging_events')
+
+
+# the calendar rows of a key range, {number} numbers the rows of the {products} cross join
+query_templates['extend_calendar'] = (
     """
-    INSERT INTO users (user_id, first_name, last_name, gender, level)
-    SELECT DISTINCT(userId) AS user_id,
-        firstName AS first_name,
-        lastName AS last_name,
-        gender,
-        level
-    FROM staging_events
-    WHERE page = 'NextSong' 
-    AND user_id NOT IN (SELECT DISTINCT user_id FROM users)
+    INSERT INTO time (time_key, start_time, hour, day, week, month, year, weekday)
+    SELECT time_key,
+        start_time,
+        EXTRACT(hour FROM start_time),
+        EXTRACT(day FROM start_time),
+        EXTRACT(week FROM start_time),
+        EXTRACT(month FROM start_time),
+        EXTRACT(year FROM start_time),
+        EXTRACT(dow FROM start_time)
+    FROM (
+        SELECT {first_key} + n AS time_key,
+            TIMESTAMP 'epoch' + ({first_key} + n) * {calendar_grain_seconds} * INTERVAL '1 second' AS start_time
+        FROM (
+            SELECT {number} AS n
+            FROM {products}
+        ) numbers
+        WHERE n <= {last_offset}
+    ) calendar;
     """
 )
 
-insert_into_songs_table = (
+
+def render_extend_calendar(first_key, last_key, dialect='redshift', settings=None):
     """
-    INSERT INTO songs (song_id, title, artist_id, year, duration)
-    SELECT DISTINCT(song_id) AS song_id,
-        title,
-        artist_id,
-        year,
-        duration
-    FROM staging_songs
-    WHERE song_id NOT IN (SELECT DISTINCT song_id FROM songs)
+    Render the bulk insert of the calendar rows from first_key to last_key. Redshift
+    can't insert from generate_series, the row numbers come from a cross join of
+    digits, one per decimal place of the range
+
+    Params:
+    first_key -- the time_key of the first row
+    last_key -- the time_key of the last row
+    dialect -- the SQL dialect, a key of dialect_rules
+    settings -- dict of default parameters, the ones of dwh.cfg when None
+
+    Returns
+    query -- the INSERT statement
     """
+
+    places = len(str(last_key - first_key))
+    digits = ' UNION ALL '.join(f'SELECT {digit} AS d' for digit in range(10))
+    number = ' + '.join(f'{10 ** place} * p{place}.d' for place in range(places))
+    products = '\n            CROSS JOIN '.join(f'({digits}) p{place}' for place in range(places))
+
+    return render('extend_calendar', dialect, settings, first_key=first_key, last_offset=last_key - first_key,
+                  number=number, products=products)
+
+
+# EXPORT
+
+# how every warehouse table is exported: the column its date-range filter applies to
+# and the columns its Parquet files are partitioned by. songplays gets its year and
+# month from start_time, the other tables partition by their own columns
+unload_table_design = {
+    'songplays': {'date_column': 'start_time', 'partition_by': ['year', 'month'],
+                  'derived': ['EXTRACT(year FROM start_time) AS year', 'EXTRACT(month FROM start_time) AS month']},
+    'time': {'date_column': 'start_time', 'partition_by': ['year', 'month']},
+    'users': {'partition_by': ['level']},
+    'songs': {'partition_by': ['year']},
+    'artists': {},
+}
+
+
+def render_unload_select(table, start_date=None, end_date=None):
+    """
+    Render the query whose result UNLOAD exports for a table
+
+    Params:
+    table -- the table name, a key of unload_table_design
+    start_date -- only export the rows from this date on (YYYY-MM-DD), if the table has a date column
+    end_date -- only export the rows before this date (YYYY-MM-DD), if the table has a date column
+
+    Returns
+    query -- the SELECT statement
+    """
+
+    design = unload_table_design[table]
+    query = 'SELECT {} FROM {}'.format(', '.join(['*'] + design.get('derived', [])), table)
+
+    conditions = []
+    if design.get('date_column') and start_date:
+        conditions.append(f"{design['date_column']} >= '{start_date}'")
+    if design.get('date_column') and end_date:
+        conditions.append(f"{design['date_column']} < '{end_date}'")
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    return query
+
+
+query_templates['unload_table'] = (
+    "UNLOAD ('{query}')\n"
+    "TO '{path}/{table}/'\n"
+    "IAM_ROLE '{iam_role_arn}'\n"
+    "FORMAT AS PARQUET\n"
+    "{options}"
+    "MANIFEST VERBOSE\n"
+    "ALLOWOVERWRITE;"
 )
 
-insert_into_artists_table = (
+
+def render_unload(table, path, start_date=None, end_date=None, max_file_size_mb=None, dialect='redshift',
+                  settings=None):
     """
-    INSERT INTO artists (artist_id, name, location, latitude, longitude)
-    SELECT DISTINCT(artist_id) as artist_id,
-        artist_name AS name,
-        artist_location AS location,
-        artist_latitude AS latitude,
-        artist_longitude AS longitude
-    FROM staging_songs
-    WHERE artist_id NOT IN (SELECT DISTINCT artist_id FROM artists)
+    Render the UNLOAD of a table to partitioned Parquet files and a manifest.
+    The slices write the files in parallel, nothing goes through the leader node
+
+    Params:
+    table -- the table name, a key of unload_table_design
+    path -- the S3 prefix the tables are exported under, each table gets its own folder
+    start_date -- only export the rows from this date on (YYYY-MM-DD)
+    end_date -- only export the rows before this date (YYYY-MM-DD)
+    max_file_size_mb -- the maximum size of a Parquet file, 6200 MB by default
+    dialect -- the SQL dialect, a key of dialect_rules
+    settings -- dict of default parameters, the ones of dwh.cfg when None
+
+    Returns
+    query -- the UNLOAD statement
     """
+
+    # the quotes of the query are doubled inside the UNLOAD string literal
+    query = render_unload_select(table, start_date, end_date).replace("'", "''")
+    partition_by = unload_table_design[table].get('partition_by')
+
+    options = ''
+    if partition_by:
+        # INCLUDE keeps the partition columns in the files too
+        options += f"PARTITION BY ({', '.join(partition_by)}) INCLUDE\n"
+    if max_file_size_mb:
+        options += f'MAXFILESIZE {max_file_size_mb} MB\n'
+
+    return render('unload_table', dialect, settings, query=query, path=path.rstrip('/'), table=table,
+                  options=options)
+
+
+# DATA QUALITY
+
+# the row count of a table recorded by the last finished step of a previous run
+quality_previous_rows = (
+    "SELECT row_count FROM etl_checkpoints "
+    "WHERE step = '{}' AND status = 'done' AND row_count IS NOT NULL AND run_id < %(run_id)s "
+    "ORDER BY run_id DESC, updated_at DESC LIMIT 1"
 )
 
-insert_into_time_table = (
+# the newest loaded event, as a timestamp
+quality_watermark_time = (
+    "SELECT TIMESTAMP 'epoch' + MAX(last_ts) / 1000 * INTERVAL '1 second' "
+    "FROM etl_watermarks WHERE source = %(source)s"
+)
+
+
+def render_quality_check(table, checks):
     """
-    INSERT INTO time (start_time, hour, day, week, month, year, weekday)
-    SELECT DISTINCT timestamp 'epoch' + cast(ts as bigint)/1000 * interval '1 second' AS start_time,
-            EXTRACT(hour FROM start_time) AS hour,
-            EXTRACT(day FROM start_time) AS day,
-            EXTRACT(week FROM start_time) AS week,
-            EXTRACT(month FROM start_time) AS month,
-            EXTRACT(year FROM start_time) AS year,
-            EXTRACT(dayofweek FROM start_time) as weekday
-    FROM staging_events e;
+    Render the query computing every check of a table in one pass: the inner
+    query scans the table once and aggregates all the measures, the outer one
+    adds the previous row count and the freshness of the one row result
+
+    Params:
+    table -- the table name
+    checks -- dict of the checks of the table, as returned by quality.load_checks
+
+    Returns
+    query -- the SELECT statement, it takes the run_id and source named parameters
+    """
+
+    measures = ['COUNT(*) AS row_count']
+    joins = []
+    for column in checks.get('null_rates', {}):
+        measures.append(f'SUM(CASE WHEN t.{column} IS NULL THEN 1 ELSE 0 END) AS nulls_{column}')
+    for column in checks.get('unique', []):
+        measures.append(f'COUNT(t.{column}) - COUNT(DISTINCT t.{column}) AS duplicates_{column}')
+    for i, (column, (parent, key)) in enumerate(checks.get('references', {}).items()):
+        # the distinct parent keys keep the join from multiplying the rows
+        joins.append(f'LEFT JOIN (SELECT DISTINCT {key} AS parent_key FROM {parent}) r{i} '
+                     f'ON t.{column} = r{i}.parent_key')
+        measures.append(f'SUM(CASE WHEN t.{column} IS NOT NULL AND r{i}.parent_key IS NULL THEN 1 ELSE 0 END) '
+                        f'AS orphans_{column}')
+    for column in checks.get('freshness', {}):
+        measures.append(f'MAX(t.{column}) AS newest_{column}')
+
+    derived = ['measures.*']
+    if 'max_row_drop' in checks:
+        derived.append(f'({quality_previous_rows.format(table)}) AS previous_rows')
+    for column, hours in checks.get('freshness', {}).items():
+        derived.append(f"CASE WHEN newest_{column} >= ({quality_watermark_time}) - INTERVAL '{hours} hours' "
+                       f"THEN 0 ELSE 1 END AS stale_{column}")
+
+    return '\n'.join(['SELECT ' + ',\n       '.join(derived),
+                      'FROM (',
+                      '    SELECT ' + ',\n           '.join(measures),
+                      f'    FROM {table} t'] +
+                     [f'    {join}' for join in joins] +
+                     [') measures;'])
+
+
+# MAINTENANCE
+
+# unsorted and stats_off are percentages, deleted is the share of rows marked for deletion
+select_table_health = (
+    """
+    SELECT "table",
+        COALESCE(unsorted, 0) AS unsorted,
+        COALESCE(stats_off, 0) AS stats_off,
+        CASE WHEN tbl_rows > 0 THEN 100.0 * (tbl_rows - estimated_visible_rows) / tbl_rows ELSE 0 END AS deleted
+    FROM svv_table_info
+    WHERE schema = current_schema()
+    AND "table" IN %s;
     """
 )
 
+vacuum_sort_only = "VACUUM SORT ONLY {};"
+vacuum_delete_only = "VACUUM DELETE ONLY {};"
+analyze_table = "ANALYZE {};"
+
+# the search path the unqualified table names of every statement resolve in
+query_templates['set_search_path'] = "SET search_path TO {schema};"
+
+# DASHBOARD QUERIES
 
+# the aggregates behind the Power BI dashboard, used to benchmark the table layouts
+dashboard_queries = {
+    'plays by hour': (
+        """
+        SELECT t.hour, COUNT(*) AS plays
+        FROM songplays sp
+        JOIN time t ON sp.time_key = t.time_key
+        GROUP BY t.hour
+        ORDER BY t.hour;
+        """
+    ),
+    'top songs': (
+        """
+        SELECT s.title, a.name AS artist, COUNT(*) AS plays
+        FROM songplays sp
+        JOIN songs s ON sp.song_id = s.song_id
+        JOIN artists a ON sp.artist_id = a.artist_id
+        GROUP BY s.title, a.name
+        ORDER BY plays DESC
+        LIMIT 10;
+        """
+    ),
+    'plays by gender and level': (
+        """
+        SELECT u.gender, sp.level, COUNT(*) AS plays
+        FROM songplays sp
+        JOIN users u ON sp.user_id = u.user_id
+        GROUP BY u.gender, sp.level;
+        """
+    ),
+    'plays by weekday': (
+        """
+        SELECT t.weekday, COUNT(DISTINCT sp.user_id) AS listeners, COUNT(*) AS plays
+        FROM songplays sp
+        JOIN time t ON sp.time_key = t.time_key
+        GROUP BY t.weekday
+        ORDER BY t.weekday;
+        """
+    ),
+}
 
+# MATERIALIZED VIEWS
+
+# the dashboard aggregates, pre-computed after every load. They only use inner joins,
+# GROUP BY, COUNT and SUM so Redshift can refresh them incrementally
+materialized_views = {
+    'mv_daily_song_plays': (
+        """
+        SELECT DATE_TRUNC('day', sp.start_time) AS day, sp.song_id, sp.artist_id, sp.level, COUNT(*) AS plays
+        FROM songplays sp
+        GROUP BY DATE_TRUNC('day', sp.start_time), sp.song_id, sp.artist_id, sp.level
+        """
+    ),
+    'mv_hourly_activity': (
+        """
+        SELECT t.hour, t.weekday, sp.level, COUNT(*) AS plays
+        FROM songplays sp
+        JOIN time t ON sp.time_key = t.time_key
+        GROUP BY t.hour, t.weekday, sp.level
+        """
+    ),
+    'mv_plays_by_gender_level': (
+        """
+        SELECT u.gender, sp.level, COUNT(*) AS plays
+        FROM songplays sp
+        JOIN users u ON sp.user_id = u.user_id
+        GROUP BY u.gender, sp.level
+        """
+    ),
+    # one row per listener and weekday, small enough to count the distinct listeners on
+    'mv_weekday_listeners': (
+        """
+        SELECT t.weekday, sp.user_id, COUNT(*) AS plays
+        FROM songplays sp
+        JOIN time t ON sp.time_key = t.time_key
+        GROUP BY t.weekday, sp.user_id
+        """
+    ),
+}
+
+
+def render_create_view(view, auto_refresh=False):
+    """
+    Render the CREATE MATERIALIZED VIEW statement of a dashboard aggregate
+
+    Params:
+    view -- the view name, a key of materialized_views
+    auto_refresh -- let Redshift refresh the view when the cluster is idle
+
+    Returns
+    query -- the CREATE MATERIALIZED VIEW statement
+    """
+
+    return 'CREATE MATERIALIZED VIEW {}\nAUTO REFRESH {}\nAS {};'.format(
+        view, 'YES' if auto_refresh else 'NO', materialized_views[view].strip())
+
+
+refresh_view = "REFRESH MATERIALIZED VIEW {};"
+
+# the outcome of the last refresh of every view, e.g. whether it was incremental
+select_view_refresh_status = (
+    """
+    SELECT TRIM(mv_name), TRIM(status)
+    FROM (
+        SELECT mv_name, status, ROW_NUMBER() OVER (PARTITION BY mv_name ORDER BY starttime DESC) AS latest
+        FROM svl_mv_refresh_status
+        WHERE schema_name = current_schema()
+        AND mv_name IN %s
+    ) refreshes
+    WHERE latest = 1;
+    """
+)
+
+# the dashboard queries reading the materialized views instead of songplays
+dashboard_view_queries = {
+    'plays by hour': (
+        """
+        SELECT hour, SUM(plays) AS plays
+        FROM mv_hourly_activity
+        GROUP BY hour
+        ORDER BY hour;
+        """
+    ),
+    'top songs': (
+        """
+        SELECT s.title, a.name AS artist, SUM(d.plays) AS plays
+        FROM mv_daily_song_plays d
+        JOIN songs s ON d.song_id = s.song_id
+        JOIN artists a ON d.artist_id = a.artist_id
+        GROUP BY s.title, a.name
+        ORDER BY plays DESC
+        LIMIT 10;
+        """
+    ),
+    'plays by gender and level': (
+        """
+        SELECT gender, level, plays
+        FROM mv_plays_by_gender_level;
+        """
+    ),
+    'plays by weekday': (
+        """
+        SELECT weekday, COUNT(*) AS listeners, SUM(plays) AS plays
+        FROM mv_weekday_listeners
+        GROUP BY weekday
+        ORDER BY weekday;
+        """
+    ),
+}
 
 # QUERY LISTS
 
-create_tables_order = ['staging events', 'staging songs', 'time', 'users', 'artists', 'songs', 'songplays']
-create_table_queries = [create_staging_events_table, create_staging_songs_table, create_time_table, create_users_table,\
-                        create_artists_table, create_songs_table, create_playsong_table]
-                        
-drop_tables_order = ['staging events', 'staging songs', 'songplays', 'users', 'songs', 'artists', 'time']
+create_tables_names = ['staging_events', 'staging_songs', 'time', 'users', 'artists', 'songs', 'songplays', 'etl_watermarks', \
+                       'etl_checkpoints', 'song_lookup', 'etl_query_metrics', 'staging_next_songs', 'parked_plays']
+create_tables_order = ['staging events', 'staging songs', 'time', 'users', 'artists', 'songs', 'songplays', 'etl watermarks', \
+                       'etl checkpoints', 'song lookup', 'etl query metrics', 'staging next songs', 'parked plays']
+
+drop_tables_order = ['staging events', 'staging songs', 'songplays', 'users', 'songs', 'artists', 'time', 'etl watermarks', \
+                     'etl checkpoints', 'song lookup', 'etl query metrics', 'staging next songs', 'parked plays']
 drop_table_queries = [drop_staging_events_table, drop_staging_songs_table, drop_songplay_table, drop_users_table, \
-                      drop_songs_table, drop_artists_table, drop_time_table]
+                      drop_songs_table, drop_artists_table, drop_time_table, drop_watermarks_table, \
+                      drop_checkpoints_table, drop_song_lookup_table, drop_query_metrics_table, \
+                      drop_staging_next_songs_table, drop_parked_plays_table]
+
+# the views depend on the tables, they are dropped before and created after them
+view_names = list(materialized_views)
+views_order = [view.replace('_', ' ') for view in view_names]
+lazy_query_lists['create_view_queries'] = lambda: [render_create_view(view, load_settings()['mv_auto_refresh'])
+                                                   for view in view_names]
+drop_view_queries = [drop_view.format(view) for view in view_names]
+refresh_view_queries = [refresh_view.format(view) for view in view_names]
 
 staging_tables_order = ['staging events', 'staging songs']
-copy_table_queries = [copy_staging_events, copy_staging_songs]
+staging_tables_names = ['staging_events', 'staging_songs']
+lazy_query_lists['copy_table_queries'] = lambda: [render('copy_staging_events'), render('copy_staging_songs')]
+truncate_staging_queries = [truncate_staging_events, truncate_staging_songs]
 
 dwh_tables_order = ['artists', 'songs', 'time', 'users', 'songplays']
-insert_table_queries = [insert_into_artists_table, insert_into_songs_table, insert_into_time_table, insert_into_users_table, insert_into_songplay_table]
+# the time dimension is extended by calendar_dimension.py before the inserts
+insert_tables_order = ['artists', 'songs', 'users', 'songplays']
+lazy_query_lists['insert_table_queries'] = lambda: [insert_into_artists_table, insert_into_songs_table,
+                                                    insert_into_users_table, render('insert_into_songplay_table')]
+
+# the insert steps also build the song lookup the songplays insert joins against and
+# the NextSong projection the users and songplays inserts read from, then park the
+# plays without a song and promote the parked plays whose song arrived
+insert_steps_order = ['song_lookup', 'staging_next_songs'] + insert_tables_order + ['parked_plays']
+lazy_query_lists['insert_steps_queries'] = lambda: ([build_song_lookup, build_staging_next_songs]
+                                                    + lazy_query_lists['insert_table_queries']()
+                                                    + [render('park_unmatched_plays')])
+
+
+def render_insert_steps(events_source='staging_events', songs_source='staging_songs', dialect='redshift'):
+    """
+    The insert step queries reading the events and the songs from other relations
+    than the staging tables, e.g. Spectrum external tables, in a SQL dialect
+
+    Params:
+    events_source -- table or parenthesized subquery the events are read from
+    songs_source -- table or parenthesized subquery the songs are read from
+    dialect -- the SQL dialect, a key of dialect_rules
+
+    Returns
+    queries -- list of queries in insert_steps_order
+    """
+
+    return [to_dialect(query.replace('FROM staging_events e', f'FROM {events_source} e')
+                            .replace('FROM staging_songs s', f'FROM {songs_source} s'), dialect)
+            for query in lazy_query_lists['insert_steps_queries']()]
+
+
+# songplays REFERENCES all the dimension tables, the dimensions only read from staging
+insert_table_dependencies = {
+    'users': ['staging_next_songs'],
+    'songplays': ['artists', 'songs', 'users', 'song_lookup', 'staging_next_songs'],
+    # it writes songplays too, after the insert of the new plays
+    'parked_plays': ['songplays'],
+}
@@ -0,0 +1,123 @@
+import configparser
+import os
+from sql_queries import create_tables_names, render_create_table
+
+# the layout used when none is configured
+DEFAULT_LAYOUT = 'default'
+
+
+def load_layouts(path='table_design.cfg'):
+    """
+    Read the table layouts from the table design config file
+
+    Params:
+    path -- path of the table design config file
+
+    Returns
+    layouts -- dict mapping every layout name to a dict of table designs
+    """
+
+    config = configparser.ConfigParser()
+    with open(path) as configfile:
+        config.read_file(configfile)
+
+    layouts = {}
+    for section in config.sections():
+        layout, table = section.split('.', 1)
+        options = config[section]
+
+        design = {}
+        if 'diststyle' in options:
+            design['diststyle'] = options['diststyle']
+        if 'distkey' in options:
+            design['distkey'] = options['distkey']
+        if 'sortkey' in options:
+            design['sortkey'] = [column.strip() for column in options['sortkey'].split(',')]
+        if 'sortstyle' in options:
+            design['sortstyle'] = options['sortstyle']
+        if 'encode' in options:
+            design['encode'] = dict(pair.strip().split(':') for pair in options['encode'].split(','))
+
+        layouts.setdefault(layout, {})[table] = design
+
+    return layouts
+
+
+def load_column_design(path):
+    """
+    Read the column encodings and VARCHAR widths derived by compression.py
+
+    Params:
+    path -- path of the column design config file
+
+    Returns
+    column_design -- dict mapping every table to its encode and widths dicts,
+                     empty when the file doesn't exist yet
+    """
+
+    if not os.path.exists(path):
+        return {}
+
+    config = configparser.ConfigParser()
+    with open(path) as configfile:
+        config.read_file(configfile)
+
+    column_design = {}
+    for table in config.sections():
+        options = config[table]
+        column_design[table] = {
+            'encode': dict(pair.strip().split(':') for pair in options.get('encode', '').split(',') if pair),
+            'widths': {name.strip(): int(width) for name, width in
+                       (pair.split(':') for pair in options.get('widths', '').split(',') if pair)},
+        }
+
+    return column_design
+
+
+def apply_column_design(layout, column_design):
+    """
+    Merge the derived column design into a layout, the encodings set in the layout win
+
+    Params:
+    layout -- dict mapping a table to its design, as returned by load_layouts
+    column_design -- dict as returned by load_column_design
+
+    Returns
+    layout -- a new dict mapping every table to its merged design
+    """
+
+    merged = {table: dict(design) for table, design in layout.items()}
+    for table, columns in column_design.items():
+        design = merged.setdefault(table, {})
+        design['encode'] = {**columns['encode'], **design.get('encode', {})}
+        design['widths'] = columns['widths']
+
+    return merged
+
+
+def render_create_tables(layout):
+    """
+    Render the CREATE TABLE statements of all the tables for one layout
+
+    Params:
+    layout -- dict mapping a table to its design, as returned by load_layouts
+
+    Returns
+    queries -- list of CREATE TABLE statements in create_tables_names order
+    """
+
+    return [render_create_table(table, layout.get(table)) for table in create_tables_names]
+
+
+def default_create_table_queries(path='table_design.cfg'):
+    """
+    Render the CREATE TABLE statements of all the tables with the default layout
+
+    Params:
+    path -- path of the table design config file
+
+    Returns
+    queries -- list of CREATE TABLE statements in create_tables_names order
+    """
+
+    return render_create_tables(load_layouts(path)[DEFAULT_LAYOUT])
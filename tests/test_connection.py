@@ -0,0 +1,117 @@
+import configparser
+import psycopg2.extensions
+import psycopg2.pool
+import pytest
+from connection import ClusterPool
+from instrumentation import query_group
+
+
+class FakeInfo:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=None):
+        self.conn.statements.append((query, params))
+
+
+class FakeConnection:
+    info = FakeInfo()
+
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    # only counted, a closed connection is freed and its id can be reused like with psycopg2
+    count = []
+
+    def connect(*args, **kwargs):
+        count.append(1)
+        return FakeConnection()
+
+    monkeypatch.setattr(psycopg2.pool.psycopg2, 'connect', connect)
+    return count
+
+
+def make_config(**connection):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'CLUSTER': {'host': 'localhost', 'db_name': 'dwh', 'db_user': 'dwh', 'db_password': 'dwh', 'db_port': '5439'},
+        'CONNECTION': {'max_connections': '5', 'connect_timeout': '10', 'statement_timeout_ms': '1000',
+                       'keepalives_idle': '60', 'keepalives_interval': '10', 'keepalives_count': '5',
+                       'retries': '1', 'retry_backoff': '0', **connection},
+    })
+    return config
+
+
+def is_prepared(conn):
+    return ('SET statement_timeout TO %s;', (1000,)) in conn.statements
+
+
+def test_every_checkout_is_prepared(opened):
+    pool = ClusterPool(make_config(min_connections='1'))
+    control = pool.getconn()
+
+    for _ in range(50):
+        conns = [pool.getconn() for _ in range(4)]
+        assert all(is_prepared(conn) for conn in conns)
+        for conn in conns:
+            pool.putconn(conn)
+
+    assert is_prepared(control)
+    assert ('SET query_group TO %s;', ('etl',)) in control.statements
+
+
+def test_sessions_are_kept_by_default(opened):
+    pool = ClusterPool(make_config())
+
+    for _ in range(50):
+        conns = [pool.getconn() for _ in range(5)]
+        assert all(is_prepared(conn) for conn in conns)
+        for conn in conns:
+            pool.putconn(conn)
+
+    assert len(opened) == 5
+    # every session was set up once
+    assert all(conn.statements.count(('SET statement_timeout TO %s;', (1000,))) == 1 for conn in conns)
+
+
+def test_query_group_goes_back_to_the_pool_group(opened):
+    pool = ClusterPool(make_config(), query_group='etl_nightly')
+    conn = pool.getconn()
+
+    with query_group(conn.cursor(), conn, 'etl/run/step'):
+        pass
+
+    assert conn.statements[-2:] == [('SET query_group TO %s;', ('etl/run/step',)),
+                                    ('SET query_group TO %s;', ('etl_nightly',))]
+
+
+def test_query_group_resets_a_session_without_group(opened):
+    pool = ClusterPool(make_config(), query_group=None)
+    conn = pool.getconn()
+
+    with pytest.raises(ValueError):
+        with query_group(conn.cursor(), conn, 'etl/run/step'):
+            raise ValueError
+
+    assert conn.statements[-1] == ('RESET query_group;', None)
@@ -0,0 +1,103 @@
+import json
+from datetime import datetime, timezone
+import boto3
+import pytest
+from moto import mock_aws
+from manifest import expand_prefixes, list_objects, filter_objects, balance_objects, build_manifest, \
+                     prepare_manifest
+
+BUCKET = 'udacity-dend'
+
+LOG_KEYS = {
+    'log_data/2018/11/2018-11-01-events.json': 100,
+    'log_data/2018/11/2018-11-02-events.json': 400,
+    'log_data/2018/11/2018-11-30-events.json': 300,
+    'log_data/2018/12/2018-12-01-events.json': 200,
+    'log_data/2018/12/notes.txt': 10,
+}
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        for key, size in LOG_KEYS.items():
+            client.put_object(Bucket=BUCKET, Key=key, Body=b'x' * size)
+        yield client
+
+
+def test_expand_prefixes_walks_the_month_directories(s3):
+    assert expand_prefixes(s3, BUCKET, 'log_data', 2) == ['log_data/2018/11/', 'log_data/2018/12/']
+
+
+def test_expand_prefixes_stops_at_a_prefix_holding_objects(s3):
+    s3.put_object(Bucket=BUCKET, Key='log_data/2018/loose.json', Body=b'{}')
+
+    assert expand_prefixes(s3, BUCKET, 'log_data', 2) == ['log_data/2018/']
+
+
+def test_list_objects_finds_every_object_once(s3):
+    objects = list_objects(s3, f's3://{BUCKET}/log_data', max_workers=4)
+
+    assert [(key, size) for key, size, _ in objects] == sorted(LOG_KEYS.items())
+
+
+def test_filter_objects_by_pattern_and_dates(s3):
+    objects = list_objects(s3, f's3://{BUCKET}/log_data', max_workers=4)
+
+    matching = filter_objects(objects, '*.json', start_date='2018-11-02', end_date='2018-11-30')
+
+    assert [key for key, _, _ in matching] == ['log_data/2018/11/2018-11-02-events.json',
+                                                'log_data/2018/11/2018-11-30-events.json']
+
+
+def test_filter_objects_dates_undated_keys_by_last_modified():
+    last_modified = datetime(2018, 11, 15, tzinfo=timezone.utc)
+    objects = [('song_data/A/A/A/TRAAAAK128F9318786.json', 10, last_modified)]
+
+    assert filter_objects(objects, start_date='2018-11-15') == objects
+    assert filter_objects(objects, start_date='2018-11-16') == []
+
+
+def test_balance_objects_evens_out_the_group_sizes():
+    objects = [(f'key{size}', size, None) for size in [400, 300, 200, 100, 100]]
+
+    groups = balance_objects(objects, 2)
+
+    assert sorted(sum(obj[1] for obj in group) for group in groups) == [500, 600]
+    assert sorted(obj for group in groups for obj in group) == sorted(objects)
+
+
+def test_balance_objects_leaves_extra_groups_empty():
+    groups = balance_objects([('key', 10, None)], 3)
+
+    assert [len(group) for group in groups] == [1, 0, 0]
+
+
+def test_build_manifest_interleaves_the_groups():
+    groups = [[('a', 3, None), ('b', 1, None)], [('c', 2, None)]]
+
+    manifest = build_manifest(BUCKET, groups)
+
+    assert manifest == {'entries': [
+        {'url': f's3://{BUCKET}/a', 'mandatory': True, 'meta': {'content_length': 3}},
+        {'url': f's3://{BUCKET}/c', 'mandatory': True, 'meta': {'content_length': 2}},
+        {'url': f's3://{BUCKET}/b', 'mandatory': True, 'meta': {'content_length': 1}},
+    ]}
+
+
+def test_prepare_manifest_writes_the_filtered_manifest(s3):
+    manifest_path = f's3://{BUCKET}/manifests/staging_events.manifest'
+
+    stats = prepare_manifest(s3, f's3://{BUCKET}/log_data', manifest_path, num_slices=2, max_workers=4,
+                             pattern='*.json', start_date='2018-11-02')
+
+    body = json.loads(s3.get_object(Bucket=BUCKET, Key='manifests/staging_events.manifest')['Body'].read())
+    assert sorted(entry['url'] for entry in body['entries']) == [
+        f's3://{BUCKET}/log_data/2018/11/2018-11-02-events.json',
+        f's3://{BUCKET}/log_data/2018/11/2018-11-30-events.json',
+        f's3://{BUCKET}/log_data/2018/12/2018-12-01-events.json',
+    ]
+    assert all(entry['mandatory'] for entry in body['entries'])
+    assert stats == {'objects': 3, 'bytes': 900, 'max_group_bytes': 500, 'min_group_bytes': 400}
@@ -0,0 +1,95 @@
+import boto3
+import pytest
+from botocore.exceptions import WaiterError
+from moto import mock_aws
+from moto.core import DEFAULT_ACCOUNT_ID
+from moto.redshift.models import redshift_backends
+import provisioning
+from provisioning import wait_for_cluster, prepare_security_group, find_subnet_group
+
+REGION = 'us-west-2'
+CLUSTER = 'dwhcluster'
+
+
+@pytest.fixture
+def aws():
+    with mock_aws():
+        yield
+
+
+@pytest.fixture
+def redshift(aws):
+    client = boto3.client('redshift', region_name=REGION)
+    client.create_cluster(ClusterIdentifier=CLUSTER, NodeType='dc2.large', ClusterType='single-node',
+                          MasterUsername='dwhuser', MasterUserPassword='Passw0rd1')
+    return client
+
+
+@pytest.fixture
+def ec2(aws):
+    return boto3.client('ec2', region_name=REGION)
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    # the backoff of poll moves a fake clock instead of sleeping
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(provisioning.time, 'sleep', sleep)
+    monkeypatch.setattr(provisioning.time, 'monotonic', lambda: sum(slept))
+    return slept
+
+
+def set_cluster_status(status):
+    redshift_backends[DEFAULT_ACCOUNT_ID][REGION].clusters[CLUSTER].status = status
+
+
+def test_wait_for_cluster_returns_once_available(redshift, no_sleep):
+    assert wait_for_cluster(redshift, 'cluster_available', CLUSTER, timeout=60) < 60
+    assert no_sleep == []
+
+
+def test_wait_for_cluster_raises_on_a_terminal_state(redshift, no_sleep):
+    set_cluster_status('deleting')
+
+    with pytest.raises(WaiterError):
+        wait_for_cluster(redshift, 'cluster_available', CLUSTER, timeout=60)
+
+
+def test_wait_for_cluster_times_out(redshift, no_sleep):
+    # an available cluster is never deleted
+    with pytest.raises(TimeoutError):
+        wait_for_cluster(redshift, 'cluster_deleted', CLUSTER, timeout=30, initial_delay=5, max_delay=10)
+
+    assert no_sleep == [5, 10, 10]
+
+
+def test_prepare_security_group_with_the_rule_already_open(ec2):
+    group_id = prepare_security_group(ec2, 5439)
+
+    assert prepare_security_group(ec2, 5439) == group_id
+
+    group = ec2.describe_security_groups(GroupIds=[group_id])['SecurityGroups'][0]
+    rules = [rule for rule in group['IpPermissions'] if rule.get('FromPort') == 5439]
+    assert len(rules) == 1
+    assert rules[0]['IpRanges'] == [{'CidrIp': '0.0.0.0/0'}]
+
+
+def test_find_subnet_group_existing(redshift, ec2):
+    vpc_id = ec2.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']['VpcId']
+    subnet_id = ec2.create_subnet(VpcId=vpc_id, CidrBlock='10.0.1.0/24')['Subnet']['SubnetId']
+    redshift.create_cluster_subnet_group(ClusterSubnetGroupName='dwh-subnets', Description='dwh',
+                                         SubnetIds=[subnet_id])
+
+    assert find_subnet_group(redshift, 'dwh-subnets') == 'dwh-subnets'
+
+
+def test_find_subnet_group_missing_falls_back_to_the_default(redshift):
+    assert find_subnet_group(redshift, 'dwh-subnets') is None
+
+
+def test_find_subnet_group_not_configured(redshift):
+    assert find_subnet_group(redshift, '') is None
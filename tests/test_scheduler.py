@@ -0,0 +1,127 @@
+import threading
+import time
+import pytest
+from scheduler import validate_dag, run_dag
+
+
+class FakePool:
+    """
+    Runs every unit of work on a fake cursor, recording the queries in the order they
+    finished and the most queries running at the same time
+    """
+
+    query_group = 'etl'
+
+    def __init__(self, delay=0.01, failing=()):
+        self.delay = delay
+        self.failing = set(failing)
+        self.finished = []
+        self.statements = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def run(self, func):
+        return func(FakeCursor(self))
+
+
+class FakeCursor:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def execute(self, query, params=None):
+        pool = self.pool
+        pool.statements.append((query, params))
+        if params is not None:
+            return
+
+        with pool._lock:
+            pool.running += 1
+            pool.max_running = max(pool.max_running, pool.running)
+        try:
+            time.sleep(pool.delay)
+            if query in pool.failing:
+                raise RuntimeError(f'{query} failed')
+        finally:
+            with pool._lock:
+                pool.running -= 1
+        pool.finished.append(query)
+
+
+NODES = ['artists', 'songs', 'users', 'songplays']
+DEPENDENCIES = {'songplays': ['artists', 'songs', 'users']}
+
+
+def test_validate_dag_accepts_a_dag():
+    validate_dag(NODES, DEPENDENCIES)
+
+
+def test_validate_dag_rejects_an_unknown_dependency():
+    with pytest.raises(ValueError, match='Unknown node in dependencies: time'):
+        validate_dag(NODES, {'songplays': ['time']})
+
+
+def test_validate_dag_rejects_a_cycle():
+    with pytest.raises(ValueError, match='Cycle detected'):
+        validate_dag(NODES, {'songs': ['artists'], 'artists': ['songs']})
+
+
+def test_run_dag_runs_the_dependencies_first():
+    pool = FakePool()
+
+    timings = run_dag(NODES, NODES, DEPENDENCIES, pool, max_workers=4)
+
+    assert set(timings) == set(NODES)
+    assert pool.finished[-1] == 'songplays'
+
+
+def test_run_dag_skips_nodes_and_counts_them_as_done():
+    pool = FakePool()
+
+    timings = run_dag(NODES, NODES, DEPENDENCIES, pool, max_workers=4, skip=['artists', 'songs'])
+
+    assert set(timings) == {'users', 'songplays'}
+    assert pool.finished == ['users', 'songplays']
+
+
+def test_run_dag_stops_the_dependents_of_a_failure():
+    pool = FakePool(failing=['users'])
+    statuses = []
+
+    with pytest.raises(RuntimeError, match='users failed'):
+        run_dag(NODES, NODES, DEPENDENCIES, pool, max_workers=4,
+                on_status=lambda node, status, seconds: statuses.append((node, status)))
+
+    assert 'songplays' not in pool.finished
+    assert ('users', 'failed') in statuses
+    assert ('songplays', 'running') not in statuses
+
+
+def test_run_dag_respects_max_workers():
+    nodes = [f'node{i}' for i in range(8)]
+    pool = FakePool(delay=0.05)
+
+    run_dag(nodes, nodes, {}, pool, max_workers=2)
+
+    assert sorted(pool.finished) == nodes
+    assert pool.max_running == 2
+
+
+def test_run_dag_reports_the_wall_time_of_every_node():
+    pool = FakePool(delay=0.02)
+    statuses = []
+
+    timings = run_dag(NODES, NODES, DEPENDENCIES, pool, max_workers=4,
+                      on_status=lambda node, status, seconds: statuses.append((node, status, seconds)))
+
+    assert all(seconds >= 0.02 for seconds in timings.values())
+    assert [(node, seconds) for node, status, seconds in statuses if status == 'done'] == list(timings.items())
+
+
+def test_run_dag_restores_the_pool_query_group():
+    pool = FakePool()
+
+    run_dag(['songs'], ['songs'], {}, pool, max_workers=1, query_groups=lambda node: f'etl/run/{node}')
+
+    assert pool.statements == [('SET query_group TO %s;', ('etl/run/songs',)), ('songs', None),
+                               ('SET query_group TO %s;', ('etl',))]
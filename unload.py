@@ -0,0 +1,94 @@
+import argparse
+import configparser
+from connection import ClusterPool
+from local_postgres import translate
+from scheduler import run_dag
+from sql_queries import dwh_tables_order, render_unload, render_unload_select
+
+
+def unload_tables(pool, tables, path, max_concurrency, start_date=None, end_date=None, max_file_size_mb=None):
+    """
+    Export the tables to S3 as partitioned Parquet files, the UNLOADs run at the
+    same time on a pool of connections
+
+    Params:
+    pool -- connection.ClusterPool the UNLOADs borrow their connections from
+    tables -- the tables to export
+    path -- the S3 prefix the tables are exported under
+    max_concurrency -- maximum number of UNLOADs running at the same time
+    start_date -- only export the rows from this date on (YYYY-MM-DD)
+    end_date -- only export the rows before this date (YYYY-MM-DD)
+    max_file_size_mb -- the maximum size of a Parquet file
+
+    Returns
+    timings -- dict mapping every table to its UNLOAD wall time in seconds
+    """
+
+    print("Unloading the data warehouse tables to S3...")
+
+    queries = [render_unload(table, path, start_date, end_date, max_file_size_mb) for table in tables]
+    # the tables don't depend on each other
+    timings = run_dag(tables, queries, {}, pool, max_concurrency)
+
+    for table, seconds in timings.items():
+        print(f"{table}: {seconds:.2f}s, manifest at {path.rstrip('/')}/{table}/manifest")
+
+    print("\nAll tables unloaded successfully.\n")
+
+    return timings
+
+
+def check_local(pool, tables, start_date=None, end_date=None):
+    """
+    Plan the query of every UNLOAD on the local Postgres stand-in, so a broken
+    export fails before it reaches the cluster
+
+    Params:
+    pool -- connection.ClusterPool of the local database
+    tables -- the tables to export
+    start_date -- only export the rows from this date on (YYYY-MM-DD)
+    end_date -- only export the rows before this date (YYYY-MM-DD)
+    """
+
+    with pool.unit_of_work() as cur:
+        for i, table in enumerate(tables, 1):
+            print(f'{i}. Checking the {table} export...')
+            cur.execute('EXPLAIN ' + translate(render_unload_select(table, start_date, end_date)))
+            print('Done.')
+
+
+if __name__ == "__main__":
+    """
+    Export the star schema to S3 as partitioned Parquet, in parallel from the
+    slices instead of through the leader node
+    """
+
+    parser = argparse.ArgumentParser(description='Export the data warehouse tables to S3 as Parquet.')
+    parser.add_argument('--tables', nargs='+', choices=dwh_tables_order, default=dwh_tables_order,
+                        help='the tables to export, all of them by default')
+    parser.add_argument('--start-date', help='only export the rows from this date on (YYYY-MM-DD)')
+    parser.add_argument('--end-date', help='only export the rows before this date (YYYY-MM-DD)')
+    parser.add_argument('--max-file-size', type=int, help='maximum Parquet file size in MB, [UNLOAD] by default')
+    parser.add_argument('--dry-run', action='store_true', help='print the UNLOAD statements without running them')
+    parser.add_argument('--check-local', action='store_true',
+                        help='plan the exported queries on the local Postgres of the [LOCAL] section')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    path = config.get('UNLOAD', 'PATH')
+    max_file_size_mb = args.max_file_size or config.getint('UNLOAD', 'MAX_FILE_SIZE_MB')
+
+    if args.dry_run:
+        for table in args.tables:
+            print(render_unload(table, path, args.start_date, args.end_date, max_file_size_mb) + '\n')
+    elif args.check_local:
+        pool = ClusterPool(config, 'LOCAL', query_group=None)
+        check_local(pool, args.tables, args.start_date, args.end_date)
+        pool.closeall()
+    else:
+        pool = ClusterPool(config)
+        unload_tables(pool, args.tables, path, config.getint('UNLOAD', 'MAX_CONCURRENCY'),
+                      args.start_date, args.end_date, max_file_size_mb)
+        pool.closeall()
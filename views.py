@@ -0,0 +1,49 @@
+import time
+from sql_queries import view_names, views_order, refresh_view_queries, select_view_refresh_status
+
+
+def refresh_views(conn, views=view_names):
+    """
+    Refresh the materialized views of the dashboard right after the inserts and
+    log whether Redshift refreshed each of them incrementally or from scratch
+
+    Params:
+    conn -- connection object to database
+    views -- the views to refresh, all of them by default
+
+    Returns
+    timings -- list of (view, seconds, refresh status) tuples
+    """
+
+    print("Refreshing the materialized views...")
+
+    # every refresh commits on its own, like VACUUM in maintenance.py. The transaction the
+    # caller left open, e.g. the SET query_group of the step, is committed first
+    conn.commit()
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    timings = []
+    try:
+        refreshed = []
+        for i, (view, name, query) in enumerate(zip(views_order, view_names, refresh_view_queries), 1):
+            if name not in views:
+                continue
+            print(f'{i}. Refreshing {view} view...')
+            start = time.perf_counter()
+            cur.execute(query)
+            refreshed.append((name, time.perf_counter() - start))
+            print(f'Done in {refreshed[-1][1]:.2f}s.')
+
+        if refreshed:
+            cur.execute(select_view_refresh_status, (tuple(name for name, _ in refreshed),))
+            status = dict(cur.fetchall())
+            for name, seconds in refreshed:
+                timings.append((name, seconds, status.get(name, 'unknown')))
+                print(f'{name}: {status.get(name, "unknown")}')
+    finally:
+        conn.autocommit = False
+
+    print("\nAll materialized views refreshed.\n")
+
+    return timings